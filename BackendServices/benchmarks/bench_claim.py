@@ -0,0 +1,119 @@
+import json
+import random
+import threading
+import time
+
+from redis.exceptions import WatchError
+
+import common
+import registry
+
+# Compares claiming player slots with the atomic claim script against the previous WATCH/MULTI retry loop
+# when many clients compete for the same few game servers
+
+servers = 20
+max_players = 2
+clients = 32
+requests_per_client = 50
+
+def register_servers(redis_client):
+    redis_client.flushdb()
+    with redis_client.pipeline(transaction=False) as pipe:
+        for i in range(servers):
+            server_id = "arn:aws:ecs:task/bench-" + str(i // 10) + "-container" + str(i % 10)
+            key = registry.server_key(registry.AVAILABLE, server_id)
+            # Plenty of slots so that the benchmark measures contention and not full servers
+            pipe.hset(key, mapping={ registry.VERSION: registry.RECORD_VERSION, registry.CURRENT_PLAYERS: 0,
+                                     registry.MAX_PLAYERS: clients * requests_per_client, registry.READY: 1,
+                                     registry.ADDRESS: "10.0.0.1:1935" })
+            pipe.expire(key, 600)
+            registry.update_index(pipe, server_id, registry.AVAILABLE, 600)
+        pipe.execute()
+
+# Get up to count random available game server keys that have not expired yet from a random shard, like
+# requestgamesession did before the claim script
+def get_candidates(redis_client, count):
+    now = time.time()
+    shard = random.randrange(registry.shards)
+    candidates = []
+    members = redis_client.zrandmember(registry.index_key(registry.AVAILABLE, shard), count, withscores=True)
+    if members == None:
+        return candidates
+    # redis-py returns the members with scores as a flat list when RESP2 is used
+    if len(members) > 0 and not isinstance(members[0], (list, tuple)):
+        members = list(zip(members[0::2], members[1::2]))
+    for member, expires in members:
+        if float(expires) > now:
+            candidates.append(registry.server_key(registry.AVAILABLE, member))
+    random.shuffle(candidates)
+    return candidates
+
+# The optimistic locking implementation requestgamesession used before the claim script
+def watch_claim(redis_client, stats):
+    candidates = get_candidates(redis_client, 25)
+    with redis_client.pipeline() as pipe:
+        for x in range(55):
+            try:
+                game_server_key = random.choice(candidates)
+                if int(redis_client.hget(game_server_key, registry.READY)) == 0:
+                    continue
+                pipe.watch("-lock"+game_server_key)
+                current_reservations = pipe.hget(game_server_key, registry.RESERVED_SLOTS)
+                max_players = pipe.hget(game_server_key, registry.MAX_PLAYERS)
+                if current_reservations == None:
+                    current_reservations = 0
+                if int(current_reservations) >= int(max_players):
+                    continue
+                pipe.multi()
+                pipe.hset(game_server_key, registry.RESERVED_SLOTS, int(current_reservations) + 1)
+                pipe.hset(game_server_key, b'last-reservation-time', time.time())
+                pipe.set("-lock"+game_server_key, "")
+                pipe.expire("-lock"+game_server_key, 3)
+                pipe.execute()
+                redis_client.hget(game_server_key, registry.ADDRESS)
+                return True
+            except WatchError:
+                stats["retries"] += 1
+    return False
+
+def script_claim(redis_client, stats):
+    return registry.claim_slots(redis_client, [registry.AVAILABLE], 25) != None
+
+def run(redis_client, claim):
+    register_servers(redis_client)
+    stats = { "retries": 0, "failures": 0 }
+    durations = []
+    lock = threading.Lock()
+
+    def client():
+        for i in range(requests_per_client):
+            duration, claimed = common.timed(claim, redis_client, stats)
+            with lock:
+                durations.append(duration)
+                if not claimed:
+                    stats["failures"] += 1
+
+    with common.CommandCounter() as counter:
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    result = { "path": claim.__name__, "claims": len(durations), "claims_per_second": len(durations) / elapsed,
+               "round_trips_per_claim": counter.round_trips / float(len(durations)),
+               "commands_per_claim": counter.commands / float(len(durations)) }
+    result.update(stats)
+    result.update(common.percentiles(durations))
+    return result
+
+def main():
+    redis_client = common.connect()
+    for claim in [watch_claim, script_claim]:
+        print(json.dumps(run(redis_client, claim)))
+    redis_client.flushdb()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import json
+import time
+
+import common
+import launcher
+from simulator.fakeecs import FakeECS
+
+# Measures how long the scaler takes to start a cold fleet of Tasks with serial and concurrent run_task calls
+# The fake ECS adds a fixed API latency to every run_task call and throttles every 10th call
+
+task_counts = [100, 300, 500]
+run_task_latency = 0.2
+
+class SlowECS(FakeECS):
+
+    def run_task(self, **kwargs):
+        time.sleep(run_task_latency)
+        return FakeECS.run_task(self, **kwargs)
+
+def main():
+    redis_client = common.connect()
+    results = []
+    concurrency = launcher.max_concurrent_calls
+    for task_count in task_counts:
+        for calls in [1, concurrency]:
+            redis_client.flushdb()
+            launcher.max_concurrent_calls = calls
+            ecs = SlowECS(10, throttle_every=10)
+            with common.quiet():
+                duration, launched = common.timed(launcher.launch_tasks, redis_client, ecs, task_count,
+                                                  { "cluster": "bench", "taskDefinition": "bench" }, 2, 60)
+            results.append({ "tasks": task_count, "concurrent_calls": calls, "launched": launched,
+                             "run_task_calls": ecs.calls["run_task"], "seconds": duration })
+    launcher.max_concurrent_calls = concurrency
+    redis_client.flushdb()
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import json
+
+import redis
+
+import common
+import registry
+
+# Measures the Redis memory used per registered game server with the previous Hash format (long field names and
+# the game server id repeated in the Hash) and the current compact format. The indexes and Task keys are the same
+# for both formats, only the game server Hashes differ.
+# The Hash payload (key, field names and values) is measured on any backend. The memory Redis reports for the keys
+# (MEMORY USAGE, includes the overhead of the encoding) is only available on a real Redis
+
+server_counts = [1000, 10000]
+containers_in_task = 10
+max_players = 2
+
+# The Hash of a game server as the previous format stored it
+def previous_record(server_id):
+    return { "server-id": server_id, "current-players": 1, "max-players": max_players, "ready": 1,
+             "publicIP": "10.0.12.34", "port": 1935, "reserved-player-slots": 1 }
+
+def register_servers(redis_client, count, record_format):
+    with redis_client.pipeline(transaction=False) as pipe:
+        for i in range(count):
+            task_id = "arn:aws:ecs:us-east-1:123456789012:task/game-servers/" + "%032x" % (i // containers_in_task)
+            server_id = task_id + "-container" + str(i % containers_in_task)
+            registry.update_game_server(pipe, server_id, task_id, False, False, 1, max_players, True, "10.0.12.34", 1935,
+                                        600)
+            key = registry.server_key(registry.ACTIVE, server_id)
+            if record_format == "previous":
+                pipe.delete(key)
+                pipe.hset(key, mapping=previous_record(server_id))
+                pipe.expire(key, 600)
+            else:
+                pipe.hset(key, registry.RESERVED_SLOTS, 1)
+            if i % 1000 == 999:
+                pipe.execute()
+        pipe.execute()
+
+# Get the size of the Hash payload (key, field names and values) and the memory Redis reports (or None) of all
+# the game server Hashes and of all the keys
+def measure(redis_client):
+    hash_payload = 0
+    hash_memory = 0
+    total_memory = 0
+    supported = True
+    for key in redis_client.scan_iter(count=1000):
+        is_server = b"-gameserver-" in key
+        if is_server:
+            hash_payload += len(key) + sum(len(field) + len(value) for field, value in redis_client.hgetall(key).items())
+        if supported:
+            try:
+                usage = redis_client.memory_usage(key, samples=0) or 0
+            except redis.exceptions.ResponseError:
+                supported = False
+                continue
+            total_memory += usage
+            if is_server:
+                hash_memory += usage
+    if not supported:
+        return hash_payload, None, None
+    return hash_payload, hash_memory, total_memory
+
+def main():
+    redis_client = common.connect()
+    registry.load_scripts(redis_client)
+    for count in server_counts:
+        for record_format in ["previous", "compact"]:
+            redis_client.flushdb()
+            register_servers(redis_client, count, record_format)
+            hash_payload, hash_memory, total_memory = measure(redis_client)
+            result = { "format": record_format, "servers": count,
+                       "hash_payload_bytes_per_server": hash_payload / float(count),
+                       "hash_memory_bytes_per_server": None if hash_memory == None else hash_memory / float(count),
+                       "total_memory_bytes_per_server": None if total_memory == None else total_memory / float(count) }
+            print(json.dumps(result))
+    redis_client.flushdb()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import json
+
+import common
+import registry
+import requestgamesession
+
+# Measures requestgamesession latency with a growing number of registered game servers
+# The latency should stay flat as the candidates are read from the indexes instead of SCANning the keyspace
+
+server_counts = [1000, 10000, 100000]
+requests_per_round = 200
+max_players = 2
+
+def register_servers(redis_client, count):
+    with redis_client.pipeline(transaction=False) as pipe:
+        for i in range(count):
+            server_id = "arn:aws:ecs:task/bench-" + str(i // 10) + "-container" + str(i % 10)
+            key = registry.server_key(registry.AVAILABLE, server_id)
+            pipe.hset(key, mapping={ registry.VERSION: registry.RECORD_VERSION, registry.CURRENT_PLAYERS: 0,
+                                     registry.MAX_PLAYERS: max_players, registry.READY: 1, registry.ADDRESS: "10.0.0.1:1935" })
+            pipe.expire(key, 600)
+            registry.update_index(pipe, server_id, registry.AVAILABLE, 600)
+            if i % 1000 == 999:
+                pipe.execute()
+        pipe.execute()
+
+def main():
+    redis_client = common.connect()
+    results = []
+    with common.use_client(redis_client):
+        for count in server_counts:
+            redis_client.flushdb()
+            register_servers(redis_client, count)
+            durations = []
+            with common.quiet():
+                for i in range(requests_per_round):
+                    duration, response = common.timed(requestgamesession.lambda_handler, {}, None)
+                    durations.append(duration)
+            result = { "servers": count, "requests": requests_per_round }
+            result.update(common.percentiles(durations))
+            results.append(result)
+            print(json.dumps(result))
+    redis_client.flushdb()
+
+if __name__ == "__main__":
+    main()
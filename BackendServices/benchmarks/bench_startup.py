@@ -0,0 +1,81 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures the cold start cost of each handler: the time to import the handler module in a fresh interpreter
+# and the time of the first invocation (the first commands and scripts sent to Redis)
+# Each measurement runs in a new Python process so nothing is cached from the previous runs
+#
+# Run from the BackendServices folder, for example:
+#   REDIS_ENDPOINT=fake python benchmarks/bench_startup.py --runs 10
+
+handlers = ["requestgamesession", "updateredis", "checktaskstatus", "scaler"]
+default_runs = 5
+
+# Runs in the child process: import the handler, then invoke it once against the benchmark Redis
+def measure(handler):
+    start = time.perf_counter()
+    module = __import__(handler)
+    import_ms = (time.perf_counter() - start) * 1000.0
+    aws_sdk_imported = "boto3" in sys.modules
+
+    import common
+    redis_client = common.connect()
+    redis_client.flushdb()
+    server_id = "arn:aws:ecs:task/bench-startup-container0"
+    event = { "serverInUse": False, "taskArn": server_id, "currentPlayers": 0, "maxPlayers": 2, "ready": True,
+              "publicIP": "10.0.0.1", "port": 1935, "serverTerminated": False }
+
+    with common.use_client(redis_client), common.quiet():
+        if handler != "updateredis":
+            import updateredis
+            updateredis.update_game_servers(redis_client, [event])
+        start = time.perf_counter()
+        if handler == "requestgamesession":
+            module.lambda_handler({}, None)
+        elif handler == "updateredis":
+            module.lambda_handler(event, None)
+        elif handler == "checktaskstatus":
+            module.lambda_handler({ "taskArn": "arn:aws:ecs:task/bench-startup" }, None)
+        else:
+            # The scaler handler needs the AWS APIs, so run a single scaling round against the fake ECS instead
+            from simulator.fakeecs import FakeECS
+            module.scaling_round(redis_client, FakeECS(module.containers_in_task), "cluster", "task-definition", ["subnet"], "sg")
+        first_invocation_ms = (time.perf_counter() - start) * 1000.0
+    redis_client.flushdb()
+
+    print(json.dumps({ "import_ms": import_ms, "first_invocation_ms": first_invocation_ms,
+                       "aws_sdk_imported": aws_sdk_imported }))
+
+def run_child(handler):
+    backend_services = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", handler], cwd=backend_services)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def main():
+    runs = default_runs
+    if "--runs" in sys.argv:
+        runs = int(sys.argv[sys.argv.index("--runs") + 1])
+    results = []
+    for handler in handlers:
+        samples = [run_child(handler) for i in range(runs)]
+        results.append({
+            "handler": handler,
+            "runs": runs,
+            "import_ms_median": statistics.median(sample["import_ms"] for sample in samples),
+            "first_invocation_ms_median": statistics.median(sample["first_invocation_ms"] for sample in samples),
+            "aws_sdk_imported": samples[0]["aws_sdk_imported"]
+        })
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "functions"))
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        measure(sys.argv[sys.argv.index("--child") + 1])
+    else:
+        main()
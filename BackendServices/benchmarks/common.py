@@ -0,0 +1,93 @@
+import contextlib
+import os
+import sys
+import threading
+import time
+from unittest import mock
+
+import redis
+import redis.connection
+
+# Shared helpers for the benchmarks. Run them from the BackendServices folder, for example:
+#   python benchmarks/bench_registry.py
+# By default the benchmarks use a local Redis at REDIS_ENDPOINT (localhost if not set).
+# Set REDIS_ENDPOINT=fake to use an in-process fakeredis instead (numbers are only comparable within the same backend)
+# and REDIS_CLUSTER=true (with REDIS_PORT and REDIS_SHARDS) to run against a Redis Cluster
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "functions"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def connect():
+    endpoint = os.environ.get("REDIS_ENDPOINT", "localhost")
+    if endpoint == "fake":
+        import fakeredis
+        return fakeredis.FakeRedis()
+    if os.environ.get("REDIS_CLUSTER", "false").lower() == "true":
+        return redis.cluster.RedisCluster(host=endpoint, port=int(os.environ.get("REDIS_PORT", 6379)))
+    return redis.Redis(host=endpoint, port=int(os.environ.get("REDIS_PORT", 6379)), db=0)
+
+# Make every handler use the given client instead of creating its own
+def use_client(redis_client):
+    import backend
+    os.environ.setdefault("REDIS_ENDPOINT", "localhost")
+    return mock.patch.object(backend, "_redis_client", redis_client)
+
+# Counts the round trips and commands sent to Redis by all clients while active
+# The counts are also kept per thread (thread_counts) to attribute them to the operation a thread is running
+class CommandCounter:
+
+    def __init__(self):
+        self.round_trips = 0
+        self.commands = 0
+        self.patches = []
+        self.local = threading.local()
+
+    def thread_counts(self):
+        return getattr(self.local, "round_trips", 0), getattr(self.local, "commands", 0)
+
+    def count(self, commands):
+        self.round_trips += 1
+        self.commands += commands
+        self.local.round_trips = getattr(self.local, "round_trips", 0) + 1
+        self.local.commands = getattr(self.local, "commands", 0) + commands
+
+    def __enter__(self):
+        counter = self
+        send_command = redis.connection.AbstractConnection.send_command
+        pack_commands = redis.connection.AbstractConnection.pack_commands
+
+        def counting_send_command(connection, *args, **kwargs):
+            counter.count(1)
+            return send_command(connection, *args, **kwargs)
+
+        def counting_pack_commands(connection, commands):
+            commands = list(commands)
+            counter.count(len(commands))
+            return pack_commands(connection, commands)
+
+        self.patches = [mock.patch.object(redis.connection.AbstractConnection, "send_command", counting_send_command),
+                        mock.patch.object(redis.connection.AbstractConnection, "pack_commands", counting_pack_commands)]
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *exc):
+        for patch in self.patches:
+            patch.stop()
+        return False
+
+# Hide the log output of the handlers while measuring
+def quiet():
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+# Returns the p50, p99 and p999 of the measured durations in milliseconds
+def percentiles(durations):
+    ordered = sorted(durations)
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000.0
+    return { "p50": pick(0.50), "p99": pick(0.99), "p999": pick(0.999) }
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
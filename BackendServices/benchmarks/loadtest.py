@@ -0,0 +1,163 @@
+import argparse
+import json
+import subprocess
+import sys
+import threading
+import time
+
+import common
+import checktaskstatus
+import requestgamesession
+import updateredis
+
+# Load test for the backend functions against a local Redis
+#
+# Simulated game servers heartbeat through updateredis, clients request game sessions through requestgamesession and
+# finished servers poll checktaskstatus, all concurrently. For each operation the test reports the throughput,
+# p50/p99/p999 latency and Redis round trips and commands per operation.
+#
+# Save the results of a commit and compare another commit against them to catch regressions:
+#   python benchmarks/loadtest.py --output before.json
+#   python benchmarks/loadtest.py --compare before.json
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.samples = { "updateredis": [], "requestgamesession": [], "checktaskstatus": [] }
+        self.counter = common.CommandCounter()
+        # Game session requests shed by the admission control (HTTP 429)
+        self.shed = 0
+
+    def server_id(self, server):
+        return "arn:aws:ecs:local:000000000000:task/loadtest/" + str(server // 10) + "-container" + str(server % 10)
+
+    def heartbeat_event(self, server, current_players=0):
+        return {
+            "serverInUse": current_players >= 2,
+            "taskArn": self.server_id(server),
+            "currentPlayers": current_players,
+            "maxPlayers": 2,
+            "ready": True,
+            "publicIP": "10.0." + str(server // 250 % 250) + "." + str(server % 250),
+            "port": 1935,
+            "serverTerminated": False
+        }
+
+    def measure(self, operation, function, *args):
+        round_trips, commands = self.counter.thread_counts()
+        duration, result = common.timed(function, *args)
+        after_round_trips, after_commands = self.counter.thread_counts()
+        with self.lock:
+            self.samples[operation].append((duration, after_round_trips - round_trips, after_commands - commands))
+        return result
+
+    # Each heartbeat worker updates its share of the game servers in a loop
+    def heartbeat_worker(self, worker):
+        servers = range(worker, self.args.servers, self.args.heartbeat_workers)
+        while not self.stop.is_set():
+            for server in servers:
+                if self.stop.is_set():
+                    return
+                self.measure("updateredis", updateredis.lambda_handler, self.heartbeat_event(server, server % 2), None)
+
+    def client_worker(self):
+        while not self.stop.is_set():
+            response = self.measure("requestgamesession", requestgamesession.lambda_handler, {}, None)
+            if response["statusCode"] == 429:
+                with self.lock:
+                    self.shed += 1
+
+    def task_status_worker(self):
+        task = 0
+        while not self.stop.is_set():
+            task_arn = self.server_id(task * 10).split("-container")[0]
+            self.measure("checktaskstatus", checktaskstatus.lambda_handler, { "taskArn": task_arn }, None)
+            task = (task + 1) % max(self.args.servers // 10, 1)
+
+    def run(self, redis_client):
+        redis_client.flushdb()
+        # Register all the game servers before starting the load
+        for server in range(self.args.servers):
+            updateredis.lambda_handler(self.heartbeat_event(server), None)
+
+        threads = [threading.Thread(target=self.heartbeat_worker, args=(i,)) for i in range(self.args.heartbeat_workers)]
+        threads += [threading.Thread(target=self.client_worker) for i in range(self.args.clients)]
+        threads += [threading.Thread(target=self.task_status_worker) for i in range(self.args.task_status_workers)]
+        with self.counter:
+            for thread in threads:
+                thread.start()
+            time.sleep(self.args.duration)
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        redis_client.flushdb()
+        return self.results()
+
+    def results(self):
+        results = { "commit": git_commit(), "servers": self.args.servers, "clients": self.args.clients,
+                    "duration": self.args.duration, "operations": {} }
+        for operation, samples in self.samples.items():
+            if len(samples) == 0:
+                continue
+            result = { "count": len(samples), "throughput": len(samples) / self.args.duration,
+                       "round_trips_per_operation": sum(s[1] for s in samples) / float(len(samples)),
+                       "commands_per_operation": sum(s[2] for s in samples) / float(len(samples)) }
+            result.update(common.percentiles([s[0] for s in samples]))
+            results["operations"][operation] = result
+        if "requestgamesession" in results["operations"]:
+            results["operations"]["requestgamesession"]["shed"] = self.shed
+        return results
+
+# Compare the latency and Redis commands against earlier results. Returns the regressions found
+def compare(results, baseline, tolerance):
+    regressions = []
+    for operation, result in results["operations"].items():
+        if operation not in baseline["operations"]:
+            continue
+        before = baseline["operations"][operation]
+        for metric in ["p50", "p99", "commands_per_operation"]:
+            change = (result[metric] - before[metric]) / max(before[metric], 1e-9)
+            print("%-20s %-24s %10.3f -> %10.3f (%+.1f%%)" % (operation, metric, before[metric], result[metric], change * 100.0))
+            if change > tolerance:
+                regressions.append(operation + " " + metric)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the backend functions against a local Redis")
+    parser.add_argument("--servers", type=int, default=2000, help="Simulated game servers")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent clients requesting game sessions")
+    parser.add_argument("--heartbeat-workers", type=int, default=8, help="Concurrent game server update callers")
+    parser.add_argument("--task-status-workers", type=int, default=2, help="Concurrent Task status callers")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run the load")
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare against results written earlier with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression when comparing")
+    args = parser.parse_args()
+
+    redis_client = common.connect()
+    with common.use_client(redis_client), common.quiet():
+        results = LoadTest(args).run(redis_client)
+    print(json.dumps(results, indent=2))
+
+    if args.output != None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare != None:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if len(regressions) > 0:
+            print("Regressions: " + ", ".join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
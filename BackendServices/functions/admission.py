@@ -0,0 +1,96 @@
+import math
+import time
+import random
+import zlib
+import metrics
+import registry
+
+# Admission control of the matchmaking requests
+#
+# The matchmaking requests are limited with token buckets in Redis: a shared bucket for all the requestgamesession
+# invocations and a bucket for each player (the Cognito identity of the request). A request is admitted when both
+# its player and the shared bucket have a token. Otherwise it's shed right away with HTTP 429 and the seconds after
+# which the client should try again, instead of spending Redis round trips on claims that would fail or delay others.
+# The game server updates are not admitted through the buckets: their load is set by the size of the fleet (an update
+# every 15 seconds per game server) and the Redis nodes are sized for it, so shared_rate is the capacity left for
+# the matchmaking requests on top of the updates and a storm of client retries can't delay the heartbeats.
+# The buckets are refilled continuously and expire once they would be full again, so idle players take no memory.
+# The shared bucket is split into one bucket per registry shard, each with its share of the rate, so the admission
+# scripts are spread over the nodes of Redis Cluster. A player always uses the shared bucket of its own shard and
+# both buckets have the same hash tag ("{admission<shard>}") so a single script checks them
+
+# Matchmaking requests admitted per second (over all the Lambda containers and shards)
+shared_rate = 5000.0
+
+# Requests admitted right away on top of the rate after a quiet period
+shared_burst = 10000.0
+
+# Matchmaking requests admitted per second for a single player (retries and ticket checks included)
+player_rate = 1.0
+
+# Requests of a single player admitted right away on top of the rate
+player_burst = 5.0
+
+# Get the admission shard of a player (a random one for requests without an identity)
+# With a single shard there's nothing to choose from
+def shard_of(player_id):
+    if registry.shards == 1:
+        return 0
+    if player_id == None:
+        return random.randrange(registry.shards)
+    return zlib.crc32(registry.to_str(player_id).encode('UTF-8')) % registry.shards
+
+# Get the Redis key of the shared bucket of a shard
+def shared_bucket_key(shard):
+    return "{admission" + str(shard) + "}bucket-shared"
+
+# Get the Redis key of the bucket of a player
+def player_bucket_key(player_id):
+    return "{admission" + str(shard_of(player_id)) + "}bucket-player-" + registry.to_str(player_id)
+
+# Atomically takes tokens from the buckets if all of them have enough (checked in the order of KEYS)
+# KEYS[1..]: the buckets, ARGV[1]: current time, ARGV[2]: tokens to take, ARGV[3..]: the rate and burst of each bucket in KEYS
+# Returns {0, 0} if the tokens were taken or {index of the bucket that was short of tokens, milliseconds until it has them}
+ADMISSION_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local buckets = {}
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local burst = tonumber(ARGV[2 + 2 * i])
+    local bucket = redis.call('HMGET', KEYS[i], 't', 'u')
+    local tokens = burst
+    if bucket[1] then
+        tokens = math.min(burst, tonumber(bucket[1]) + math.max(now - tonumber(bucket[2]), 0) * rate)
+    end
+    if tokens < cost then
+        return {i, math.ceil((cost - tokens) / rate * 1000)}
+    end
+    buckets[i] = {tokens - cost, rate, burst}
+end
+for i = 1, #KEYS do
+    redis.call('HSET', KEYS[i], 't', buckets[i][1], 'u', ARGV[1])
+    redis.call('PEXPIRE', KEYS[i], math.ceil((buckets[i][3] - buckets[i][1]) / buckets[i][2] * 1000) + 1000)
+end
+return {0, 0}
+"""
+
+# Admit a matchmaking request of the player (None for requests without an identity)
+# Returns None if the request is admitted or the seconds after which the client should try again
+def admit_request(redis_client, player_id=None, now=None):
+    if now == None:
+        now = time.time()
+    shared_key = shared_bucket_key(shard_of(player_id))
+    keys = [shared_key]
+    args = [repr(now), 1, shared_rate / registry.shards, shared_burst / registry.shards]
+    if player_id != None:
+        keys.insert(0, player_bucket_key(player_id))
+        args[2:2] = [player_rate, player_burst]
+    with metrics.timer("RedisAdmissionTime"):
+        bucket, wait = registry.run_script(redis_client, ADMISSION_SCRIPT, keys, args)
+    if int(bucket) == 0:
+        return None
+    metrics.add("ShedRequests")
+    if keys[int(bucket) - 1] != shared_key:
+        metrics.add("ShedPlayerRequests")
+    return max(int(math.ceil(int(wait) / 1000.0)), 1)
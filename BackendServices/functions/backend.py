@@ -0,0 +1,92 @@
+import os
+import time
+import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+import metrics
+
+# Shared clients for the Lambda functions
+#
+# The clients are created lazily on first use and kept at module scope, so warm invocations of the function reuse
+# the Redis connection pool, the AWS SDK clients and the resolved Task Definition instead of setting them up on every call
+#
+# The AWS SDK is only imported when an AWS client is first needed. Importing boto3 takes a large part of a cold start
+# and the functions on the player and game server request paths only talk to Redis
+
+# Seconds we use the resolved Task Definition before checking the CloudFormation Stack again (it changes on deployments)
+task_definition_refresh_seconds = 300
+
+_redis_client = None
+_aws_clients = {}
+_task_definition = None
+_task_definition_time = 0.0
+
+# Retry policy of the Redis client that counts the retries in the RedisRetries metric of the invocation
+class CountingRetry(Retry):
+
+    def call_with_retry(self, do, fail, *args, **kwargs):
+        def counting_fail(error, *failures):
+            metrics.add("RedisRetries")
+            return fail(error, *failures)
+        return super().call_with_retry(do, counting_fail, *args, **kwargs)
+
+# Get the Redis client. Commands are retried with backoff on connection errors and timeouts,
+# reconnecting through the connection pool. With REDIS_CLUSTER=true the endpoint is the configuration endpoint
+# of a Redis Cluster and the client routes each command to the node that has the hash slot of its keys
+def get_redis_client():
+    global _redis_client
+    if _redis_client == None:
+        redis_endpoint = os.environ['REDIS_ENDPOINT']
+        if os.environ.get('REDIS_CLUSTER', 'false').lower() == 'true':
+            _redis_client = redis.cluster.RedisCluster(host=redis_endpoint, port=int(os.environ.get('REDIS_PORT', 6379)),
+                                                       socket_connect_timeout=2, socket_timeout=5, health_check_interval=30,
+                                                       retry=CountingRetry(ExponentialBackoff(cap=0.5, base=0.02), 3))
+        else:
+            _redis_client = redis.Redis(host=redis_endpoint, port=int(os.environ.get('REDIS_PORT', 6379)), db=0,
+                                        socket_connect_timeout=2, socket_timeout=5, health_check_interval=30,
+                                        retry=CountingRetry(ExponentialBackoff(cap=0.5, base=0.02), 3),
+                                        retry_on_error=[redis.exceptions.ConnectionError, redis.exceptions.TimeoutError])
+    return _redis_client
+
+# Drop the Redis client and its connections (for example after the connection failed for good).
+# The next get_redis_client() call creates a new one
+def reset_redis_client():
+    global _redis_client
+    if _redis_client != None:
+        try:
+            if isinstance(_redis_client, redis.cluster.RedisCluster):
+                _redis_client.close()
+            else:
+                _redis_client.connection_pool.disconnect()
+        except redis.exceptions.RedisError:
+            pass
+    _redis_client = None
+
+# Get an AWS SDK client for the service (in the given Region, the Region of the function if not set)
+def get_aws_client(service, region=None):
+    key = service if region == None else service + ":" + region
+    if key not in _aws_clients:
+        import boto3
+        if region == None:
+            _aws_clients[key] = boto3.client(service)
+        else:
+            _aws_clients[key] = boto3.client(service, region_name=region)
+    return _aws_clients[key]
+
+# Drop the AWS SDK clients (for example after an error that might have been caused by a broken connection)
+def reset_aws_clients():
+    _aws_clients.clear()
+
+# Get the Task Definition to deploy from the Task Definition CloudFormation Stack outputs
+def get_task_definition():
+    global _task_definition, _task_definition_time
+    if _task_definition == None or time.time() - _task_definition_time > task_definition_refresh_seconds:
+        cloudformation = get_aws_client("cloudformation")
+        with metrics.timer("CloudFormationTime"):
+            stack = cloudformation.describe_stacks(StackName="fargate-game-servers-task-definition")["Stacks"][0]
+        for output in stack["Outputs"]:
+            metrics.logger.info('%s=%s (%s)', output["OutputKey"], output["OutputValue"], output["Description"])
+            if output["OutputKey"] == "TaskDefinition":
+                _task_definition = output["OutputValue"]
+                _task_definition_time = time.time()
+    return _task_definition
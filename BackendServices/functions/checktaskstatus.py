@@ -1,34 +1,38 @@
-import json
-import datetime
-import time
-import os
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
-import redis
-from datetime import timedelta
+import backend
+import metrics
+import registry
 
 # Checks if all game servers in a Task are done hosting maximum amount of game sessions
 
 def lambda_handler(event, context):
 
-    # Get redis endpoint and set up
-    redis_endpoint = os.environ['REDIS_ENDPOINT']
-    # Setup Redis client
-    redis_client = redis.Redis(host=redis_endpoint, port=6379, db=0)
+    # The metrics of the check are written as a single record when it's done
+    metrics.begin("CheckTaskStatus")
+    try:
+        return check_task(event)
+    finally:
+        metrics.flush()
+
+def check_task(event):
+
+    # Get the Redis client (reused between invocations)
+    redis_client = backend.get_redis_client()
 
     # Get the parameters from the server
     taskArn = event["taskArn"]
-    print("taskArn: " + str(taskArn))
+    metrics.logger.debug("taskArn: %s", taskArn)
 
-    # Get all game servers within this task in any state (active, full, available)
-    # Servers that are already done should be already removed from Redis completely
-    active_game_servers_in_task_response = redis_client.scan(count=100,match="*-gameserver-"+taskArn+"*")
-    active_game_servers_in_task_count = len(active_game_servers_in_task_response[1])
-    print("game servers still active: " + str(active_game_servers_in_task_count))
+    # Get the amount of game servers within this task in any state (active, full, available) from the Task membership
+    # Servers that are already done have removed themselves and servers that stopped reporting have expired
+    with metrics.timer("RedisLookupTime"):
+        active_game_servers_in_task_count = registry.count_task_servers(redis_client, taskArn)
+    metrics.logger.debug("game servers still active: %d", active_game_servers_in_task_count)
+    metrics.put("ActiveGameServersInTask", active_game_servers_in_task_count)
 
     if active_game_servers_in_task_count <= 0:
-        print("No game servers in the Task, return true")
+        metrics.logger.debug("No game servers in the Task, return true")
+        metrics.add("TasksDone")
         return True
 
-    print("Game servers still active in Task, return false")
-    return False
\ No newline at end of file
+    metrics.logger.debug("Game servers still active in Task, return false")
+    return False
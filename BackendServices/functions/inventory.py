@@ -0,0 +1,219 @@
+import time
+import redis
+import metrics
+import registry
+
+# Inventory of the Tasks of each location, kept in Redis for the scaler
+#
+# The Tasks are updated incrementally from the ECS Task state change events (taskstatechange.py) and by the scaler
+# itself when it starts and stops Tasks. Each Task is stored in a Hash ("tasks") with its state (pending, running or
+# stopped), Task Definition, amount of containers and the version of the ECS Task it was last updated from. Events
+# that arrive late (with an older version than the one recorded) are ignored. The counts of the live Tasks and
+# their containers are kept up to date in another Hash ("counts") in the same atomic script, so the scaler reads them
+# in O(1) instead of paging through list_tasks on every round. The amount of containers of each Task Definition is
+# recorded as well ("task-definitions"), so the scaler knows how many game servers a Task of its Task Definition runs.
+# Stopped Tasks are kept for stopped_retention seconds so a late event doesn't add them back.
+#
+# Events can be lost, so the scaler reconciles the inventory with list_tasks every reconcile_interval seconds: Tasks
+# that ECS doesn't list anymore are marked stopped, listed Tasks that are missing are added (with describe_tasks)
+# and the counts are recalculated. The locations whose events are not delivered to the backend (other Regions, see
+# locations.receives_task_events) only learn about the Tasks that stop on their own this way, so they are reconciled
+# every remote_reconcile_interval seconds instead.
+# All the keys of a location have the same hash tag so the scripts work on Redis Cluster
+
+# Seconds between the reconciliations of the inventory with list_tasks
+reconcile_interval = 300
+
+# Seconds between the reconciliations of the locations whose Task state change events are not delivered
+remote_reconcile_interval = 30
+
+# Seconds the stopped Tasks are kept in the inventory
+stopped_retention = 3600
+
+# Max Tasks in a single describe_tasks call (ECS limit)
+max_describe_tasks = 100
+
+# Get the hash tag of the inventory keys of the location
+def inventory_tag(location=None):
+    return "{inventory" + registry.location_suffix(location) + "}"
+
+# Get the Redis key of the Hash of the Tasks of the location (taskArn -> state|taskDefinitionArn|containers|version|updated)
+def tasks_key(location=None):
+    return inventory_tag(location) + "tasks"
+
+# Get the Redis key of the Hash of the counts of the live Tasks of the location (tasks, containers, pending, running)
+def counts_key(location=None):
+    return inventory_tag(location) + "counts"
+
+# Get the Redis key of the Hash of the amount of containers in each Task Definition
+def task_definitions_key(location=None):
+    return inventory_tag(location) + "task-definitions"
+
+# Get the Redis key that is set while the inventory of the location has been reconciled recently
+def reconciled_key(location=None):
+    return inventory_tag(location) + "reconciled"
+
+# Get the state of an ECS Task (from the ECS API or the detail of a Task state change event) in the inventory.
+# Tasks that are stopping are not counted anymore (like list_tasks that lists the Tasks with desired status RUNNING)
+def task_state(task):
+    if task.get("desiredStatus", "RUNNING") == "STOPPED" or task.get("lastStatus") == "STOPPED":
+        return "stopped"
+    if task.get("lastStatus") == "RUNNING":
+        return "running"
+    return "pending"
+
+# Atomically records the state of a Task and updates the counts of the live Tasks
+# KEYS[1]: the Tasks, KEYS[2]: the counts, KEYS[3]: the Task Definitions, ARGV[1]: the Task ARN, ARGV[2]: the state,
+# ARGV[3]: the Task Definition ARN, ARGV[4]: amount of containers, ARGV[5]: the version of the Task, ARGV[6]: current time
+# Returns 1 if the Task was updated or 0 if the inventory already had a newer version of it
+RECORD_SCRIPT = """
+local entry = redis.call('HGET', KEYS[1], ARGV[1])
+if entry then
+    local state, containers, version = string.match(entry, '^([^|]*)|[^|]*|(%d+)|(%d+)|')
+    if tonumber(ARGV[5]) < tonumber(version) then
+        return 0
+    end
+    if state ~= 'stopped' then
+        redis.call('HINCRBY', KEYS[2], 'tasks', -1)
+        redis.call('HINCRBY', KEYS[2], 'containers', -tonumber(containers))
+        redis.call('HINCRBY', KEYS[2], state, -1)
+    end
+end
+if ARGV[2] ~= 'stopped' then
+    redis.call('HINCRBY', KEYS[2], 'tasks', 1)
+    redis.call('HINCRBY', KEYS[2], 'containers', tonumber(ARGV[4]))
+    redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+end
+redis.call('HSET', KEYS[1], ARGV[1], table.concat({ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6]}, '|'))
+if ARGV[3] ~= '' and tonumber(ARGV[4]) > 0 then
+    redis.call('HSET', KEYS[3], ARGV[3], ARGV[4])
+end
+return 1
+"""
+
+# Atomically reconciles the Tasks with the live Tasks listed by ECS and recalculates the counts
+# KEYS[1]: the Tasks, KEYS[2]: the counts, ARGV[1]: the time the Tasks were listed, ARGV[2]: the stopped Tasks updated
+# before this time are removed, ARGV[3..]: the ARNs of the live Tasks
+# Returns the amount of Tasks that were marked stopped
+RECONCILE_SCRIPT = """
+local live = {}
+for i = 3, #ARGV do
+    live[ARGV[i]] = true
+end
+local counts = {tasks = 0, containers = 0, pending = 0, running = 0}
+local stopped = 0
+local entries = redis.call('HGETALL', KEYS[1])
+for i = 1, #entries, 2 do
+    local state, definition, containers, version, updated = string.match(entries[i + 1], '^([^|]*)|([^|]*)|(%d+)|(%d+)|(.*)$')
+    -- Tasks updated after the listing might have started after it
+    if state ~= 'stopped' and not live[entries[i]] and tonumber(updated) < tonumber(ARGV[1]) then
+        state = 'stopped'
+        updated = ARGV[1]
+        redis.call('HSET', KEYS[1], entries[i], table.concat({state, definition, containers, version, updated}, '|'))
+        stopped = stopped + 1
+    end
+    if state == 'stopped' then
+        if tonumber(updated) < tonumber(ARGV[2]) then
+            redis.call('HDEL', KEYS[1], entries[i])
+        end
+    else
+        counts.tasks = counts.tasks + 1
+        counts.containers = counts.containers + tonumber(containers)
+        counts[state] = counts[state] + 1
+    end
+end
+redis.call('HSET', KEYS[2], 'tasks', counts.tasks, 'containers', counts.containers, 'pending', counts.pending,
+    'running', counts.running)
+return stopped
+"""
+
+# Record the state of an ECS Task (from the ECS API or the detail of a Task state change event) in the inventory
+# of the location. Use a pipeline as redis_client to send many (needs load_scripts() like the registry scripts)
+# Returns True if the Task was updated or False if the inventory had a newer version of the Task (unless a pipeline is used)
+def record_task(redis_client, task, now=None, location=None):
+    if now == None:
+        now = time.time()
+    keys = [tasks_key(location), counts_key(location), task_definitions_key(location)]
+    args = [task["taskArn"], task_state(task), task.get("taskDefinitionArn") or "", len(task.get("containers") or []),
+            int(task.get("version") or 0), repr(now)]
+    result = registry.run_script(redis_client, RECORD_SCRIPT, keys, args)
+    if isinstance(redis_client, (redis.client.Pipeline, redis.cluster.ClusterPipeline)):
+        return result
+    return result == 1
+
+# Record the states of many Tasks of the location in a single pipeline
+def record_tasks(redis_client, tasks, now=None, location=None):
+    if len(tasks) == 0:
+        return
+    for attempt in range(2):
+        with redis_client.pipeline(transaction=False) as pipe:
+            for task in tasks:
+                record_task(pipe, task, now, location)
+            responses = pipe.execute(raise_on_error=False)
+        # Load the script if Redis didn't have it yet and record again
+        if not any(isinstance(response, redis.exceptions.NoScriptError) for response in responses):
+            break
+        load_scripts(redis_client)
+    for response in responses:
+        if isinstance(response, Exception):
+            metrics.logger.error("Failed to record a Task in the inventory: %s", response)
+
+# Get the counts of the live Tasks of the location (tasks, containers, pending and running) and the amount of
+# containers in a Task of the Task Definition (None if no Task of it has been recorded yet) in a single round trip
+def get_counts(redis_client, task_definition=None, location=None):
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hmget(counts_key(location), "tasks", "containers", "pending", "running")
+        pipe.hget(task_definitions_key(location), task_definition or "")
+        counts, task_containers = pipe.execute()
+    result = dict((name, int(value or 0)) for name, value in zip(["tasks", "containers", "pending", "running"], counts))
+    result["containers_in_task"] = None if task_containers == None else int(task_containers)
+    return result
+
+# Reconcile the inventory of the location (running in the given cluster) with ECS if it hasn't been done in
+# interval seconds (reconcile_interval by default). Returns True if the inventory was reconciled
+def reconcile_if_due(redis_client, ecs, fargate_cluster_name, now=None, location=None, interval=None):
+    if now == None:
+        now = time.time()
+    if interval == None:
+        interval = reconcile_interval
+    if not redis_client.set(reconciled_key(location), repr(now), ex=interval, nx=True):
+        return False
+    reconcile(redis_client, ecs, fargate_cluster_name, now, location)
+    return True
+
+# Reconcile the inventory of the location with the live Tasks in the cluster
+# Returns the amount of Tasks that were missing from the inventory and the amount of Tasks that were marked stopped
+def reconcile(redis_client, ecs, fargate_cluster_name, now=None, location=None):
+    if now == None:
+        now = time.time()
+
+    # Get all the live Tasks in the cluster (using pagination to get over 100 Tasks)
+    task_arns = []
+    with metrics.timer("EcsListTasksTime"):
+        response = ecs.list_tasks(cluster=fargate_cluster_name, launchType='FARGATE')
+        task_arns += response["taskArns"]
+        while "nextToken" in response:
+            response = ecs.list_tasks(cluster=fargate_cluster_name, launchType='FARGATE', nextToken=response["nextToken"])
+            task_arns += response["taskArns"]
+
+    # Add the Tasks we didn't get an event of
+    known = set(registry.to_str(task_arn) for task_arn in redis_client.hkeys(tasks_key(location)))
+    missing = [task_arn for task_arn in task_arns if task_arn not in known]
+    for start in range(0, len(missing), max_describe_tasks):
+        with metrics.timer("EcsDescribeTasksTime"):
+            tasks = ecs.describe_tasks(cluster=fargate_cluster_name, tasks=missing[start:start + max_describe_tasks])["tasks"]
+        record_tasks(redis_client, tasks, now, location)
+
+    # Mark the Tasks that are not listed anymore stopped and recalculate the counts
+    args = [repr(now), repr(now - stopped_retention)] + task_arns
+    stopped = int(registry.run_script(redis_client, RECONCILE_SCRIPT, [tasks_key(location), counts_key(location)], args))
+
+    metrics.put("InventoryMissingTasks", len(missing))
+    metrics.put("InventoryStoppedTasks", stopped)
+    if len(missing) > 0 or stopped > 0:
+        metrics.logger.info("Reconciled the Task inventory: %d Tasks were missing and %d had stopped", len(missing), stopped)
+    return len(missing), stopped
+
+def load_scripts(redis_client):
+    redis_client.script_load(RECORD_SCRIPT)
+    redis_client.script_load(RECONCILE_SCRIPT)
@@ -0,0 +1,145 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import inventory
+import metrics
+import registry
+
+# Launches game server Tasks for the scaler
+#
+# The Tasks are requested with concurrent run_task calls (each starting up to 10 Tasks). When ECS throttles the calls
+# or doesn't have capacity, all the calls back off together with an exponentially growing delay that shrinks again
+# after successful calls. The placeholder game server entries of each started batch are written in a single pipeline.
+
+# Max Tasks in a single run_task call (ECS limit)
+tasks_per_call = 10
+
+# How many run_task calls we have in flight at the same time
+max_concurrent_calls = 5
+
+# How many times a single run_task call is retried on throttling and capacity errors
+max_retries = 5
+
+# The backoff delay (seconds) after the first throttled call and the maximum delay
+backoff_base = 0.25
+backoff_max = 8.0
+
+# The error codes of the AWS API on which we back off and retry
+retryable_errors = ["ThrottlingException", "Throttling", "TooManyRequestsException", "RequestLimitExceeded",
+                    "ServerException", "ServiceUnavailableException"]
+
+# run_task failure reasons on which we back off and retry the Tasks that didn't start (Fargate capacity)
+retryable_failure_reasons = ["Capacity is unavailable", "RESOURCE:"]
+
+# Shared backoff state of the concurrent calls
+class Backoff:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.delay = 0.0
+        self.resume_time = 0.0
+        self.throttled_calls = 0
+
+    # Wait until the calls are allowed to continue
+    def wait(self):
+        with self.lock:
+            wait_time = self.resume_time - time.time()
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    # Called when a call was throttled, pauses all the calls for the current delay (with jitter) and doubles the delay
+    def throttled(self):
+        with self.lock:
+            self.throttled_calls += 1
+            self.delay = min(backoff_max, max(backoff_base, self.delay * 2.0))
+            self.resume_time = max(self.resume_time, time.time() + self.delay * random.uniform(0.5, 1.0))
+
+    # Called when a call succeeded, halves the delay
+    def succeeded(self):
+        with self.lock:
+            self.delay = self.delay / 2.0
+            if self.delay < backoff_base:
+                self.delay = 0.0
+
+# Get the error code from an AWS SDK exception (botocore ClientError) without importing botocore
+def error_code(exception):
+    response = getattr(exception, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code")
+    return None
+
+def is_retryable_failure(failure):
+    reason = str(failure.get("reason", ""))
+    return any(retryable in reason for retryable in retryable_failure_reasons)
+
+# Start task_count Tasks and add placeholder game servers for their containers to Redis (in the location of the cluster)
+# run_task_parameters are passed to ecs.run_task (cluster, task definition, network configuration etc.)
+# Returns the amount of Tasks that were started
+def launch_tasks(redis_client, ecs, task_count, run_task_parameters, max_players, placeholder_ttl, location=None):
+    if task_count <= 0:
+        return 0
+    batches = [tasks_per_call] * (task_count // tasks_per_call)
+    if task_count % tasks_per_call > 0:
+        batches.append(task_count % tasks_per_call)
+
+    backoff = Backoff()
+    if len(batches) == 1 or max_concurrent_calls <= 1:
+        launched = [launch_batch(redis_client, ecs, batch, run_task_parameters, max_players, placeholder_ttl, backoff, location)
+                    for batch in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_concurrent_calls, len(batches))) as executor:
+            launched = list(executor.map(lambda batch: launch_batch(redis_client, ecs, batch, run_task_parameters,
+                                                                    max_players, placeholder_ttl, backoff, location), batches))
+
+    metrics.add("TasksRequested", task_count)
+    metrics.add("TasksLaunched", sum(launched))
+    metrics.add("ThrottledCalls", backoff.throttled_calls)
+    return sum(launched)
+
+# Start a batch of Tasks with a single run_task call, retrying the Tasks that didn't start on throttling and capacity errors
+def launch_batch(redis_client, ecs, count, run_task_parameters, max_players, placeholder_ttl, backoff, location=None):
+    launched = 0
+    remaining = count
+    for attempt in range(max_retries + 1):
+        backoff.wait()
+        try:
+            with metrics.timer("EcsRunTaskTime"):
+                response = ecs.run_task(count=remaining, **run_task_parameters)
+        except Exception as e:
+            if error_code(e) in retryable_errors:
+                metrics.logger.info("run_task throttled or failed (%s), backing off", error_code(e))
+                backoff.throttled()
+                continue
+            metrics.logger.error("run_task failed: %s", e)
+            return launched
+
+        tasks = response.get("tasks", [])
+        add_placeholders(redis_client, tasks, max_players, placeholder_ttl, location)
+        # Count the Tasks right away, the inventory is updated from their events after this
+        inventory.record_tasks(redis_client, tasks, location=location)
+        launched += len(tasks)
+        remaining -= len(tasks)
+
+        failures = response.get("failures", [])
+        for failure in failures:
+            metrics.logger.warning("Failed to start Task: %s", failure.get("reason"))
+        if remaining <= 0 or not any(is_retryable_failure(failure) for failure in failures):
+            backoff.succeeded()
+            return launched
+        backoff.throttled()
+    metrics.logger.error("Giving up starting %d Tasks after %d retries", remaining, max_retries)
+    return launched
+
+# Prepopulate Redis with all the containers of the Tasks as available game servers to match the capacity
+# (game servers will take over after this). Written with a single pipeline
+def add_placeholders(redis_client, tasks, max_players, placeholder_ttl, location=None):
+    if len(tasks) == 0:
+        return
+    now = time.time()
+    with redis_client.pipeline(transaction=False) as pipe:
+        for task in tasks:
+            for i in range(0, len(task["containers"])):
+                registry.add_placeholder(pipe, task["taskArn"] + "-container" + str(i), task["taskArn"], max_players,
+                                         placeholder_ttl, now, location)
+        pipe.execute()
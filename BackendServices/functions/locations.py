@@ -0,0 +1,90 @@
+import json
+import os
+import registry
+
+# Locations the game servers run in
+#
+# A location is an ECS cluster (for example in another Region, closer to a group of players) with its own capacity.
+# The game servers report their location with their updates (the Region of the Task by default) and each location
+# has its own indexes in the registry. The scaler manages the capacity of each location separately and
+# requestgamesession places the players in the location with the lowest latency that has free slots
+#
+# The locations are configured with the LOCATIONS environment variable as a JSON list, for example
+# [{ "name": "us-east-1", "cluster": "game-servers", "subnets": ["subnet-1", "subnet-2"], "securityGroup": "sg-1" },
+#  { "name": "eu-west-1", "region": "eu-west-1", "cluster": "game-servers", "subnets": ["subnet-3", "subnet-4"],
+#    "securityGroup": "sg-2", "taskDefinition": "arn:aws:ecs:eu-west-1:...", "minGameServers": 10 }]
+# The region (for the ECS calls), taskDefinition and minGameServers are optional, except that locations in other Regions
+# than the backend need their own taskDefinition (a Task Definition is only valid in its own Region) and the
+# configuration is rejected without it. The ECS Task state change events of
+# locations in other Regions than the backend are not delivered to the backend unless they are forwarded to its Region
+# with an EventBridge rule: set "taskEvents": true in the location when they are. Without the variable there's a single
+# location (the default location of the registry) that uses the cluster from FARGATE_CLUSTER_NAME, SUBNET_1, SUBNET_2
+# and SECURITY_GROUP and the Task Definition of the Task Definition CloudFormation Stack
+
+def load_locations():
+    configured = os.environ.get("LOCATIONS", "").strip()
+    if configured != "":
+        configured = json.loads(configured)
+        for location in configured:
+            if not in_home_region(location) and not location.get("taskDefinition"):
+                raise ValueError("Location " + str(location.get("name")) + " is in another Region (" +
+                                 str(location.get("region")) + ") and needs a taskDefinition of that Region")
+        return configured
+    return [{ "name": registry.default_location, "cluster": os.environ.get("FARGATE_CLUSTER_NAME"),
+              "subnets": [os.environ.get("SUBNET_1"), os.environ.get("SUBNET_2")],
+              "securityGroup": os.environ.get("SECURITY_GROUP") }]
+
+# Check if the location is in the Region of the backend (locations without a region are)
+def in_home_region(location):
+    return location.get("region") in (None, os.environ.get("AWS_REGION"))
+
+# The configured locations, the first one is the default order of placements for clients that don't send preferences
+locations = load_locations()
+
+# Get the names of the locations
+def names():
+    return [location["name"] for location in locations]
+
+# Get the locations to place a client in, in the order to try them. The client can send the latencies it measured to
+# the locations ("us-east-1:40,eu-west-1:95", lowest first) and/or a list of preferred locations ("eu-west-1,us-east-1")
+# that is used after the measured ones. Locations that are not configured are ignored and the clients that
+# don't send (valid) preferences can be placed in any location
+def placement_order(latencies=None, preferred=None):
+    measured = []
+    for entry in (latencies or "").split(","):
+        name, separator, latency = entry.partition(":")
+        try:
+            measured.append((float(latency), name.strip()))
+        except ValueError:
+            continue
+    requested = [name for latency, name in sorted(measured)] + [name.strip() for name in (preferred or "").split(",")]
+
+    known = names()
+    order = []
+    for name in requested:
+        if name in known and name not in order:
+            order.append(name)
+    if len(order) == 0:
+        return known
+    return order
+
+# Check if the ECS Task state change events of the location are delivered to the backend (see taskstatechange.py).
+# EventBridge delivers them in the Region of the cluster, so the events of other Regions only arrive when they are
+# forwarded to the Region of the backend ("taskEvents" in the location)
+def receives_task_events(location):
+    if "taskEvents" in location:
+        return location["taskEvents"] == True
+    return in_home_region(location)
+
+# Get the name of the location of an ECS cluster from its ARN (arn:aws:ecs:<region>:<account>:cluster/<name>)
+# or None if the cluster is not one of the locations
+def location_of_cluster(cluster_arn):
+    parts = str(cluster_arn or "").split(":")
+    if len(parts) < 6:
+        return None
+    region, cluster = parts[3], parts[5].split("/")[-1]
+    for location in locations:
+        location_region = location.get("region") or os.environ.get("AWS_REGION")
+        if location.get("cluster") in (cluster, cluster_arn) and (location_region == None or location_region == region):
+            return location["name"]
+    return None
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Metrics and logging of the Lambda functions
+#
+# The metrics of an invocation are collected in memory and written as a single structured log record when the handler
+# is done, in the CloudWatch Embedded Metric Format (EMF). CloudWatch extracts the metrics from the record directly
+# so no metric filters are needed and a handler writes one log line for its metrics instead of one per value.
+# A gauge that is measured many times in an invocation (for example on each round of the scaler) is written as
+# a list of values in the same record. Timers add up the milliseconds spent in a stage (Redis and ECS calls)
+# and counters add up the events (claim conflicts, Redis retries etc.) of the invocation. Metrics recorded with
+# dimensions (the scaler records the metrics of each location with a Location dimension) are written in a record
+# of their own.
+# Recording is a no-op outside of begin() and flush(), so the functions can be called from code that runs in
+# the simulator and the benchmarks as well
+#
+# The log lines of the functions go through the logger below at the level set with the LOG_LEVEL environment variable
+# (INFO by default). The per-request details of the handlers are logged at DEBUG level
+
+logger = logging.getLogger("fargate-game-servers")
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# The metrics of the current invocation: dimensions -> metric name -> [unit, [values]] (None when not recording)
+_metrics = None
+_namespace = None
+# The dimensions of the metrics recorded now (name, value pairs)
+_dimensions = ()
+# The launcher records metrics from many threads
+_lock = threading.Lock()
+# The records are appended here instead of printed while capture() is active
+_captured = None
+
+# Start recording the metrics of an invocation under the CloudWatch namespace
+def begin(namespace):
+    global _metrics, _namespace
+    _metrics = {}
+    _namespace = namespace
+
+# Record the metrics of the block with the given dimensions (for example the location the scaler is working on)
+# The metrics of each set of dimensions are written as a record of their own
+@contextmanager
+def dimensions(**values):
+    global _dimensions
+    previous, _dimensions = _dimensions, tuple(sorted(values.items()))
+    try:
+        yield
+    finally:
+        _dimensions = previous
+
+# Get the metrics of the current dimensions (under _lock)
+def current(metrics):
+    if _dimensions not in metrics:
+        metrics[_dimensions] = {}
+    return metrics[_dimensions]
+
+# Record a new value of a metric (a metric measured many times is written as a list of values)
+def put(name, value, unit="Count"):
+    metrics = _metrics
+    if metrics == None:
+        return
+    with _lock:
+        values = current(metrics)
+        if name not in values:
+            values[name] = [unit, []]
+        values[name][1].append(value)
+
+# Add to the value of a counter (or timer) metric of the invocation
+def add(name, value=1, unit="Count"):
+    metrics = _metrics
+    if metrics == None:
+        return
+    with _lock:
+        values = current(metrics)
+        if name not in values:
+            values[name] = [unit, [0]]
+        values[name][1][-1] += value
+
+# Time the block and add the milliseconds spent to the timer metric
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, (time.perf_counter() - start) * 1000.0, "Milliseconds")
+
+# Write the metrics of the invocation as EMF records (one for each set of dimensions) and stop recording
+# Returns the records
+def flush():
+    global _metrics
+    metrics, _metrics = _metrics, None
+    records = []
+    for dimension_values, values in (metrics or {}).items():
+        if len(values) == 0:
+            continue
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": _namespace,
+                    "Dimensions": [[name for name, value in dimension_values]],
+                    "Metrics": [{ "Name": name, "Unit": unit } for name, (unit, metric_values) in values.items()]
+                }]
+            }
+        }
+        record.update(dimension_values)
+        for name, (unit, metric_values) in values.items():
+            record[name] = metric_values[0] if len(metric_values) == 1 else metric_values
+        if _captured != None:
+            _captured.append(record)
+        else:
+            print(json.dumps(record))
+        records.append(record)
+    return records
+
+# Collect the records written while active into the returned list instead of printing them (for tests)
+@contextmanager
+def capture():
+    global _captured
+    previous, _captured = _captured, []
+    try:
+        yield _captured
+    finally:
+        _captured = previous
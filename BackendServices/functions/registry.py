@@ -0,0 +1,738 @@
+import os
+import math
+import time
+import random
+import hashlib
+import zlib
+import redis
+
+# Registry of game servers stored in Redis
+#
+# Each game server is stored as a Redis Hash named after its state ("available-gameserver-<taskArn-containerX>" etc.)
+# with short field names (see the record fields below). The id of the game server is only stored in the key.
+# Next to the Hashes we keep one Sorted Set index per state. The members of the index are the game server ids
+# (taskArn-containerX) and the score is the time the entry expires. This way we never need to SCAN the keyspace
+# to find game servers: we can pick random candidates in O(1) per candidate and count servers in O(log n).
+# Each Task also has a Sorted Set of its game servers ("task-gameservers-<taskArn>", score is the expiry time)
+# so we can check how many game servers of a Task are still live without searching the keyspace.
+# Tasks that the scaler is scaling in are marked draining ("draining-<taskArn>"): their game servers are kept out
+# of the indexes so no new players are placed on them.
+# The Tasks that have free slots on ready game servers are also kept in an occupancy index scored by the slots in use,
+# so placements can fill the busiest Tasks first (bin-packing) and leave the rest idle for scale-in.
+# The latest placement of each player is kept for as long as the reservation ("player-session-<player id>") so that
+# a client that retries its request (for example after a dropped connection) gets the same game server back.
+# Players that didn't get a placement wait in a FIFO queue of matchmaking tickets ("ticket-<id>" Hashes in the
+# "ticket-queue" Sorted Set, scored by the time the ticket expires) that is served with the free slots of the game servers after their heartbeats and by the scaler.
+# Every reservation of player slots is kept in a reservation index ("index-reservations", member
+# "<server id>|<reservation id>|<slots>" scored by the time the reservation expires) so that the scaler can release
+# the reservations of clients that never connected across the whole fleet in a single sweep.
+# The reservations of a game server are pending until their players connect: the game server Hash keeps the pending
+# slots next to the connected players and a field per pending reservation. The slots in use are the connected players
+# plus the pending slots. When the heartbeat reports more connected players, they take over the oldest pending
+# reservations, and the sweep only releases the reservations that are still pending when they expire.
+#
+# The registry is split into shards so it can run on Redis Cluster. All the keys of a Task (the Hashes of its game
+# servers, its membership, draining and prioritize keys) and the indexes of its shard start with the same hash tag
+# ("{gs<shard>}"), so they are in the same hash slot and every script only touches keys of a single slot. The shard of
+# a Task (and of a ticket Hash) is derived from its id. With more shards the indexes and the scripts are spread over
+# the nodes of the cluster and the registry scales by adding nodes. The ticket queue is not sharded ("{tickets}" hash
+# tag) so the tickets are served in FIFO order by the game servers of any shard.
+#
+# Game servers run in locations (ECS clusters, for example in different Regions, see locations.py). Each location has
+# its own state, occupancy and reservation indexes and draining Tasks in every shard and its own ticket queue, so
+# placements and the scaler work on the game servers of a single location. The keys of a location end with the location name,
+# except for the default location whose keys have no suffix.
+
+# Game server states
+AVAILABLE = "available"
+AVAILABLE_PRIORITY = "available-priority"
+ACTIVE = "active"
+FULL = "full"
+STATES = [AVAILABLE, AVAILABLE_PRIORITY, ACTIVE, FULL]
+
+# Fields of the game server Hashes. The names are single letters to keep the Hashes small: Redis stores small Hashes
+# as a compact list of the field names and values so the names take memory in every Hash and bandwidth on every read.
+# The public IP and port are packed into a single address field ("<publicIP>:<port>"). The version field tells
+# the format of the Hash. The keys of the previous releases (long field names, no shard hash tag) are not read, so Redis
+# needs to be flushed (or the fleet drained) when upgrading from them
+RECORD_VERSION = "1"
+VERSION = "v"
+READY = "r"
+MAX_PLAYERS = "m"
+CURRENT_PLAYERS = "c"
+RESERVED_SLOTS = "s"
+ADDRESS = "a"
+# Prefix of the fields of the pending reservations ("p<reservation id>", the value is "<slots>|<expiry time>")
+PENDING_RESERVATION = "p"
+
+# How many shards the registry is split into. Needs to be the same for all the functions (REDIS_SHARDS environment variable)
+shards = int(os.environ.get("REDIS_SHARDS", "1"))
+
+# The location of the game servers that don't report one (the Region of the functions by default)
+default_location = os.environ.get("DEFAULT_LOCATION") or os.environ.get("AWS_REGION") or "default"
+
+# Get the suffix of the keys of a location (none for the default location)
+def location_suffix(location):
+    if location == None or location == "" or location == default_location:
+        return ""
+    return "-" + to_str(location)
+
+# Get the shard of a Task, game server (taskArn-containerX) or ticket id
+def shard_of(id):
+    return zlib.crc32(task_of(id).encode('UTF-8')) % shards
+
+# Get the hash tag that the keys of the shard start with
+def shard_tag(shard):
+    return "{gs" + str(shard) + "}"
+
+# Get the Redis key of the game server Hash in a specific state
+def server_key(state, server_id):
+    return shard_tag(shard_of(server_id)) + state + "-gameserver-" + to_str(server_id)
+
+# Get the Redis key of the Sorted Set index for a state in the shard of the location
+def index_key(state, shard, location=None):
+    return shard_tag(shard) + "index-" + state + "-gameservers" + location_suffix(location)
+
+# Get the Redis key of the Sorted Set of the game servers in a Task
+def task_key(task_id):
+    return shard_tag(shard_of(task_id)) + "task-gameservers-" + to_str(task_id)
+
+# Get the Redis key that marks a Task draining
+def draining_key(task_id):
+    return shard_tag(shard_of(task_id)) + "draining-" + to_str(task_id)
+
+# Get the Redis key that marks a Task that has already hosted sessions
+def prioritize_key(task_id):
+    return shard_tag(shard_of(task_id)) + "prioritize-" + to_str(task_id)
+
+# Get the Redis key of the Sorted Set of the Tasks with free slots in the shard of the location, scored by the slots
+# in use (+0.5 for Tasks that have already hosted sessions)
+def occupancy_index(shard, location=None):
+    return shard_tag(shard) + "index-task-occupancy" + location_suffix(location)
+
+# Get the Redis key of the Sorted Set of the reservations in the shard of the location, scored by the time they expire
+def reservation_index(shard, location=None):
+    return shard_tag(shard) + "index-reservations" + location_suffix(location)
+
+# Get the Redis key of the Sorted Set of queued matchmaking ticket ids of the location, scored by the time the ticket
+# expires. The tickets have the same timeout so this is the order they were queued in (FIFO)
+def ticket_queue(location=None):
+    return "{tickets}ticket-queue" + location_suffix(location)
+
+# Get the Redis key of a matchmaking ticket Hash
+def ticket_key(ticket_id):
+    return shard_tag(shard_of(ticket_id)) + "ticket-" + to_str(ticket_id)
+
+# Get the Redis key of the List that gets an entry when the ticket is placed (for long-polling with BLPOP)
+def ticket_notify_key(ticket_id):
+    return shard_tag(shard_of(ticket_id)) + "ticket-notify-" + to_str(ticket_id)
+
+# Get the Redis key of the Hash of the latest placement (or queued ticket) of a player
+def player_key(player_id):
+    return shard_tag(shard_of(player_id)) + "player-session-" + to_str(player_id)
+
+# Sorted Set of the Tasks being drained by the scaler (score is the time the Task was marked draining).
+# Only used by the scaler with single key commands so it is not in a shard
+DRAINING_TASKS = "draining-tasks"
+
+# Get the Redis key of the Sorted Set of the draining Tasks of the location
+def draining_tasks_key(location=None):
+    return DRAINING_TASKS + location_suffix(location)
+
+def to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('UTF-8')
+    return str(value)
+
+# Get the public IP and port of a game server from its address field (publicIP:port)
+def parse_address(address):
+    publicIP, separator, port = to_str(address).rpartition(":")
+    return publicIP, port
+
+# Add the game server to the index of its current state and remove it from all the others
+# Use a pipeline (or MULTI) as redis_client to send this together with the Hash updates
+def update_index(redis_client, server_id, state, ttl, now=None, location=None):
+    if now == None:
+        now = time.time()
+    server_id = to_str(server_id)
+    shard = shard_of(server_id)
+    for other_state in STATES:
+        if other_state != state:
+            redis_client.zrem(index_key(other_state, shard, location), server_id)
+    redis_client.zadd(index_key(state, shard, location), { server_id: now + ttl })
+
+# Add the game server to the members of its Task. The membership key expires with the last game server entry
+# Use a pipeline (or MULTI) as redis_client to send this together with the Hash updates
+def add_to_task(redis_client, server_id, task_id, ttl, now=None):
+    if now == None:
+        now = time.time()
+    redis_client.zadd(task_key(task_id), { to_str(server_id): now + ttl })
+    redis_client.expire(task_key(task_id), int(math.ceil(ttl)))
+
+# Add a placeholder for a game server in a Task that was just started. The game server is not ready until it
+# reports itself and the placeholder expires if it never does
+def add_placeholder(redis_client, server_id, task_id, max_players, ttl, now=None, location=None):
+    if now == None:
+        now = time.time()
+    key = server_key(AVAILABLE, server_id)
+    redis_client.hset(key, mapping={ VERSION: RECORD_VERSION, CURRENT_PLAYERS: 0, MAX_PLAYERS: max_players, READY: 0 })
+    redis_client.expire(key, int(math.ceil(ttl)))
+    update_index(redis_client, server_id, AVAILABLE, ttl, now, location)
+    add_to_task(redis_client, server_id, task_id, ttl, now)
+
+# Get the amount of game servers in the Task that are still live (have not terminated or expired)
+def count_task_servers(redis_client, task_id, now=None):
+    if now == None:
+        now = time.time()
+    return redis_client.zcount(task_key(task_id), "(" + repr(now), "+inf")
+
+# Lua function shared by the scripts that updates a Task in the occupancy index. Only Tasks that are not draining and
+# have free slots on ready game servers are in the index. The score is the slots in use in the Task and Tasks
+# that have already hosted sessions (the prioritize flag) get an extra 0.5 to be used before fresh Tasks
+REFRESH_TASK_FUNCTION = """
+-- Get the hash tag of the shard from a key. All the keys a script uses are in the same shard
+local function key_tag(key)
+    return string.match(key, '^{[^}]*}') or ''
+end
+
+local function refresh_task(task, occupancy_index, now)
+    local tag = key_tag(occupancy_index)
+    local used = 0
+    local free = 0
+    if redis.call('EXISTS', tag .. 'draining-' .. task) == 0 then
+        local members = redis.call('ZRANGEBYSCORE', tag .. 'task-gameservers-' .. task, '(' .. now, '+inf')
+        for _, member in ipairs(members) do
+            for _, state in ipairs({'available', 'available-priority', 'active', 'full'}) do
+                local server = redis.call('HMGET', tag .. state .. '-gameserver-' .. member, 'r', 'm', 'c', 's')
+                if server[2] then
+                    local reserved = tonumber(server[3] or '0') + tonumber(server[4] or '0')
+                    used = used + reserved
+                    if server[1] == '1' and state ~= 'full' then
+                        free = free + math.max(tonumber(server[2]) - reserved, 0)
+                    end
+                    break
+                end
+            end
+        end
+    end
+    if free > 0 then
+        if redis.call('EXISTS', tag .. 'prioritize-' .. task) == 1 then
+            used = used + 0.5
+        end
+        redis.call('ZADD', occupancy_index, used, task)
+    else
+        redis.call('ZREM', occupancy_index, task)
+    end
+end
+"""
+
+# Get the Task id from the game server id (taskArn-containerX)
+def task_of(server_id):
+    return to_str(server_id).split("-container")[0]
+
+# Atomically claims player slots on the first game server that is ready and has free slots
+# KEYS[1]: the occupancy index, KEYS[2]: the reservation index, KEYS[3..]: the indexes to search, in the order of preference
+# ARGV[1]: current time, ARGV[2]: random value 0-1 for picking the starting point in the indexes,
+# ARGV[3]: how many candidates to check per index, ARGV[4]: slots to claim, ARGV[5]: the time the reservation expires,
+# ARGV[6]: reservation id, ARGV[7..]: the state of each index in KEYS[3..]
+# Returns the game server key and address or nil if no free slots were found
+CLAIM_SCRIPT = REFRESH_TASK_FUNCTION + """
+local now = tonumber(ARGV[1])
+local tag = key_tag(KEYS[1])
+local candidates = tonumber(ARGV[3])
+local slots = tonumber(ARGV[4])
+for i = 3, #KEYS do
+    local index = KEYS[i]
+    local size = redis.call('ZCARD', index)
+    if size > 0 then
+        -- Check a window of candidates starting from a random position, wrapping around the end of the index
+        local start = math.floor(tonumber(ARGV[2]) * size)
+        local members = redis.call('ZRANGE', index, start, start + candidates - 1, 'WITHSCORES')
+        if start + candidates > size and start > 0 then
+            local rest = redis.call('ZRANGE', index, 0, math.min(start, start + candidates - size) - 1, 'WITHSCORES')
+            for _, value in ipairs(rest) do
+                table.insert(members, value)
+            end
+        end
+        for j = 1, #members, 2 do
+            if tonumber(members[j + 1]) > now then
+                local key = tag .. ARGV[4 + i] .. '-gameserver-' .. members[j]
+                local server = redis.call('HMGET', key, 'r', 'm', 's', 'a', 'c')
+                if server[1] == '1' and server[2] and server[4] then
+                    local pending = tonumber(server[3] or '0')
+                    if tonumber(server[5] or '0') + pending + slots <= tonumber(server[2]) then
+                        redis.call('HSET', key, 's', pending + slots, 'p' .. ARGV[6], slots .. '|' .. ARGV[5])
+                        redis.call('ZADD', KEYS[2], ARGV[5], members[j] .. '|' .. ARGV[6] .. '|' .. slots)
+                        refresh_task(string.match(members[j], '^(.*)-container%d+$') or members[j], KEYS[1], ARGV[1])
+                        return {key, server[4]}
+                    end
+                end
+            end
+        end
+    end
+end
+return nil
+"""
+
+# Claim player slots on a game server of the location in a single round trip per shard tried. Searches the states
+# in the given order. Returns the game server key, publicIP and port (as strings) or None if no game server had free slots
+# The reservation is released if the players don't connect in reservation_timeout seconds
+def claim_slots(redis_client, states, candidates, slots=1, reservation_timeout=30.0, now=None, location=None):
+    if now == None:
+        now = time.time()
+    for shard in claim_shards(redis_client, False, location):
+        keys = [occupancy_index(shard, location), reservation_index(shard, location)]
+        keys += [index_key(state, shard, location) for state in states]
+        args = [repr(now), random.random(), candidates, slots, repr(now + reservation_timeout), reservation_id()] + states
+        result = run_script(redis_client, CLAIM_SCRIPT, keys, args)
+        if result != None:
+            return claimed_server(result)
+    return None
+
+# Get the shards to claim player slots from in the location, in the order to try them. Only the shards that have Tasks
+# with free slots are returned, the ones with the busiest Task first when consolidating and otherwise in a random order
+# With a single shard there's nothing to choose from and no round trip is needed
+def claim_shards(redis_client, by_occupancy, location=None):
+    if shards == 1:
+        return [0]
+    with redis_client.pipeline(transaction=False) as pipe:
+        for shard in range(shards):
+            pipe.zrevrange(occupancy_index(shard, location), 0, 0, withscores=True)
+        busiest = [(shard, task[0][1]) for shard, task in enumerate(pipe.execute()) if len(task) > 0]
+    if by_occupancy:
+        busiest.sort(key=lambda shard: -shard[1])
+    else:
+        random.shuffle(busiest)
+    return [shard for shard, score in busiest]
+
+# Atomically claims player slots on the busiest Task that has free slots (bin-packing)
+# The Tasks are checked in the order of the occupancy index. In a Task, game servers that already have players are
+# used first. Tasks that turn out to have no free slots (their servers expired) are updated in the index
+# KEYS[1]: the occupancy index, KEYS[2]: the reservation index, ARGV[1]: current time, ARGV[2]: how many Tasks to check,
+# ARGV[3]: slots to claim, ARGV[4]: the time the reservation expires, ARGV[5]: reservation id
+# Returns the game server key and address or nil if no free slots were found
+CLAIM_BY_OCCUPANCY_SCRIPT = REFRESH_TASK_FUNCTION + """
+local now = ARGV[1]
+local tag = key_tag(KEYS[1])
+local slots = tonumber(ARGV[3])
+local tasks = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+for _, task in ipairs(tasks) do
+    local members = redis.call('ZRANGEBYSCORE', tag .. 'task-gameservers-' .. task, '(' .. now, '+inf')
+    for _, state in ipairs({'active', 'available-priority', 'available'}) do
+        for _, member in ipairs(members) do
+            local key = tag .. state .. '-gameserver-' .. member
+            local server = redis.call('HMGET', key, 'r', 'm', 's', 'a', 'c')
+            if server[1] == '1' and server[2] and server[4] then
+                local pending = tonumber(server[3] or '0')
+                if tonumber(server[5] or '0') + pending + slots <= tonumber(server[2]) then
+                    redis.call('HSET', key, 's', pending + slots, 'p' .. ARGV[5], slots .. '|' .. ARGV[4])
+                    redis.call('ZADD', KEYS[2], ARGV[4], member .. '|' .. ARGV[5] .. '|' .. slots)
+                    refresh_task(task, KEYS[1], now)
+                    return {key, server[4]}
+                end
+            end
+        end
+    end
+    refresh_task(task, KEYS[1], now)
+end
+return nil
+"""
+
+# Claim player slots on the busiest Task with free slots in the location in a single round trip per shard tried
+# Returns the game server key, publicIP and port (as strings) or None if no game server had free slots
+def claim_slots_by_occupancy(redis_client, tasks, slots=1, reservation_timeout=30.0, now=None, location=None):
+    if now == None:
+        now = time.time()
+    for shard in claim_shards(redis_client, True, location):
+        args = [repr(now), tasks, slots, repr(now + reservation_timeout), reservation_id()]
+        keys = [occupancy_index(shard, location), reservation_index(shard, location)]
+        result = run_script(redis_client, CLAIM_BY_OCCUPANCY_SCRIPT, keys, args)
+        if result != None:
+            return claimed_server(result)
+    return None
+
+# Get the game server key, publicIP and port (as strings) from the result of a claim script
+def claimed_server(result):
+    publicIP, port = parse_address(result[1])
+    return [to_str(result[0]), publicIP, port]
+
+# Atomically applies a game server status update (heartbeat) to the game server Hash and the indexes
+# KEYS[1-4]: the game server Hash in each state (available, available priority, active, full)
+# KEYS[5]: the prioritize key of the Task, KEYS[6-9]: the index of each state, KEYS[10]: the game servers of the Task
+# KEYS[11]: the draining key of the Task, KEYS[12]: the occupancy index
+# ARGV[1]: server id, ARGV[2]: current time, ARGV[3]: ttl, ARGV[4]: server in use, ARGV[5]: server terminated,
+# ARGV[6]: current players, ARGV[7]: max players, ARGV[8]: ready, ARGV[9]: public IP, ARGV[10]: port, ARGV[11]: the Task id
+# The other game servers of the Task are only read (to update the occupancy index) when the slots of the game server
+# change or its Task is missing from the index, so a steady heartbeat runs the same commands whatever the Task size
+# Returns the new state index (1-4) or 0 if the server was removed
+HEARTBEAT_SCRIPT = REFRESH_TASK_FUNCTION + """
+-- Get the slots the game server takes and has free for placements in its Task
+local function task_slots(state, ready, max_players, players, pending)
+    local used = tonumber(players or '0') + tonumber(pending or '0')
+    local free = 0
+    if ready == '1' and state ~= 4 and max_players then
+        free = math.max(tonumber(max_players) - used, 0)
+    end
+    return used, free
+end
+
+local now = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+local current_players = tonumber(ARGV[6])
+
+-- Server terminated, delete all the possible game server keys and index entries
+if ARGV[5] == '1' then
+    for i = 1, 4 do
+        redis.call('DEL', KEYS[i])
+        redis.call('ZREM', KEYS[5 + i], ARGV[1])
+    end
+    redis.call('ZREM', KEYS[10], ARGV[1])
+    refresh_task(ARGV[11], KEYS[12], ARGV[2])
+    return 0
+end
+
+-- Find the current state of the game server
+local current = nil
+for i = 1, 4 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        current = i
+        break
+    end
+end
+
+-- Select the new state: full when in use, active when there are players, otherwise available.
+-- Servers on Tasks that have already hosted sessions are marked priority for good rotation of Tasks
+local target = 1
+if ARGV[4] == '1' then
+    target = 4
+    redis.call('SET', KEYS[5], 'yes', 'EX', ttl)
+elseif current_players > 0 then
+    target = 3
+    redis.call('SET', KEYS[5], 'yes', 'EX', ttl)
+elseif redis.call('EXISTS', KEYS[5]) == 1 then
+    target = 2
+    redis.call('SET', KEYS[5], 'yes', 'EX', ttl)
+end
+
+-- The slots of the game server before the update
+local server = redis.call('HMGET', KEYS[current or target], 'r', 'm', 'c', 's')
+local used_before, free_before = -1, -1
+if current ~= nil then
+    used_before, free_before = task_slots(current, server[1], server[2], server[3], server[4])
+end
+
+-- Move the existing data (reservations) to the new state and delete all other states
+if current ~= nil and current ~= target then
+    redis.call('RENAME', KEYS[current], KEYS[target])
+end
+for i = 1, 4 do
+    if i ~= target then
+        redis.call('DEL', KEYS[i])
+        redis.call('ZREM', KEYS[5 + i], ARGV[1])
+    end
+end
+-- Players that connected since the previous heartbeat take over the oldest pending reservations
+local pending = tonumber(server[4] or '0')
+local joined = math.min(current_players - tonumber(server[3] or '0'), pending)
+if joined > 0 then
+    local reservations = {}
+    local fields = redis.call('HGETALL', KEYS[target])
+    for i = 1, #fields, 2 do
+        if string.sub(fields[i], 1, 1) == 'p' then
+            local slots, expires = string.match(fields[i + 1], '^(%d+)|(.*)$')
+            table.insert(reservations, {fields[i], tonumber(slots), expires})
+        end
+    end
+    table.sort(reservations, function(a, b) return tonumber(a[3]) < tonumber(b[3]) end)
+    for _, reservation in ipairs(reservations) do
+        if joined == 0 then
+            break
+        end
+        local connected = math.min(joined, reservation[2])
+        if connected == reservation[2] then
+            redis.call('HDEL', KEYS[target], reservation[1])
+        else
+            redis.call('HSET', KEYS[target], reservation[1], (reservation[2] - connected) .. '|' .. reservation[3])
+        end
+        joined = joined - connected
+        pending = pending - connected
+    end
+    redis.call('HSET', KEYS[target], 's', pending)
+end
+
+redis.call('HSET', KEYS[target], 'v', '1', 'c', ARGV[6], 'm', ARGV[7], 'r', ARGV[8], 'a', ARGV[9] .. ':' .. ARGV[10])
+redis.call('EXPIRE', KEYS[target], math.ceil(ttl))
+
+-- Servers on draining Tasks are kept out of the indexes so no new players are placed on them
+local draining = redis.call('EXISTS', KEYS[11]) == 1
+if draining then
+    redis.call('ZREM', KEYS[5 + target], ARGV[1])
+else
+    redis.call('ZADD', KEYS[5 + target], now + ttl, ARGV[1])
+end
+-- Keep the server live in its Task. Only extend the expiry of the Task key, other servers of the Task might live longer
+redis.call('ZADD', KEYS[10], now + ttl, ARGV[1])
+if redis.call('TTL', KEYS[10]) < math.ceil(ttl) then
+    redis.call('EXPIRE', KEYS[10], math.ceil(ttl))
+end
+-- Update the Task in the occupancy index when the slots of the game server changed, or when the game server has free
+-- slots and the Task is missing from the index (it was draining, or the slots of another game server were freed)
+local used, free = task_slots(target, ARGV[8], ARGV[7], ARGV[6], pending)
+if used ~= used_before or free ~= free_before or
+        (free > 0 and not draining and not redis.call('ZSCORE', KEYS[12], ARGV[11])) then
+    refresh_task(ARGV[11], KEYS[12], ARGV[2])
+end
+return target
+"""
+
+# Update the game server data and the indexes of its location with a single atomic script
+# redis_client can be a pipeline to send updates of multiple game servers together
+# Returns the new state of the game server (or None if it was removed) unless a pipeline is used
+def update_game_server(redis_client, server_id, task_id, server_in_use, server_terminated, current_players, max_players,
+                       ready, publicIP, port, ttl, now=None, location=None):
+    if now == None:
+        now = time.time()
+    server_id = to_str(server_id)
+    shard = shard_of(task_id)
+    keys = [server_key(state, server_id) for state in STATES] + [prioritize_key(task_id)]
+    keys += [index_key(state, shard, location) for state in STATES] + [task_key(task_id), draining_key(task_id),
+             occupancy_index(shard, location)]
+    args = [server_id, repr(now), ttl, int(server_in_use == True), int(server_terminated == True),
+            current_players, max_players, int(ready == True), publicIP or "", port or "", to_str(task_id)]
+    return run_script(redis_client, HEARTBEAT_SCRIPT, keys, args)
+
+# Get the state name from the value returned by the heartbeat script
+def state_from_result(result):
+    if result == None or int(result) == 0:
+        return None
+    return STATES[int(result) - 1]
+
+# Get the exact amount of game servers in each state in the location. Expired entries are pruned first so the counts
+# match the Hashes that exist in Redis. Done in a single round trip with O(log n) work per state and shard
+def count_servers(redis_client, now=None, location=None):
+    if now == None:
+        now = time.time()
+    with redis_client.pipeline(transaction=False) as pipe:
+        for shard in range(shards):
+            for state in STATES:
+                pipe.zremrangebyscore(index_key(state, shard, location), "-inf", now)
+                pipe.zcard(index_key(state, shard, location))
+        responses = pipe.execute()
+    counts = dict((state, 0) for state in STATES)
+    for i, count in enumerate(responses[1::2]):
+        counts[STATES[i % len(STATES)]] += count
+    return counts
+
+# Atomically drains an idle Task or stops draining it. A Task is idle when all its live game servers are ready
+# and available with no players and no reservations
+# KEYS[1]: the game servers of the Task, KEYS[2]: the draining key of the Task, KEYS[3-6]: the index of each state
+# KEYS[7]: the occupancy index, ARGV[1]: current time, ARGV[2]: drain timeout, ARGV[3]: 'drain' to mark the Task draining
+# or 'stop' to remove the game servers of a draining Task before it is stopped, ARGV[4]: the Task id
+# Returns the amount of game servers in the Task, or 0 if the Task was not idle (a draining Task is then released)
+DRAIN_SCRIPT = """
+local tag = string.match(KEYS[1], '^{[^}]*}') or ''
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf')
+local idle = #members > 0
+for _, member in ipairs(members) do
+    local server_idle = false
+    for _, state in ipairs({'available', 'available-priority'}) do
+        local server = redis.call('HMGET', tag .. state .. '-gameserver-' .. member, 'r', 'c', 's')
+        if server[1] == '1' and tonumber(server[2]) == 0 and tonumber(server[3] or '0') == 0 then
+            server_idle = true
+        end
+    end
+    if not server_idle then
+        idle = false
+        break
+    end
+end
+if not idle then
+    if ARGV[3] == 'stop' then
+        redis.call('DEL', KEYS[2])
+    end
+    return 0
+end
+for _, member in ipairs(members) do
+    for i = 3, 6 do
+        redis.call('ZREM', KEYS[i], member)
+    end
+    if ARGV[3] == 'stop' then
+        redis.call('DEL', tag .. 'available-gameserver-' .. member, tag .. 'available-priority-gameserver-' .. member)
+    end
+end
+if ARGV[3] == 'stop' then
+    redis.call('DEL', KEYS[1])
+end
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+redis.call('ZREM', KEYS[7], ARGV[4])
+return #members
+"""
+
+# Mark the Task (in the location) draining if all its game servers are idle
+# Returns the amount of game servers drained (0 if not idle)
+def drain_task(redis_client, task_id, drain_timeout, now=None, location=None):
+    if now == None:
+        now = time.time()
+    keys = drain_keys(task_id, location)
+    return int(run_script(redis_client, DRAIN_SCRIPT, keys, [repr(now), int(math.ceil(drain_timeout)), "drain", to_str(task_id)]))
+
+# Confirm a draining Task is still idle and remove its game servers so it can be stopped
+# Returns the amount of game servers removed, or 0 if the Task was not idle anymore and was released from draining
+def release_drained_task(redis_client, task_id, drain_timeout, now=None, location=None):
+    if now == None:
+        now = time.time()
+    keys = drain_keys(task_id, location)
+    return int(run_script(redis_client, DRAIN_SCRIPT, keys, [repr(now), int(math.ceil(drain_timeout)), "stop", to_str(task_id)]))
+
+# Get the keys the drain script uses for the Task in the location
+def drain_keys(task_id, location):
+    shard = shard_of(task_id)
+    return [task_key(task_id), draining_key(task_id)] + [index_key(state, shard, location) for state in STATES] + \
+           [occupancy_index(shard, location)]
+
+# Atomically releases the expired reservations (clients that got a placement but never connected)
+# The pending slots of the game server are reduced by the slots of the reservation that are still pending. Reservations
+# whose players have connected are only removed from the index
+# KEYS[1]: the reservation index, KEYS[2]: the occupancy index, ARGV[1]: current time, ARGV[2]: max reservations to release
+# Returns the amount of reservations released
+SWEEP_RESERVATIONS_SCRIPT = REFRESH_TASK_FUNCTION + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local tag = key_tag(KEYS[1])
+local tasks = {}
+for _, reservation in ipairs(expired) do
+    local server_id, reservation_id = string.match(reservation, '^(.*)|([^|]*)|%d+$')
+    if server_id then
+        for _, state in ipairs({'available', 'available-priority', 'active', 'full'}) do
+            local key = tag .. state .. '-gameserver-' .. server_id
+            local pending = redis.call('HGET', key, 'p' .. reservation_id)
+            if pending then
+                local slots = tonumber(string.match(pending, '^(%d+)'))
+                redis.call('HDEL', key, 'p' .. reservation_id)
+                redis.call('HSET', key, 's', math.max(tonumber(redis.call('HGET', key, 's') or '0') - slots, 0))
+                tasks[string.match(server_id, '^(.*)-container%d+$') or server_id] = true
+                break
+            end
+        end
+    end
+    redis.call('ZREM', KEYS[1], reservation)
+end
+-- The released slots are free for placements again
+for task, _ in pairs(tasks) do
+    refresh_task(task, KEYS[2], ARGV[1])
+end
+return #expired
+"""
+
+# Release all the expired reservations of each shard of the location in batches. Called by the scaler
+# Returns the amount of reservations released
+def sweep_reservations(redis_client, batch=1000, now=None, location=None):
+    if now == None:
+        now = time.time()
+    released = 0
+    for shard in range(shards):
+        while True:
+            keys = [reservation_index(shard, location), occupancy_index(shard, location)]
+            count = int(run_script(redis_client, SWEEP_RESERVATIONS_SCRIPT, keys, [repr(now), batch]))
+            released += count
+            if count < batch:
+                break
+    return released
+
+# Get a random id for a reservation
+def reservation_id():
+    return "%016x" % random.getrandbits(64)
+
+# Add a matchmaking ticket to the end of the queue of the location (served by the game servers of the location)
+# The ticket expires if it's not placed in timeout seconds
+def enqueue_ticket(redis_client, ticket_id, slots, timeout, now=None, location=None):
+    if now == None:
+        now = time.time()
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(ticket_key(ticket_id), mapping={ "status": "queued", "slots": slots, "created": repr(now) })
+        pipe.expire(ticket_key(ticket_id), int(math.ceil(timeout)))
+        pipe.zadd(ticket_queue(location), { to_str(ticket_id): now + timeout })
+        pipe.execute()
+
+# Serve the queued matchmaking tickets of the location in FIFO order with the free slots of its game servers (the
+# busiest Tasks first, checking up to tasks Tasks per shard). Stops at the first ticket that doesn't fit, keeping it
+# first in the queue. The players of a served ticket have reservation_timeout seconds to connect
+# Returns the amount of tickets placed
+def serve_tickets(redis_client, reservation_timeout, tasks=5, batch=100, now=None, location=None):
+    if now == None:
+        now = time.time()
+    placed = 0
+    for i in range(batch):
+        queued = redis_client.zpopmin(ticket_queue(location))
+        if len(queued) == 0:
+            break
+        ticket_id, expires = queued[0]
+        # Expired tickets (the client gave up) are skipped
+        if expires <= now:
+            continue
+        ticket = redis_client.hmget(ticket_key(ticket_id), "status", "slots")
+        if ticket[0] != b"queued":
+            continue
+        claimed = claim_slots_by_occupancy(redis_client, tasks, int(ticket[1]), reservation_timeout, now, location)
+        if claimed == None:
+            redis_client.zadd(ticket_queue(location), { ticket_id: expires })
+            break
+        with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(ticket_key(ticket_id), mapping={ "status": "placed", "publicIP": claimed[1], "port": claimed[2] })
+            pipe.expire(ticket_key(ticket_id), int(math.ceil(reservation_timeout)))
+            pipe.rpush(ticket_notify_key(ticket_id), "1")
+            pipe.expire(ticket_notify_key(ticket_id), int(math.ceil(reservation_timeout)))
+            pipe.execute()
+        placed += 1
+    return placed
+
+# Get the matchmaking ticket as a dict of strings (status, slots, created and publicIP and port once placed)
+# Waits up to wait seconds for the ticket to be placed. Returns None if the ticket doesn't exist or has expired
+def get_ticket(redis_client, ticket_id, wait=0):
+    ticket = redis_client.hgetall(ticket_key(ticket_id))
+    if wait > 0 and ticket.get(b"status") == b"queued":
+        redis_client.blpop([ticket_notify_key(ticket_id)], timeout=wait)
+        ticket = redis_client.hgetall(ticket_key(ticket_id))
+    if len(ticket) == 0:
+        return None
+    return dict((to_str(key), to_str(value)) for key, value in ticket.items())
+
+# Get the amount of queued matchmaking tickets in the location. The expired tickets are removed from the queue first
+def count_tickets(redis_client, now=None, location=None):
+    if now == None:
+        now = time.time()
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zremrangebyscore(ticket_queue(location), "-inf", now)
+        pipe.zcard(ticket_queue(location))
+        return pipe.execute()[1]
+
+# Record the placement of a player (publicIP and port, or ticketId while the player waits for a ticket) so that
+# a repeated request of the player gets the same spot instead of reserving another one. Expires in timeout seconds
+def set_player_session(redis_client, player_id, session, timeout):
+    with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(player_key(player_id), mapping=session)
+        pipe.pexpire(player_key(player_id), int(math.ceil(timeout * 1000)))
+        pipe.execute()
+
+# Get the latest placement of the player as a dict of strings or None if the player has no placement (or it expired)
+def get_player_session(redis_client, player_id):
+    session = redis_client.hgetall(player_key(player_id))
+    if len(session) == 0:
+        return None
+    return dict((to_str(key), to_str(value)) for key, value in session.items())
+
+# Run a Lua script with EVALSHA. On a client the script is loaded automatically if Redis doesn't have it yet.
+# On a pipeline the EVALSHA is only queued (redis-py would otherwise check the scripts with an extra SCRIPT EXISTS
+# round trip on every execute) so the caller needs to load_scripts() and retry if the pipeline returns NoScriptError
+# (sent as a raw command as the Redis Cluster pipeline of redis-py blocks its evalsha method, it routes the command
+# by the keys like any other command)
+def run_script(redis_client, script, keys, args):
+    if isinstance(redis_client, (redis.client.Pipeline, redis.cluster.ClusterPipeline)):
+        return redis_client.execute_command("EVALSHA", script_sha(script), len(keys), *(keys + args))
+    return redis_client.register_script(script)(keys=keys, args=args)
+
+def script_sha(script):
+    return hashlib.sha1(script.encode('UTF-8')).hexdigest()
+
+def load_scripts(redis_client):
+    for script in [CLAIM_SCRIPT, CLAIM_BY_OCCUPANCY_SCRIPT, HEARTBEAT_SCRIPT, DRAIN_SCRIPT, SWEEP_RESERVATIONS_SCRIPT]:
+        redis_client.script_load(script)
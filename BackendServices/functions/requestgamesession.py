@@ -1,184 +1,243 @@
 import json
-import datetime
-import time
-import os
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
-import redis
-from datetime import timedelta
-import random
-from redis.exceptions import (
-    ConnectionError,
-    DataError,
-    ExecAbortError,
-    NoScriptError,
-    PubSubError,
-    RedisError,
-    ResponseError,
-    TimeoutError,
-    WatchError,
-)
+import uuid
+import admission
+import backend
+import locations
+import metrics
+import registry
+import scalingpolicy
 
 # Tries to find an existing or free game session and return the IP and Port to the client
+#
+# In ticket mode, a request that doesn't find a free spot queues a matchmaking ticket and returns its id (HTTP 202).
+# The client then checks the ticket with requestgamesession?ticketId=<id>&wait=<seconds> which waits (long-polls)
+# up to the given seconds for a game server and returns the IP and Port once the ticket is placed
+#
+# A group of players (party) requests the same game session with requestgamesession?groupSize=<players>. The slots for
+# the whole group are reserved atomically on a single game server that has room for all of them, or not at all
+#
+# The placements are recorded per player (the Cognito identity of the caller) for as long as the reservation is held.
+# A player that requests again (for example after its connection dropped) gets the same game server (or its queued
+# ticket) back with a single lookup instead of reserving another slot. Requests without an identity are not recorded
+#
+# Requests over the admitted rate (in total or of a single player, see admission.py) are shed with HTTP 429 and
+# a Retry-After header with the seconds after which the client should try again
+#
+# The game servers run in one or more locations (see locations.py). The client can send the latencies it measured to
+# the locations with requestgamesession?latencies=<location>:<milliseconds>,... and/or its preferred locations with
+# requestgamesession?locations=<location>,<location>. The player is placed in the location with the lowest latency
+# that has a free spot, falling back to the next ones in order. Clients without preferences can be placed anywhere
+
+# The placement strategy: "consolidate" fills the game servers of the busiest Tasks first (ordered by Task occupancy)
+# and only then uses fresh Tasks, so that idle Tasks can be scaled in. "spread" picks random game servers
+placement_strategy = "consolidate"
+
+# How many candidates the claim script checks in each index on a single try
+candidates_to_check = 25
+
+# How many Tasks the consolidating claim script checks on a single try (from the busiest down)
+tasks_to_check = 5
+
+# How many times we try to claim a spot (each try checks a new random window of candidates)
+claim_attempts = 3
+
+# Seconds the players have to connect to the game server before their reservation is released
+reservation_timeout = 30.0
+
+# Max players in a group request (the max players of a game session, see max_players in scaler.py)
+max_group_size = 2
+
+# Queue a matchmaking ticket instead of failing when there are no free spots
+ticket_mode = True
+
+# Seconds a queued ticket waits for a game server before it expires (the client needs to request again)
+ticket_timeout = 60
+
+# Max seconds a ticket status request waits for the placement (stays below the Redis client socket timeout)
+max_long_poll_seconds = 4.0
 
 def lambda_handler(event, context):
 
-    # Get redis endpoint and set up
-    redis_endpoint = os.environ['REDIS_ENDPOINT']
-    # Setup Redis client
-    redis_client = redis.Redis(host=redis_endpoint, port=6379, db=0)
-
-    # 1. Check if there are game servers that have players in them but are not full yet    
-    print("Checking if there are active servers with players already")
-    active_game_servers_response = redis_client.scan(count=100000,match="active-gameserver-*")
-    if len(active_game_servers_response[1]) > 0:
-        print("Found an active game server, trying to take the spot")
-
-        # Try to claim a spot on a random active game server
-        # Use WATCH locking to cancel the placement in case someone else took it a the same time
-        with redis_client.pipeline() as pipe:
-            # We'll try this 25 times and then just fail
-            for x in range(25):
-                try:
-                    # Take a random active game server
-                    game_server_key = random.choice(active_game_servers_response[1])
-
-                    # put a WATCH on a lock for this specific key
-                    pipe.watch(b'-lock'+game_server_key)
-
-                    # get the current reservation and max players for this game server.
-                    # Server will use "current-players" for actually connected players
-                    current_reservations = pipe.hget(game_server_key, b'reserved-player-slots')
-                    max_players = pipe.hget(game_server_key, b'max-players')
-                    print("current reservations: " + str(current_reservations))
-                    print("max players: " + str(max_players))
-
-                    if current_reservations == None:
-                        current_reservations = 0
-
-                    # Check if this server is full already
-                    if int(current_reservations) >= int(max_players):
-                        print("Server full, cannot join")
-                        continue
-
-                    next_value = int(current_reservations) + 1
-
-                    # now we can put the pipeline back into buffered mode with MULTI and try to update
-                    pipe.multi()
-                    pipe.hset(game_server_key, b'reserved-player-slots', next_value)
-                    pipe.hset(game_server_key, b'last-reservation-time', time.time())
-                    # Update lock
-                    pipe.set(b'-lock'+game_server_key, "")
-                    pipe.expire(b'-lock'+game_server_key, timedelta(seconds=3))
-                    # and finally, execute the pipeline (the set command)
-                    pipe.execute()
-
-                    # If we reached here, there was no WatchError
-                    print("Successfully taken the spot, return IP and port to client")
-
-                    publicIP = redis_client.hget(game_server_key, b'publicIP')
-                    port = redis_client.hget(game_server_key, b'port')
-
-                    print("Got server: " + str(publicIP) + ":" + str(port))
-
-                    return {
-                        "statusCode": 200,
-                        "body": json.dumps({ 'publicIP': publicIP.decode('UTF-8'), 'port': port.decode('UTF-8') })
-                    }
-                except WatchError:
-                    # another client must have changed the game server data in between
-                    # the time we started WATCHing it and the pipeline's execution.
-                    # We will retry a placement
-                    print("Failed to reserve slot, retrying")
-
-
-    # 2. As no game servers with players in them found, search for a free available game server
-    # We'll try this 30 times and then just fail
-    for x in range(30):
+    # The metrics of the request are written as a single record when it's done
+    metrics.begin("RequestGameSession")
+    try:
+        return handle_request(event)
+    finally:
+        metrics.flush()
+
+def handle_request(event):
+
+    # Get the Redis client (reused between invocations)
+    redis_client = backend.get_redis_client()
+
+    # Shed the request right away if it's over the admitted rate
+    player_id = get_player_id(event)
+    retry_after = admission.admit_request(redis_client, player_id)
+    if retry_after != None:
+        metrics.logger.debug("Shed a request of player %s, retry after %d seconds", player_id, retry_after)
+        return {
+            "statusCode": 429,
+            "headers": { "Retry-After": str(retry_after) },
+            "body": json.dumps({ 'failed': 'too many requests', 'retryAfter': retry_after })
+        }
+
+    # Status check of a queued matchmaking ticket
+    query_parameters = (event or {}).get("queryStringParameters") or {}
+    if query_parameters.get("ticketId") != None:
+        wait = 0.0
         try:
-            #   Check priority list first for the first 20 rounds (Game servers on Tasks that already hosted sessions) for good rotation of Tasks
-            #   For the last 10 rounds we switch to non-priority to make sure any issues in priority won't fail us completely
-            available_game_servers_response = None
-            if x < 20:
-                print("No active game sessions, checking priority servers first from available")
-                available_game_servers_response = redis_client.scan(count=100000,match="available-priority-gameserver-*")
-
-            if available_game_servers_response == None or len(available_game_servers_response[1]) == 0:
-                # No priority servers, check list of servers on fresh Tasks
-                print("No priority servers. Checking if there are available servers with no players")
-                available_game_servers_response = redis_client.scan(count=100000,match="available-gameserver-*")
-
-            if len(available_game_servers_response[1]) > 0:
-                print("Found an available game server, trying to take the spot")
-                # You can use these 3 lines for debugging if you need more information on the server
-                #print(available_game_servers_response[1])
-                #server_info = redis_client.hgetall(available_game_servers_response[1][0])
-                #print(server_info)
-
-            # Try to claim a spot on a random available game server
-            # Use WATCH locking to cancel the placement in case someone else took it a the same time
-            with redis_client.pipeline() as pipe:
-
-                # Take a random available game server
-                game_server_key = random.choice(available_game_servers_response[1])
-
-                # Make sure the server is ready to accept connections
-                server_ready = redis_client.hget(game_server_key, b'ready')
-                print("Server ready: " + str(server_ready))
-                if int(server_ready) == 0:
-                    print("Server not ready yet, retry.")
-                    continue
-
-                # put a WATCH on a lock for this specific key
-                pipe.watch(b'-lock'+game_server_key)
-
-                # get the current reservation and max players for this game server.
-                # Server will use "current-players" for actually connected players
-                current_reservations = pipe.hget(game_server_key, b'reserved-player-slots')
-                max_players = pipe.hget(game_server_key, b'max-players')
-                print("current reservations: " + str(current_reservations))
-                print("max players: " + str(max_players))
-
-                if current_reservations == None:
-                    current_reservations = 0
-
-                # Check if this was preserved full already
-                if int(current_reservations) >= int(max_players):
-                    print("Server full, cannot join")
-                    continue
-
-                next_value = int(current_reservations) + 1
-
-                # now we can put the pipeline back into buffered mode with MULTI and try to update
-                pipe.multi()
-                pipe.hset(game_server_key, b'reserved-player-slots', next_value)
-                pipe.hset(game_server_key, b'last-reservation-time', time.time())
-                # Update lock
-                pipe.set(b'-lock'+game_server_key, "")
-                pipe.expire(b'-lock'+game_server_key, timedelta(seconds=3))
-                # and finally, execute the pipeline (the set command)
-                pipe.execute()
-
-                # If we reached here, there was no WatchError
-                print("Successfully taken the spot, return IP and port to client")
-
-                publicIP = redis_client.hget(game_server_key, b'publicIP')
-                port = redis_client.hget(game_server_key, b'port')
-
-                print("Got server: " + str(publicIP) + ":" + str(port))
-
-                return {
-                    "statusCode": 200,
-                    "body": json.dumps({ 'publicIP': publicIP.decode('UTF-8'), 'port': port.decode('UTF-8') })
-                }
-        except WatchError:
-            # another client must have changed 'OUR-SEQUENCE-KEY' between
-            # the time we started WATCHing it and the pipeline's execution.
-            # our best bet is to just retry.
-            print("Failed to reserve slot, retrying")
+            wait = min(max(float(query_parameters.get("wait", 0)), 0.0), max_long_poll_seconds)
+        except ValueError:
+            pass
+        with metrics.timer("RedisTicketTime"):
+            return ticket_status(redis_client, query_parameters["ticketId"], wait)
+
+    # The amount of slots to reserve (players in the group)
+    try:
+        group_size = int(query_parameters.get("groupSize", 1))
+    except ValueError:
+        group_size = 0
+    if group_size < 1 or group_size > max_group_size:
+        metrics.logger.debug("Invalid group size: %s", query_parameters.get("groupSize"))
+        metrics.add("InvalidRequests")
+        return {
+            "statusCode": 400,
+            "body": json.dumps({ 'failed': 'groupSize needs to be between 1 and ' + str(max_group_size) })
+        }
+
+    # A repeated request of the player gets its existing placement or ticket
+    if player_id != None:
+        with metrics.timer("RedisPlayerSessionTime"):
+            response = existing_placement(redis_client, player_id)
+        if response != None:
+            metrics.add("RepeatedRequests")
+            return response
+
+    # The locations to place the player in, the lowest latency (or most preferred) first. The demand is recorded
+    # and the tickets are queued in the first one so the scaler starts capacity where the players want to play
+    placement_locations = locations.placement_order(query_parameters.get("latencies"), query_parameters.get("locations"))
+
+    for location in placement_locations:
+        claimed = claim_in_location(redis_client, group_size, location)
+        if claimed != None:
+            game_server_key, publicIP, port = claimed
+            metrics.logger.debug("Claimed a spot on %s (%s:%s) in %s for a group of %d", game_server_key, publicIP, port,
+                                 location, group_size)
+            metrics.add("Placements")
+            if location != placement_locations[0]:
+                metrics.add("FallbackPlacements")
+
+            # Record the request to the demand time series for the scaler
+            with metrics.timer("RedisDemandTime"):
+                scalingpolicy.record_session_request(redis_client, True, group_size, location=placement_locations[0])
+
+            # Record the placement of the player for its repeated requests
+            if player_id != None:
+                with metrics.timer("RedisPlayerSessionTime"):
+                    registry.set_player_session(redis_client, player_id, { "publicIP": publicIP, "port": port },
+                                                reservation_timeout)
+
+            return {
+                "statusCode": 200,
+                "body": json.dumps({ 'publicIP': publicIP, 'port': port })
+            }
 
     # Failed to find a server
+    metrics.add("PlacementsFailed")
+    with metrics.timer("RedisDemandTime"):
+        scalingpolicy.record_session_request(redis_client, False, group_size, location=placement_locations[0])
+
+    # Queue a ticket that the next game server with free slots will serve
+    if ticket_mode:
+        ticket_id = uuid.uuid4().hex
+        with metrics.timer("RedisTicketTime"):
+            registry.enqueue_ticket(redis_client, ticket_id, group_size, ticket_timeout, location=placement_locations[0])
+        if player_id != None:
+            with metrics.timer("RedisPlayerSessionTime"):
+                registry.set_player_session(redis_client, player_id, { "ticketId": ticket_id }, ticket_timeout)
+        metrics.logger.debug("No free spot found, queued matchmaking ticket %s", ticket_id)
+        metrics.add("TicketsQueued")
+        return {
+            "statusCode": 202,
+            "body": json.dumps({ 'ticketId': ticket_id, 'status': 'queued' })
+        }
+
     return {
             "statusCode": 500,
             "body": json.dumps({ 'failed': 'couldnt find a free server spot'})
-    }
\ No newline at end of file
+    }
+
+# Get the id of the player (the Cognito identity of the signed request) or None for requests without an identity
+def get_player_id(event):
+    identity = ((event or {}).get("requestContext") or {}).get("identity") or {}
+    return identity.get("cognitoIdentityId") or None
+
+# Get the response to a repeated request of the player: the game server it already has a spot on or the status of its
+# queued ticket. Returns None if the player has no placement or its ticket has expired
+def existing_placement(redis_client, player_id):
+    session = registry.get_player_session(redis_client, player_id)
+    if session == None:
+        return None
+    if "ticketId" in session:
+        response = ticket_status(redis_client, session["ticketId"], 0)
+        if response["statusCode"] == 404:
+            return None
+        return response
+    metrics.logger.debug("Player %s already has a spot on %s:%s", player_id, session["publicIP"], session["port"])
+    return {
+        "statusCode": 200,
+        "body": json.dumps({ 'publicIP': session["publicIP"], 'port': session["port"] })
+    }
+
+# Try to claim a spot for the group in the location with a single atomic script on Redis
+# Returns the game server key, publicIP and port or None if the location had no free spot
+def claim_in_location(redis_client, group_size, location):
+    # With the spread strategy the script checks random game servers in the order:
+    # 1. Active game servers that have players in them but are not full yet
+    # 2. Available priority game servers (Game servers on Tasks that already hosted sessions) for good rotation of Tasks
+    # 3. Available game servers with no players on fresh Tasks
+    # With the consolidate strategy the script checks the Tasks from the busiest down (Tasks that already hosted sessions
+    # before fresh ones) and uses the same order within the Task
+    # The script makes sure the server is ready and has free slots before incrementing the reservations
+    # so there's no need to retry because of other clients claiming spots at the same time
+    for x in range(claim_attempts):
+        metrics.add("ClaimAttempts")
+        with metrics.timer("RedisClaimTime"):
+            claimed = claim_spot(redis_client, group_size, location)
+        if claimed != None:
+            return claimed
+        metrics.logger.debug("No free spot found in the checked game servers in %s, retrying", location)
+    return None
+
+# Claim a spot for the group in the location with the claim scripts of the placement strategy
+def claim_spot(redis_client, group_size, location=None):
+    states = [registry.ACTIVE, registry.AVAILABLE_PRIORITY, registry.AVAILABLE]
+    if placement_strategy == "consolidate":
+        claimed = registry.claim_slots_by_occupancy(redis_client, tasks_to_check, group_size, reservation_timeout,
+                                                    location=location)
+        # The busiest Tasks might only have room for smaller groups, check random game servers as well
+        if claimed == None and group_size > 1:
+            claimed = registry.claim_slots(redis_client, states, candidates_to_check, group_size, reservation_timeout,
+                                           location=location)
+        return claimed
+    return registry.claim_slots(redis_client, states, candidates_to_check, group_size, reservation_timeout, location=location)
+
+# Get the status of a matchmaking ticket, waiting up to wait seconds for it to be placed
+def ticket_status(redis_client, ticket_id, wait):
+    ticket = registry.get_ticket(redis_client, ticket_id, wait)
+    if ticket == None:
+        metrics.logger.debug("Ticket %s not found or expired", ticket_id)
+        return {
+            "statusCode": 404,
+            "body": json.dumps({ 'failed': 'ticket not found or expired' })
+        }
+    if ticket["status"] == "placed":
+        metrics.logger.debug("Ticket %s placed on %s:%s", ticket_id, ticket["publicIP"], ticket["port"])
+        return {
+            "statusCode": 200,
+            "body": json.dumps({ 'publicIP': ticket["publicIP"], 'port': ticket["port"] })
+        }
+    return {
+        "statusCode": 202,
+        "body": json.dumps({ 'ticketId': ticket_id, 'status': ticket["status"] })
+    }
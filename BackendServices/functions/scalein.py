@@ -0,0 +1,129 @@
+import math
+import time
+import inventory
+import metrics
+import registry
+
+# Scale-in controller of the scaler: drains and stops idle Tasks when there are more available game servers than needed
+#
+# 1. Tasks whose game servers are all available with no players or reservations are marked draining (atomically on
+#    Redis) when the available game servers are above the target headroom. Their game servers are taken out of
+#    the indexes so requestgamesession stops placing players on them
+# 2. On a later round the draining Tasks are checked again. Tasks that are still idle are stopped with ECS and
+#    Tasks that got players in the meantime are released back to the fleet
+# Scale-in is rate limited and doesn't run for a while after the scaler started new Tasks, so it can't fight scale-out
+# Each location is scaled in separately (with its own draining Tasks, rate limit and cooldown)
+
+# Seconds between scale-in checks
+scale_in_interval = 30
+
+# Don't scale in for this many seconds after new Tasks were started
+scale_out_cooldown = 300
+
+# Max Tasks to mark draining on a single scale-in check
+max_tasks_to_drain = 5
+
+# Seconds a Task is draining before it's stopped (in-flight placements and heartbeats settle)
+drain_wait = 5
+
+# Seconds after which the draining mark of a Task expires (for example if the scaler stopped running)
+drain_timeout = 300
+
+LAST_SCALE_OUT_KEY = "scaler-last-scale-out"
+LAST_SCALE_IN_KEY = "scaler-last-scale-in"
+
+# Record that the scaler started new Tasks in the location (pauses scale-in for the cooldown)
+def record_scale_out(redis_client, now=None, location=None):
+    if now == None:
+        now = time.time()
+    redis_client.set(LAST_SCALE_OUT_KEY + registry.location_suffix(location), repr(now), ex=scale_out_cooldown)
+
+# Get the amount of available game servers we can remove while keeping the target headroom and minimum
+def excess_game_servers(available_game_servers, total_game_servers, settings):
+    # Keep the target percentage available after removing the game servers: (available - x) / (total - x) >= target
+    target_percentage = settings["available_game_servers_target_percentage"]
+    excess = int(math.floor((available_game_servers - target_percentage * total_game_servers) / (1.0 - target_percentage)))
+    # And keep the minimum amount of game servers running
+    excess = min(excess, total_game_servers - settings["total_game_servers_target_min"])
+    return max(excess, 0)
+
+# Run a scale-in check in the location (running in the given cluster): stop the drained Tasks that are still idle and
+# drain new idle Tasks if we have excess capacity. Returns the amount of Tasks stopped
+def scale_in(redis_client, ecs, fargate_cluster_name, available_game_servers, total_game_servers, settings, now=None,
+             location=None):
+    if now == None:
+        now = time.time()
+
+    stopped = stop_drained_tasks(redis_client, ecs, fargate_cluster_name, now, location)
+
+    # Rate limit the checks and don't scale in right after scaling out
+    if redis_client.exists(LAST_SCALE_OUT_KEY + registry.location_suffix(location)):
+        return stopped
+    if not redis_client.set(LAST_SCALE_IN_KEY + registry.location_suffix(location), repr(now), ex=scale_in_interval, nx=True):
+        return stopped
+
+    excess = excess_game_servers(available_game_servers, total_game_servers, settings)
+    tasks_to_drain = min(max_tasks_to_drain, excess // settings["containers_in_task"])
+    metrics.put("ExcessGameServers", excess)
+    if tasks_to_drain <= 0:
+        return stopped
+
+    drained = 0
+    for task_id in find_idle_tasks(redis_client, now, location):
+        if drained >= tasks_to_drain:
+            break
+        if registry.drain_task(redis_client, task_id, drain_timeout, now, location) > 0:
+            redis_client.zadd(registry.draining_tasks_key(location), { task_id: now })
+            drained += 1
+    metrics.put("DrainingTasks", drained)
+    return stopped
+
+# Stop the Tasks of the location that have been draining for drain_wait seconds and are still idle
+def stop_drained_tasks(redis_client, ecs, fargate_cluster_name, now, location=None):
+    stopped = 0
+    for task_id in redis_client.zrangebyscore(registry.draining_tasks_key(location), "-inf", now - drain_wait):
+        task_id = registry.to_str(task_id)
+        redis_client.zrem(registry.draining_tasks_key(location), task_id)
+        if registry.release_drained_task(redis_client, task_id, drain_timeout, now, location) == 0:
+            metrics.logger.info("Task %s got players while draining, released back to the fleet", task_id)
+            continue
+        metrics.logger.info("Stopping idle Task %s", task_id)
+        with metrics.timer("EcsStopTaskTime"):
+            response = ecs.stop_task(cluster=fargate_cluster_name, task=task_id, reason="Scaled in by the scaler")
+        # The Task is not counted anymore, the inventory is updated from its events after this
+        if "task" in response:
+            inventory.record_task(redis_client, response["task"], now, location)
+        stopped += 1
+    metrics.put("StoppedTasks", stopped)
+    return stopped
+
+# Release all the draining Tasks of the location back to the fleet (when the scaler needs more capacity)
+def release_draining_tasks(redis_client, location=None):
+    task_ids = redis_client.zrange(registry.draining_tasks_key(location), 0, -1)
+    if len(task_ids) == 0:
+        return
+    with redis_client.pipeline(transaction=False) as pipe:
+        for task_id in task_ids:
+            pipe.delete(registry.draining_key(task_id))
+            pipe.zrem(registry.draining_tasks_key(location), task_id)
+        pipe.execute()
+    metrics.logger.info("Released %d draining Tasks back to the fleet", len(task_ids))
+
+# Get the Tasks of the location that have all their live game servers available, the ones that already hosted sessions first
+def find_idle_tasks(redis_client, now, location=None):
+    available_by_task = {}
+    with redis_client.pipeline(transaction=False) as pipe:
+        for shard in range(registry.shards):
+            for state in [registry.AVAILABLE_PRIORITY, registry.AVAILABLE]:
+                pipe.zrangebyscore(registry.index_key(state, shard, location), "(" + repr(now), "+inf")
+        available = pipe.execute()
+    for server_ids in available:
+        for server_id in server_ids:
+            task_id = registry.task_of(server_id)
+            available_by_task[task_id] = available_by_task.get(task_id, 0) + 1
+    task_ids = list(available_by_task.keys())
+    with redis_client.pipeline(transaction=False) as pipe:
+        for task_id in task_ids:
+            pipe.zcount(registry.task_key(task_id), "(" + repr(now), "+inf")
+        live_counts = pipe.execute()
+    return [task_id for task_id, live in zip(task_ids, live_counts) if live > 0 and live == available_by_task[task_id]]
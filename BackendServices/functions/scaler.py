@@ -1,20 +1,25 @@
-import json
-import datetime
+import math
 import time
-import os
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
 import redis
-from datetime import timedelta
-
-# Containers in a single Task (this is configured also outside of the Lambda so update as needed!)
+import backend
+import inventory
+import launcher
+import locations
+import metrics
+import scalein
+import registry
+import scalingpolicy
+
+# Containers in a single Task. Only used until the Task inventory has seen a Task of the Task Definition
+# (the inventory records the containers of each Task Definition from the Tasks, see inventory.py)
 containers_in_task = 10
 
 # We want to keep at least X available game servers running
 total_game_servers_target_min = 30
 
-# Hard limit for max amount of servers to start at once to avoid hitting API throttling (this is containers not Tasks so with 10 containers per task, max of 30 would be 3 Tasks)
-max_game_servers_to_start = 30
+# Hard limit for max amount of servers to start at once (this is containers not Tasks so with 10 containers per task, max of 500 would be 50 Tasks)
+# The Tasks are started with concurrent calls that back off on API throttling (see launcher.py)
+max_game_servers_to_start = 500
 
 # We want to keep 20% excess capacity to current load
 available_game_servers_target_percentage = 0.2
@@ -25,28 +30,35 @@ max_players = 2
 # The amount of seconds we give servers to start up
 server_startup_grace_period = 60
 
+# Seconds the players of a ticket served by the scaler have to connect before their reservation is released
+reservation_timeout = 30.0
+
+# The scaling policy to use: "percentage" keeps the target percentage of available game servers,
+# "predictive" forecasts the demand from the session request rate and starts capacity ahead of it
+# (using the percentage policy as the fallback)
+scaling_policy = "predictive"
+
+# Drain and stop idle Tasks when there are more available game servers than needed (see scalein.py)
+scale_in_enabled = True
+
+# How many startup periods ahead the predictive policy forecasts the demand
+forecast_startup_periods = 2
+
 def lambda_handler(event, context):
 
-    print("Running scheduled Lambda function to start new game server tasks when necessary")
+    # The metrics of all the rounds are written as a single record when the invocation is done
+    metrics.begin("Scaler")
+    try:
+        run_scaler()
+    finally:
+        metrics.flush()
 
-    # Get the resources from ECS and Task CLoudFormation Stacks from environment variables
-    fargate_cluster_name = os.environ['FARGATE_CLUSTER_NAME'] 
-    subnet1 = os.environ['SUBNET_1']
-    subnet2 = os.environ['SUBNET_2']
-    fargate_task_definition = ""
-    security_group = os.environ['SECURITY_GROUP']
-    redis_endpoint = os.environ['REDIS_ENDPOINT']
+def run_scaler():
 
-    cloudformation = boto3.client("cloudformation")
-    # Get the Task to deploy (as this changes dynamically)
-    stack = cloudformation.describe_stacks(StackName="fargate-game-servers-task-definition")["Stacks"][0]
-    for output in stack["Outputs"]:
-        print('%s=%s (%s)' % (output["OutputKey"], output["OutputValue"], output["Description"]))
-        if output["OutputKey"] == "TaskDefinition":
-            fargate_task_definition = output["OutputValue"]
+    metrics.logger.info("Running scheduled Lambda function to start new game server tasks when necessary")
 
-    # Setup Redis client
-    redis_client = redis.Redis(host=redis_endpoint, port=6379, db=0)
+    # Get the Redis client (reused between invocations)
+    redis_client = backend.get_redis_client()
 
     # Track start time
     start_time = time.time()
@@ -54,126 +66,169 @@ def lambda_handler(event, context):
     ### Run the scaler up to 60 seconds (next one will be triggered after 1 minute)
     while (time.time() - start_time) < 58.0:
 
-        try:
-
-            #  Get Task count in the Cluster for reference
-            #  We will use this to detect failing builds that don't report correctly back to Redis
-            #  Using Pagination to get all Tasks (even over 100)
-            ecs = boto3.client("ecs")
-            task_count = 0
-            response = ecs.list_tasks(cluster=fargate_cluster_name,launchType='FARGATE')
-            task_count += len(response["taskArns"])
-            while "nextToken" in response:
-                    response = ecs.list_tasks(cluster=fargate_cluster_name,launchType='FARGATE', nextToken=response["nextToken"])
-                    task_count += len(response["taskArns"])
-            expected_amount_of_game_servers = task_count * containers_in_task
-            print("Tasks running currently: " + str(task_count) + " Expecting game server count: " + str(expected_amount_of_game_servers))
-
-            # 1. Get the available priority, available, active and full servers (support up to 100k each) to calculate total sum
-            available_game_servers_response = redis_client.scan(count=100000,match="available-gameserver-*")
-            available_game_servers = len(available_game_servers_response[1])
-            available_priority_game_servers_response = redis_client.scan(count=100000,match="available-priority-gameserver-*")
-            available_priority_game_servers = len(available_priority_game_servers_response[1])
-            print("{ \"Available_priority_game_servers\" : \"" + str(available_priority_game_servers) + "\" }")
-            print("{ \"Available_game_servers\" : \"" + str(available_game_servers + available_priority_game_servers) + "\" }")
-            active_game_servers_response = redis_client.scan(count=100000,match="active-gameserver-*")
-            active_game_servers = len(active_game_servers_response[1])
-            print("{ \"Active_game_servers\" : \"" + str(active_game_servers) + "\" }")
-            full_game_servers_response = redis_client.scan(count=100000,match="full-gameserver-*")
-            full_game_servers = len(full_game_servers_response[1])
-            print("{ \"Full_game_servers\" : \"" + str(full_game_servers) + "\" }")
-
-            total_game_servers = available_game_servers + available_priority_game_servers + active_game_servers + full_game_servers
-
-            print("{ \"Total_game_servers\" : \"" + str(total_game_servers) + "\" }")
-
-            # If there's triple the amount of Tasks compared to registered game servers,
-            # we can safely say there's an issue in the game servers (not reporting to Redis)
-            # In this case we skip any new starts
-            if expected_amount_of_game_servers > (total_game_servers * 3):
-                print("ERROR: We are running over triple the amount of containers compared to registered game servers. Server Build is clearly broken.");
-                print("WILL NOT START NEW GAME SERVERS TO AVOID COST OVERLOAD!")
-                time.sleep(1)
-                continue
-
-            # Calculate the 0-1 percentage value of available game servers
-            percentage_available = 0.0
-            if total_game_servers > 0:
-                percentage_available = float(available_game_servers + available_priority_game_servers) / float(total_game_servers)
-            print("{ \"Percentage_available\" : \"" + str(percentage_available) + "\" }")
-
-            # Spin up the missing servers and make sure we have at least minimum
-            if percentage_available < available_game_servers_target_percentage or total_game_servers < total_game_servers_target_min:
-                amount_to_start = int((available_game_servers_target_percentage - percentage_available) * total_game_servers)
-                print("planning to start game servers amount:" + str(amount_to_start))
-                # Make sure we have minimum of 1 server started as low capacity was identified
-                if amount_to_start == 0:
-                    amount_to_start = 1
-                    print("clamping value to minimum of 1 started game servers")
-                # Make sure we have the baseline at least running
-                if total_game_servers < total_game_servers_target_min:
-                    amount_to_start = total_game_servers_target_min - total_game_servers
-                    print("setting amount to start to get minimum baseline amount running: " + str(amount_to_start))
-
-                # Don't start more than our hard limit
-                if amount_to_start > max_game_servers_to_start:
-                    amount_to_start = max_game_servers_to_start
-                    print("limiting to max game servers to start on a single update hard limit: " + str(amount_to_start))
-
-                # Divide amount to start with the amount of containers we have in a single Task
-                was_more_than_zero = amount_to_start > 0
-                amount_to_start  = int(amount_to_start / containers_in_task)
-                print("Divided by the amount of containers we know to be in a single task: " + str(amount_to_start))
-
-                if amount_to_start == 0 and was_more_than_zero:
-                    print("Starting at least one Task as we needed one more game server")
-                    amount_to_start = 1
-
-                # Start a game server Fargate Task for each missing game server in batches of 10 (default soft limit, a quota increase can be requested)
-                rounds = int(amount_to_start / 10) + 1
-                print("Starting " + str(amount_to_start) + " Tasks in " + str(rounds) + " rounds")
-                for i in range(rounds):
-                    start_this_round = 10
-                    # Last round we start the remaining tasks
-                    if i == rounds-1:
-                        start_this_round = amount_to_start % 10
-                    print("Starting " + str(start_this_round) + " Tasks")
-                    if start_this_round > 0:
-                        client = boto3.client('ecs')
-                        response = client.run_task(
-                            cluster=fargate_cluster_name,
-                            launchType = 'FARGATE',
-                            taskDefinition=fargate_task_definition,
-                            count = start_this_round,
-                            platformVersion='1.4.0',
-                            networkConfiguration={
-                                'awsvpcConfiguration': {
-                                    'subnets': [
-                                        subnet1,
-                                        subnet2
-                                    ],
-                                    'assignPublicIp': 'ENABLED',
-                                    'securityGroups': [
-                                        security_group
-                                    ],
-                                }
-                            }
-                        )
-                        # Extract Task info from response and prepopulate Redis to match the capacity (game servers will take over after this)
-                        for task in response["tasks"]:
-                            #print(task)
-                            # Add all the containers in Task as individual game servers
-                            for i in range(0,len(task["containers"])):
-                                container_key = "available-gameserver-"+task["taskArn"]+"-container"+str(i);
-                                redis_client.hset(container_key, "server-id", task["taskArn"]+"-container"+str(i))
-                                redis_client.hset(container_key, "current-players", 0)
-                                redis_client.hset(container_key, "max-players", max_players)
-                                redis_client.hset(container_key, "ready", 0) #Server will define itself ready when it's started
-                                # Expire in 60 seconds (wait for server to start up)
-                                redis_client.expire(container_key, timedelta(seconds=server_startup_grace_period))
-        except:
-            print("Exception occured in starting Tasks")
+        # Scale each location (ECS cluster) separately, a failing location doesn't stop the others
+        reporting = True
+        for location in locations.locations:
+            try:
+                with metrics.dimensions(**location_dimensions(location["name"])):
+                    if not scale_location(redis_client, location):
+                        reporting = False
+            except redis.exceptions.ConnectionError:
+                # Reconnect to Redis on the next round
+                metrics.logger.error("Exception occured in connecting to Redis")
+                metrics.add("RedisConnectionErrors")
+                backend.reset_redis_client()
+                redis_client = backend.get_redis_client()
+            except Exception as e:
+                metrics.logger.error("Exception occured in starting Tasks in %s: %s", location["name"], e)
+                metrics.add("Errors")
+                # Create the AWS SDK clients again on the next round in case the error came from a broken client
+                backend.reset_aws_clients()
+        if not reporting:
+            time.sleep(1)
+            continue
         # Wait for next round unless this was the last on this minute
         if time.time() - start_time < 58.0:
-            print("Wait 2 seconds before next round")
-            time.sleep(2.0)
\ No newline at end of file
+            metrics.logger.debug("Wait 2 seconds before next round")
+            time.sleep(2.0)
+
+# The metrics of the default location have no dimensions (the same metrics as without locations),
+# the metrics of the other locations have the Location dimension
+def location_dimensions(location):
+    if registry.location_suffix(location) == "":
+        return {}
+    return { "Location": location }
+
+# Runs a scaling round in the location with its ECS cluster (in its Region), network configuration and Task Definition
+def scale_location(redis_client, location):
+    ecs = backend.get_aws_client("ecs", location.get("region"))
+    # Get the Task to deploy (as this changes dynamically, cached for a few minutes between invocations). Only locations
+    # in the Region of the backend can use its Task Definition, the others always have their own (see locations.py)
+    fargate_task_definition = location.get("taskDefinition") or backend.get_task_definition()
+    return scaling_round(redis_client, ecs, location["cluster"], fargate_task_definition, location["subnets"],
+                         location["securityGroup"], location["name"], location.get("minGameServers"),
+                         locations.receives_task_events(location))
+
+# Runs a single round of the scaler in the location: checks the game server counts in Redis and starts new Tasks when needed
+# The minimum amount of game servers can be set for the location (total_game_servers_target_min if not set)
+# task_events tells if the ECS Task state change events of the location are delivered to the backend
+# Returns False if the game servers don't seem to be reporting to Redis and we skipped starting new ones
+def scaling_round(redis_client, ecs, fargate_cluster_name, fargate_task_definition, subnets, security_group, location=None,
+                  min_game_servers=None, task_events=True):
+
+    # Reconcile the Task inventory with ECS every few minutes (in case Task state change events were lost)
+    # Without the events (locations in other Regions) the inventory is reconciled more often instead
+    interval = inventory.reconcile_interval if task_events else inventory.remote_reconcile_interval
+    inventory.reconcile_if_due(redis_client, ecs, fargate_cluster_name, location=location, interval=interval)
+
+    with metrics.timer("RedisCountTime"):
+        # Get the Task count and the containers in the Tasks of the location from the Task inventory for reference
+        # We will use this to detect failing builds that don't report correctly back to Redis
+        task_counts = inventory.get_counts(redis_client, fargate_task_definition, location)
+
+        # Release the expired reservations of clients that never connected so the slots are free for placements again
+        released_reservations = registry.sweep_reservations(redis_client, location=location)
+
+        # Serve the queued tickets with the released slots (the game servers serve them as well after their heartbeats)
+        served_tickets = registry.serve_tickets(redis_client, reservation_timeout, location=location)
+
+        # 1. Get the amount of available priority, available, active and full servers from the indexes to calculate total sum
+        server_counts = registry.count_servers(redis_client, location=location)
+
+        # Players waiting in the matchmaking ticket queue (the tickets of players that gave up have expired)
+        queued_tickets = registry.count_tickets(redis_client, location=location)
+
+    task_count = task_counts["tasks"]
+    expected_amount_of_game_servers = task_counts["containers"]
+    metrics.logger.debug("Tasks running currently: %d Expecting game server count: %d", task_count, expected_amount_of_game_servers)
+    task_containers = task_counts["containers_in_task"] or containers_in_task
+
+    # Settings for the scaling policies
+    scaling_settings = {
+        "total_game_servers_target_min": total_game_servers_target_min if min_game_servers == None else min_game_servers,
+        "available_game_servers_target_percentage": available_game_servers_target_percentage,
+        "server_startup_grace_period": server_startup_grace_period,
+        "forecast_startup_periods": forecast_startup_periods,
+        "containers_in_task": task_containers,
+        "location": location
+    }
+
+    available_game_servers = server_counts[registry.AVAILABLE]
+    available_priority_game_servers = server_counts[registry.AVAILABLE_PRIORITY]
+    active_game_servers = server_counts[registry.ACTIVE]
+    full_game_servers = server_counts[registry.FULL]
+    total_game_servers = available_game_servers + available_priority_game_servers + active_game_servers + full_game_servers
+
+    metrics.put("ReleasedReservations", released_reservations)
+    metrics.put("ServedTickets", served_tickets)
+    metrics.put("AvailablePriorityGameServers", available_priority_game_servers)
+    metrics.put("AvailableGameServers", available_game_servers + available_priority_game_servers)
+    metrics.put("ActiveGameServers", active_game_servers)
+    metrics.put("FullGameServers", full_game_servers)
+    metrics.put("TotalGameServers", total_game_servers)
+    metrics.put("QueuedTickets", queued_tickets)
+    metrics.put("RunningTasks", task_count)
+    metrics.put("PendingTasks", task_counts["pending"])
+
+    # If there's triple the amount of Tasks compared to registered game servers,
+    # we can safely say there's an issue in the game servers (not reporting to Redis)
+    # In this case we skip any new starts
+    if expected_amount_of_game_servers > (total_game_servers * 3):
+        metrics.logger.error("We are running over triple the amount of containers compared to registered game servers. Server Build is clearly broken. "
+                             "WILL NOT START NEW GAME SERVERS TO AVOID COST OVERLOAD!")
+        metrics.add("SkippedRounds")
+        return False
+
+    # Get the amount of game servers to start from the scaling policy
+    amount_to_start = scalingpolicy.policies[scaling_policy](redis_client, available_game_servers + available_priority_game_servers,
+                                                             total_game_servers, scaling_settings)
+
+    # Start game servers for the queued tickets that the available game servers (mostly still starting up) can't serve
+    servers_for_queue = int(math.ceil(queued_tickets / float(max_players))) - (available_game_servers + available_priority_game_servers)
+    if servers_for_queue > 0:
+        metrics.logger.info("starting game servers for the queued tickets: %d", servers_for_queue)
+        amount_to_start += servers_for_queue
+    if amount_to_start > 0:
+        # Don't start more than our hard limit
+        if amount_to_start > max_game_servers_to_start:
+            amount_to_start = max_game_servers_to_start
+            metrics.logger.info("limiting to max game servers to start on a single update hard limit: %d", amount_to_start)
+
+        # Divide amount to start with the amount of containers we have in a single Task
+        was_more_than_zero = amount_to_start > 0
+        amount_to_start  = int(amount_to_start / task_containers)
+        metrics.logger.debug("Divided by the amount of containers we know to be in a single task: %d", amount_to_start)
+
+        if amount_to_start == 0 and was_more_than_zero:
+            metrics.logger.debug("Starting at least one Task as we needed one more game server")
+            amount_to_start = 1
+
+        # Draining Tasks are capacity we can use right away and pause scale-in for the cooldown
+        scalein.release_draining_tasks(redis_client, location)
+        scalein.record_scale_out(redis_client, location=location)
+
+        # Start the Tasks with concurrent run_task calls that back off on throttling and capacity errors
+        # and prepopulate Redis with the containers to match the capacity (game servers will take over after this)
+        metrics.logger.info("Starting %d Tasks", amount_to_start)
+        launcher.launch_tasks(redis_client, ecs, amount_to_start, {
+            "cluster": fargate_cluster_name,
+            "launchType": 'FARGATE',
+            "taskDefinition": fargate_task_definition,
+            "platformVersion": '1.4.0',
+            "networkConfiguration": {
+                'awsvpcConfiguration': {
+                    'subnets': subnets,
+                    'assignPublicIp': 'ENABLED',
+                    'securityGroups': [
+                        security_group
+                    ],
+                }
+            }
+        }, max_players, server_startup_grace_period, location)
+
+    elif scale_in_enabled:
+        # Drain and stop idle Tasks if we have more available game servers than the target
+        scalein.scale_in(redis_client, ecs, fargate_cluster_name, available_game_servers + available_priority_game_servers,
+                         total_game_servers, scaling_settings, location=location)
+
+    return True
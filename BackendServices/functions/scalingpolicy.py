@@ -0,0 +1,137 @@
+import math
+import random
+import time
+import metrics
+import registry
+
+# Scaling policies for the scaler and the demand time series they use
+#
+# requestgamesession records every session request (and whether it was placed) in per-bucket Redis Hashes
+# ("demand-<bucket start time>") that expire after the history window. Each request is counted in the Hash of a random
+# registry shard so the counters of a busy bucket are spread over the cluster, and the scaler sums the shards. The predictive policy reads the series,
+# smooths it with double exponential smoothing (level + trend) and forecasts the demand over the time
+# it takes to start new Tasks, so that capacity is started before the players arrive.
+# Each location has its own demand series: a request is recorded in the location the client preferred the most.
+
+# Length of a single time series bucket in seconds
+bucket_seconds = 10
+
+# How many buckets of history we keep and use for forecasting (5 minutes)
+history_buckets = 30
+
+# Smoothing factors for the level and the trend of the request rate
+level_smoothing = 0.5
+trend_smoothing = 0.3
+
+# Ignore forecasts when there's less demand than this (requests per second) as the estimates are just noise then
+minimum_request_rate = 0.05
+
+def bucket_key(bucket, shard, location=None):
+    return registry.shard_tag(shard) + "demand-" + str(int(bucket)) + registry.location_suffix(location)
+
+# Record a session request for the given amount of players to the demand time series of the location
+# Called by requestgamesession
+def record_session_request(redis_client, placed, players=1, now=None, location=None):
+    if now == None:
+        now = time.time()
+    key = bucket_key(now - now % bucket_seconds, random.randrange(registry.shards), location)
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hincrby(key, "requests", players)
+        if placed:
+            pipe.hincrby(key, "placements", players)
+        pipe.expire(key, bucket_seconds * (history_buckets + 1))
+        pipe.execute()
+
+# Get the request and placement rates (per second) of the location in the completed buckets of the history window,
+# oldest first
+def get_demand_history(redis_client, now=None, location=None):
+    if now == None:
+        now = time.time()
+    current_bucket = now - now % bucket_seconds
+    buckets = [current_bucket - bucket_seconds * i for i in range(history_buckets, 0, -1)]
+    with redis_client.pipeline(transaction=False) as pipe:
+        for bucket in buckets:
+            for shard in range(registry.shards):
+                pipe.hmget(bucket_key(bucket, shard, location), "requests", "placements")
+        responses = pipe.execute()
+    history = []
+    for i in range(len(buckets)):
+        shard_counts = responses[i * registry.shards:(i + 1) * registry.shards]
+        requests = sum(int(count[0] or 0) for count in shard_counts)
+        placements = sum(int(count[1] or 0) for count in shard_counts)
+        history.append((requests / float(bucket_seconds), placements / float(bucket_seconds)))
+    return history
+
+# Forecast the rate horizon seconds ahead with double exponential smoothing (Holt's linear trend method)
+# Returns the smoothed current rate and the forecasted rate
+def forecast_rate(rates, horizon):
+    if len(rates) == 0:
+        return 0.0, 0.0
+    level = rates[0]
+    trend = 0.0
+    for rate in rates[1:]:
+        previous_level = level
+        level = level_smoothing * rate + (1.0 - level_smoothing) * (level + trend)
+        trend = trend_smoothing * (level - previous_level) + (1.0 - trend_smoothing) * trend
+    forecast = level + trend * (horizon / float(bucket_seconds))
+    return max(level, 0.0), max(forecast, 0.0)
+
+# The reactive policy: keep the target percentage of available game servers and the minimum amount of servers running
+# Returns the amount of game servers to start
+def percentage_policy(redis_client, available_game_servers, total_game_servers, settings):
+
+    # Calculate the 0-1 percentage value of available game servers
+    percentage_available = 0.0
+    if total_game_servers > 0:
+        percentage_available = float(available_game_servers) / float(total_game_servers)
+    metrics.put("PercentageAvailable", percentage_available, "None")
+
+    # Spin up the missing servers and make sure we have at least minimum
+    amount_to_start = 0
+    target_percentage = settings["available_game_servers_target_percentage"]
+    target_min = settings["total_game_servers_target_min"]
+    if percentage_available < target_percentage or total_game_servers < target_min:
+        amount_to_start = int((target_percentage - percentage_available) * total_game_servers)
+        metrics.logger.debug("planning to start game servers amount: %d", amount_to_start)
+        # Make sure we have minimum of 1 server started as low capacity was identified
+        if amount_to_start == 0:
+            amount_to_start = 1
+            metrics.logger.debug("clamping value to minimum of 1 started game servers")
+        # Make sure we have the baseline at least running
+        if total_game_servers < target_min:
+            amount_to_start = target_min - total_game_servers
+            metrics.logger.debug("setting amount to start to get minimum baseline amount running: %d", amount_to_start)
+    return amount_to_start
+
+# The predictive policy: forecast the session requests over the time it takes to start new game servers and start
+# the capacity needed for that demand now. The percentage policy is used as the fallback (we always start at least that)
+def predictive_policy(redis_client, available_game_servers, total_game_servers, settings):
+
+    amount_to_start = percentage_policy(redis_client, available_game_servers, total_game_servers, settings)
+
+    # Forecast the request rate for when the Tasks started now are ready (by default two startup periods ahead)
+    horizon = settings["server_startup_grace_period"] * settings["forecast_startup_periods"]
+    with metrics.timer("RedisDemandTime"):
+        history = get_demand_history(redis_client, location=settings.get("location"))
+    current_rate, forecasted_rate = forecast_rate([requests for requests, placements in history], horizon)
+    metrics.put("RequestRate", current_rate, "Count/Second")
+    metrics.put("ForecastedRequestRate", forecasted_rate, "Count/Second")
+    if current_rate < minimum_request_rate:
+        return amount_to_start
+
+    # The amount of busy game servers grows with the request rate (Little's law with the current session length),
+    # so we expect busy_game_servers * forecasted_rate / current_rate busy game servers at the horizon
+    busy_game_servers = total_game_servers - available_game_servers
+    forecasted_busy_game_servers = busy_game_servers * forecasted_rate / current_rate
+    # And we still want to keep the target percentage available on top of that
+    needed_game_servers = int(math.ceil(forecasted_busy_game_servers / (1.0 - settings["available_game_servers_target_percentage"])))
+    predicted_amount_to_start = needed_game_servers - total_game_servers
+    metrics.logger.debug("Forecasted busy game servers: %s predicted amount to start: %d", forecasted_busy_game_servers, predicted_amount_to_start)
+
+    return max(amount_to_start, predicted_amount_to_start)
+
+# The available scaling policies by name
+policies = {
+    "percentage": percentage_policy,
+    "predictive": predictive_policy
+}
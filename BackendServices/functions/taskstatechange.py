@@ -0,0 +1,41 @@
+import backend
+import inventory
+import locations
+import metrics
+
+# Updates the Task inventory of the scaler from the ECS Task state change events (delivered by EventBridge)
+#
+# The events of the clusters that are not game server locations are ignored. Events can arrive late and out of order,
+# the inventory keeps the newest version of each Task (see inventory.py)
+
+def lambda_handler(event, context):
+
+    # The metrics of the event are written as a single record when it's done
+    metrics.begin("TaskStateChange")
+    try:
+        return handle_event(event)
+    finally:
+        metrics.flush()
+
+def handle_event(event):
+
+    detail = (event or {}).get("detail") or {}
+    location = locations.location_of_cluster(detail.get("clusterArn"))
+    if location == None or detail.get("taskArn") == None:
+        metrics.logger.debug("Ignoring the event of Task %s in cluster %s", detail.get("taskArn"), detail.get("clusterArn"))
+        metrics.add("IgnoredTaskEvents")
+        return False
+
+    # Get the Redis client (reused between invocations)
+    redis_client = backend.get_redis_client()
+
+    metrics.logger.debug("Task %s in %s is %s (desired %s, version %s)", detail["taskArn"], location, detail.get("lastStatus"),
+                         detail.get("desiredStatus"), detail.get("version"))
+    with metrics.timer("RedisInventoryTime"):
+        updated = inventory.record_task(redis_client, detail, location=location)
+    if updated:
+        metrics.add("TaskEvents")
+    else:
+        metrics.logger.debug("Ignoring an outdated event of Task %s", detail["taskArn"])
+        metrics.add("OutdatedTaskEvents")
+    return updated
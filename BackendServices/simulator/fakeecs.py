@@ -0,0 +1,105 @@
+import copy
+import itertools
+import threading
+
+from botocore.exceptions import ClientError
+
+# A stand-in for the ECS API used by the scaler (boto3 ECS client interface) that keeps the Tasks in memory
+# Tasks are started with all their containers and the simulator decides when they boot and stop
+# throttle_every makes every Nth run_task call fail with a ThrottlingException and capacity limits the running Tasks
+# (Tasks over the limit are returned as failures like when Fargate has no capacity) to test the scaler against them
+# Every change of the state of a Task is added to events as an ECS Task state change event (like EventBridge delivers
+# them) that the tests and the simulator pass to the taskstatechange function
+
+class FakeECS:
+
+    def __init__(self, containers_in_task, on_task_started=None, page_size=100, throttle_every=0, capacity=None,
+                 on_task_stopped=None):
+        self.containers_in_task = containers_in_task
+        self.throttle_every = throttle_every
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.on_task_started = on_task_started
+        self.on_task_stopped = on_task_stopped
+        self.page_size = page_size
+        self.tasks = {}
+        self.task_ids = itertools.count()
+        self.calls = { "run_task": 0, "list_tasks": 0, "stop_task": 0, "describe_tasks": 0 }
+        self.events = []
+
+    def run_task(self, cluster, taskDefinition, count=1, **kwargs):
+        with self.lock:
+            self.calls["run_task"] += 1
+            if count > 10:
+                raise ClientError({ "Error": { "Code": "InvalidParameterException", "Message": "count > 10" } }, "RunTask")
+            if self.throttle_every > 0 and self.calls["run_task"] % self.throttle_every == 0:
+                raise ClientError({ "Error": { "Code": "ThrottlingException", "Message": "Rate exceeded" } }, "RunTask")
+            return self.start_tasks(cluster, taskDefinition, count)
+
+    def start_tasks(self, cluster, taskDefinition, count):
+        tasks = []
+        failures = []
+        for i in range(count):
+            if self.capacity != None and len(self.running_tasks()) >= self.capacity:
+                failures.append({ "reason": "Capacity is unavailable at this time. Please try again later or in a different availability zone" })
+                continue
+            task_arn = "arn:aws:ecs:local:000000000000:task/" + cluster + "/" + str(next(self.task_ids))
+            task = {
+                "taskArn": task_arn,
+                "clusterArn": "arn:aws:ecs:local:000000000000:cluster/" + cluster,
+                "taskDefinitionArn": taskDefinition,
+                "lastStatus": "PROVISIONING",
+                "desiredStatus": "RUNNING",
+                "version": 1,
+                "containers": [{ "name": "GameServer" + str(c) } for c in range(self.containers_in_task)]
+            }
+            self.tasks[task_arn] = task
+            self.add_event(task)
+            tasks.append(task)
+            if self.on_task_started != None:
+                self.on_task_started(task)
+        return { "tasks": tasks, "failures": failures }
+
+    def list_tasks(self, cluster, nextToken=None, **kwargs):
+        self.calls["list_tasks"] += 1
+        task_arns = sorted(arn for arn, task in self.tasks.items() if task["lastStatus"] != "STOPPED")
+        start = int(nextToken or 0)
+        response = { "taskArns": task_arns[start:start + self.page_size] }
+        if start + self.page_size < len(task_arns):
+            response["nextToken"] = str(start + self.page_size)
+        return response
+
+    def describe_tasks(self, cluster, tasks):
+        self.calls["describe_tasks"] += 1
+        return { "tasks": [copy.deepcopy(self.tasks[arn]) for arn in tasks if arn in self.tasks],
+                 "failures": [{ "arn": arn, "reason": "MISSING" } for arn in tasks if arn not in self.tasks] }
+
+    def stop_task(self, cluster, task, reason=""):
+        self.calls["stop_task"] += 1
+        was_running = self.tasks[task]["lastStatus"] != "STOPPED"
+        self.set_status(task, "STOPPED")
+        if was_running and self.on_task_stopped != None:
+            self.on_task_stopped(self.tasks[task])
+        return { "task": self.tasks[task] }
+
+    # Change the last status of the Task (for example to RUNNING once its containers have started)
+    def set_status(self, task_arn, status):
+        task = self.tasks[task_arn]
+        task["lastStatus"] = status
+        if status == "STOPPED":
+            task["desiredStatus"] = "STOPPED"
+        task["version"] += 1
+        self.add_event(task)
+
+    def add_event(self, task):
+        self.events.append({ "source": "aws.ecs", "detail-type": "ECS Task State Change", "region": "local",
+                             "detail": copy.deepcopy(task) })
+
+    # Get the events added since the previous call
+    def take_events(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    def running_tasks(self):
+        return [task for task in self.tasks.values() if task["lastStatus"] != "STOPPED"]
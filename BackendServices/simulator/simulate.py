@@ -0,0 +1,327 @@
+import argparse
+import contextlib
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from unittest import mock
+
+import fakeredis
+
+# Discrete-event simulator for tuning the scaler and matchmaking settings without running real Fargate Tasks
+#
+# Runs the real scaler decision logic (scaler.scaling_round), requestgamesession placement, updateredis heartbeats
+# and checktaskstatus against an in-process Redis stand-in (fakeredis) and a fake ECS. Time is simulated: time.time()
+# returns the simulation clock, so Redis TTLs, reservations and the demand time series all follow simulated time.
+#
+# Run from the BackendServices folder, for example:
+#   python -m simulator.simulate --duration 3600 --base-rate 0.2 --peak-rate 3
+#   python -m simulator.simulate --trace arrivals.txt --target-percentage 0.3
+# A trace file contains the arrival time of one player per line in seconds from the start of the simulation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "functions"))
+
+import scaler
+import requestgamesession
+import updateredis
+import checktaskstatus
+import taskstatechange
+import backend
+import locations
+import registry
+from simulator.fakeecs import FakeECS
+
+# Defaults of the simulated game server and player behaviour
+default_settings = {
+    "boot_time": 40.0,               # Seconds from run_task until the game server is ready
+    "restart_time": 5.0,             # Seconds for a game server to restart between sessions
+    "session_length": 300.0,         # Average length of a game session in seconds
+    "max_sessions": 3,               # Game sessions a game server hosts before terminating (Server.totalGameSessionsToHost)
+    "heartbeat_interval": 15.0,      # Server.redisUpdateIntervalSeconds
+    "termination_check_interval": 5.0,
+    "connect_delay": 1.0,            # Seconds from getting a placement to connecting to the game server
+    "retry_interval": 2.0,           # Seconds a client waits before requesting a game session again
+    "give_up_after": 60.0,           # Seconds after which a client gives up
+    "scaler_interval": 2.0,
+    "seed": 1
+}
+
+# Simulation starts at a fixed epoch time so that the runs are reproducible
+start_epoch = 1600000000.0
+
+class GameServer:
+
+    def __init__(self, simulation, task_arn, task_number, container):
+        self.simulation = simulation
+        self.task_arn = task_arn
+        self.server_id = task_arn + "-container" + str(container)
+        self.public_ip = "10.%d.%d.%d" % (task_number // 65536 % 256, task_number // 256 % 256, task_number % 256)
+        self.port = 7777 + container
+        self.players = 0
+        self.ready = False
+        self.sessions_hosted = 0
+        self.waiting_for_termination = False
+        self.exited = False
+
+    def boot(self):
+        if self.exited:
+            return
+        self.ready = True
+        self.heartbeat()
+        self.simulation.schedule(self.simulation.settings["heartbeat_interval"], self.periodic_heartbeat)
+
+    def periodic_heartbeat(self):
+        if self.exited or self.waiting_for_termination:
+            return
+        self.heartbeat()
+        self.simulation.schedule(self.simulation.settings["heartbeat_interval"], self.periodic_heartbeat)
+
+    def heartbeat(self, terminated=False):
+        max_players = scaler.max_players
+        updateredis.lambda_handler({
+            "serverInUse": self.ready and self.players >= max_players,
+            "taskArn": self.server_id,
+            "currentPlayers": self.players,
+            "maxPlayers": max_players,
+            "ready": self.ready,
+            "publicIP": self.public_ip,
+            "port": self.port,
+            "serverTerminated": terminated
+        }, None)
+
+    def connect(self):
+        if self.exited or not self.ready or self.players >= scaler.max_players or self.waiting_for_termination or self.exited:
+            return False
+        self.players += 1
+        if self.players == 1:
+            length = random.expovariate(1.0 / self.simulation.settings["session_length"])
+            self.simulation.schedule(length, self.end_session)
+        # A new player joined, update Redis as well
+        self.heartbeat()
+        return True
+
+    def end_session(self):
+        if self.exited:
+            return
+        self.players = 0
+        self.sessions_hosted += 1
+        if self.sessions_hosted >= self.simulation.settings["max_sessions"]:
+            self.heartbeat(terminated=True)
+            self.waiting_for_termination = True
+            self.simulation.schedule(0.0, self.check_termination)
+        else:
+            self.ready = False
+            self.heartbeat()
+            self.simulation.schedule(self.simulation.settings["restart_time"], self.restart)
+
+    def restart(self):
+        if self.exited:
+            return
+        self.ready = True
+        self.heartbeat()
+
+    def check_termination(self):
+        if self.exited:
+            return
+        if checktaskstatus.lambda_handler({ "taskArn": self.task_arn }, None):
+            self.exited = True
+            self.simulation.container_exited(self.task_arn)
+        else:
+            self.simulation.schedule(self.simulation.settings["termination_check_interval"], self.check_termination)
+
+class Simulation:
+
+    def __init__(self, settings):
+        self.settings = dict(default_settings)
+        self.settings.update(settings)
+        self.now = start_epoch
+        self.events = []
+        self.sequence = itertools.count()
+        self.redis_client = fakeredis.FakeRedis()
+        self.ecs = FakeECS(scaler.containers_in_task, on_task_started=self.task_started, on_task_stopped=self.task_stopped)
+        self.task_numbers = itertools.count()
+        self.game_servers = {}
+        self.servers_by_task = {}
+        self.placement_times = []
+        self.players = 0
+        self.failed_players = 0
+        self.failed_connections = 0
+        self.container_seconds = 0.0
+        self.idle_container_seconds = 0.0
+        self.peak_tasks = 0
+        random.seed(self.settings["seed"])
+
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), callback, args))
+
+    def task_started(self, task):
+        task_number = next(self.task_numbers)
+        servers = [GameServer(self, task["taskArn"], task_number, c) for c in range(len(task["containers"]))]
+        self.schedule(self.settings["boot_time"], self.task_running, task["taskArn"])
+        self.servers_by_task[task["taskArn"]] = servers
+        for server in servers:
+            self.game_servers[(server.public_ip, str(server.port))] = server
+            self.schedule(self.settings["boot_time"], server.boot)
+
+    def task_running(self, task_arn):
+        if self.ecs.tasks[task_arn]["lastStatus"] != "STOPPED":
+            self.ecs.set_status(task_arn, "RUNNING")
+
+    # The Task was stopped (all its game servers are done or the scaler scaled it in), its game servers exit
+    def task_stopped(self, task):
+        for server in self.servers_by_task[task["taskArn"]]:
+            server.exited = True
+
+    def container_exited(self, task_arn):
+        if all(server.exited for server in self.servers_by_task[task_arn]):
+            self.ecs.stop_task(cluster="simulated-cluster", task=task_arn, reason="All game servers done")
+
+    def scaler_tick(self):
+        # Deliver the Task state change events since the previous tick to the Task inventory
+        for event in self.ecs.take_events():
+            taskstatechange.lambda_handler(event, None)
+        try:
+            scaler.scaling_round(self.redis_client, self.ecs, "simulated-cluster", "simulated-task-definition", ["subnet"], "security-group")
+        except Exception as e:
+            print("Exception occured in starting Tasks: " + str(e))
+
+        # Account the container time since the previous tick
+        running_tasks = self.ecs.running_tasks()
+        self.peak_tasks = max(self.peak_tasks, len(running_tasks))
+        for task in running_tasks:
+            for server in self.servers_by_task[task["taskArn"]]:
+                if not server.exited:
+                    self.container_seconds += self.settings["scaler_interval"]
+                    if server.players == 0:
+                        self.idle_container_seconds += self.settings["scaler_interval"]
+        self.schedule(self.settings["scaler_interval"], self.scaler_tick)
+
+    def player_arrives(self):
+        self.players += 1
+        self.request_game_session(self.now)
+
+    def request_game_session(self, arrival_time, ticket_id=None):
+        event = {}
+        if ticket_id != None:
+            # Check the queued ticket (the simulated client polls without waiting in the request)
+            event = { "queryStringParameters": { "ticketId": ticket_id } }
+        response = requestgamesession.lambda_handler(event, None)
+        if response["statusCode"] == 200:
+            self.placement_times.append(self.now - arrival_time)
+            placement = json.loads(response["body"])
+            self.schedule(self.settings["connect_delay"], self.connect, placement["publicIP"], placement["port"])
+            return
+        if response["statusCode"] == 202:
+            ticket_id = json.loads(response["body"])["ticketId"]
+        else:
+            ticket_id = None
+        if self.now - arrival_time + self.settings["retry_interval"] <= self.settings["give_up_after"]:
+            self.schedule(self.settings["retry_interval"], self.request_game_session, arrival_time, ticket_id)
+        else:
+            self.failed_players += 1
+
+    def connect(self, public_ip, port):
+        server = self.game_servers.get((public_ip, str(port)))
+        if server == None or not server.connect():
+            self.failed_connections += 1
+
+    def run(self, arrivals, duration):
+        for arrival in arrivals:
+            heapq.heappush(self.events, (start_epoch + arrival, next(self.sequence), self.player_arrives, ()))
+        self.schedule(0.0, self.scaler_tick)
+
+        end = start_epoch + duration
+        wall_start = time.perf_counter()
+        with mock.patch.dict(os.environ, { "REDIS_ENDPOINT": "simulated" }), \
+                mock.patch("time.time", lambda: self.now), mock.patch("time.sleep"), \
+                mock.patch.object(backend, "_redis_client", self.redis_client), \
+                mock.patch.object(locations, "locations", [{ "name": registry.default_location, "region": "local",
+                                                             "cluster": "simulated-cluster", "taskEvents": True }]), \
+                contextlib.redirect_stdout(open(os.devnull, "w")):
+            while len(self.events) > 0 and self.events[0][0] <= end:
+                event_time, sequence, callback, args = heapq.heappop(self.events)
+                self.now = event_time
+                callback(*args)
+        return self.results(duration, time.perf_counter() - wall_start)
+
+    def results(self, duration, wall_seconds):
+        ordered = sorted(self.placement_times)
+        def percentile(p):
+            if len(ordered) == 0:
+                return None
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+        return {
+            "players": self.players,
+            "placed": len(self.placement_times),
+            "failed": self.failed_players,
+            "placement_failure_rate": self.failed_players / float(max(self.players, 1)),
+            "failed_connections": self.failed_connections,
+            "time_to_placement_p50": percentile(0.5),
+            "time_to_placement_p90": percentile(0.9),
+            "time_to_placement_p99": percentile(0.99),
+            "container_hours": self.container_seconds / 3600.0,
+            "idle_container_hours": self.idle_container_seconds / 3600.0,
+            "tasks_started": len(self.ecs.tasks),
+            "peak_tasks": self.peak_tasks,
+            "simulated_seconds": duration,
+            "wall_seconds": wall_seconds
+        }
+
+# Synthetic player arrivals: a Poisson process with a rate that ramps from base_rate up to peak_rate
+# in the middle of the simulation and back down (like an evening peak)
+def synthetic_trace(duration, base_rate, peak_rate, seed):
+    generator = random.Random(seed)
+    arrivals = []
+    t = 0.0
+    while True:
+        # Thinning: generate with the peak rate and keep arrivals in proportion to the rate at that time
+        t += generator.expovariate(peak_rate)
+        if t >= duration:
+            return arrivals
+        rate = base_rate + (peak_rate - base_rate) * math.sin(math.pi * t / duration) ** 2
+        if generator.random() < rate / peak_rate:
+            arrivals.append(t)
+
+def load_trace(path):
+    with open(path) as trace:
+        return sorted(float(line) for line in trace if line.strip() != "")
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the scaler and matchmaking against a player arrival trace")
+    parser.add_argument("--trace", help="File with player arrival times (seconds from start), one per line")
+    parser.add_argument("--duration", type=float, default=3600.0, help="Simulated seconds")
+    parser.add_argument("--base-rate", type=float, default=0.2, help="Synthetic trace: players per second at start and end")
+    parser.add_argument("--peak-rate", type=float, default=2.0, help="Synthetic trace: players per second at the peak")
+    parser.add_argument("--boot-time", type=float, default=default_settings["boot_time"])
+    parser.add_argument("--session-length", type=float, default=default_settings["session_length"])
+    parser.add_argument("--max-sessions", type=int, default=default_settings["max_sessions"])
+    parser.add_argument("--seed", type=int, default=default_settings["seed"])
+    # Scaler settings to tune
+    parser.add_argument("--target-min", type=int, default=scaler.total_game_servers_target_min)
+    parser.add_argument("--target-percentage", type=float, default=scaler.available_game_servers_target_percentage)
+    parser.add_argument("--max-to-start", type=int, default=scaler.max_game_servers_to_start)
+    parser.add_argument("--policy", default=scaler.scaling_policy)
+    parser.add_argument("--placement-strategy", default=requestgamesession.placement_strategy, help="consolidate or spread")
+    args = parser.parse_args()
+
+    scaler.total_game_servers_target_min = args.target_min
+    scaler.available_game_servers_target_percentage = args.target_percentage
+    scaler.max_game_servers_to_start = args.max_to_start
+    scaler.scaling_policy = args.policy
+    requestgamesession.placement_strategy = args.placement_strategy
+
+    if args.trace != None:
+        arrivals = load_trace(args.trace)
+    else:
+        arrivals = synthetic_trace(args.duration, args.base_rate, args.peak_rate, args.seed)
+
+    simulation = Simulation({ "boot_time": args.boot_time, "session_length": args.session_length,
+                              "max_sessions": args.max_sessions, "seed": args.seed })
+    print(json.dumps(simulation.run(arrivals, args.duration), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+import redis
+
+# The Lambda functions are deployed from the functions folder and import each other as top level modules
+backend_services = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(backend_services, "functions"))
+sys.path.insert(0, backend_services)
+os.environ.setdefault("REDIS_ENDPOINT", "localhost")
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture()
+def redis_client(mocker):
+    """ Local Redis stand-in that every handler connects to"""
+
+    import backend
+
+    client = fakeredis.FakeRedis()
+    # Run the tests against a local Redis Cluster instead with REDIS_TEST_CLUSTER=<host>:<port> of one of its nodes
+    if os.environ.get("REDIS_TEST_CLUSTER"):
+        host, port = os.environ["REDIS_TEST_CLUSTER"].split(":")
+        client = redis.cluster.RedisCluster(host=host, port=int(port))
+        client.flushall()
+    mocker.patch("redis.Redis", return_value=client)
+    # The handlers reuse the client cached by backend between invocations
+    mocker.patch.object(backend, "_redis_client", client)
+    return client
+
+
+@pytest.fixture()
+def heartbeat():
+    """ Generates the event a game server sends to updateredis"""
+
+    def make_event(server_id, current_players=0, server_in_use=False, ready=True, terminated=False):
+        return {
+            "serverInUse": server_in_use,
+            "taskArn": server_id,
+            "currentPlayers": current_players,
+            "maxPlayers": 2,
+            "ready": ready,
+            "publicIP": "10.0.0.1",
+            "port": 1935,
+            "serverTerminated": terminated,
+        }
+
+    return make_event
@@ -0,0 +1,56 @@
+import json
+
+import admission
+import metrics
+import registry
+import requestgamesession
+import updateredis
+
+
+def player_request(player_id):
+    return {"requestContext": {"identity": {"cognitoIdentityId": player_id}}}
+
+
+def test_requests_over_the_rate_of_a_player_are_shed(redis_client, heartbeat):
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+
+    with metrics.capture() as records:
+        responses = [requestgamesession.lambda_handler(player_request("player1"), None) for i in range(int(admission.player_burst) + 1)]
+
+    assert [response["statusCode"] for response in responses[:-1]] == [200] * int(admission.player_burst)
+    shed = responses[-1]
+    assert shed["statusCode"] == 429
+    assert shed["headers"]["Retry-After"] == "1"
+    assert json.loads(shed["body"])["retryAfter"] == 1
+    assert records[-1]["ShedRequests"] == 1 and records[-1]["ShedPlayerRequests"] == 1
+    assert "ClaimAttempts" not in records[-1]
+    # Other players are not limited by the requests of the first one
+    assert requestgamesession.lambda_handler(player_request("player2"), None)["statusCode"] == 200
+
+
+def test_buckets_refill_over_time(redis_client):
+
+    for i in range(int(admission.player_burst)):
+        assert admission.admit_request(redis_client, "player1", now=1000.0) == None
+    assert admission.admit_request(redis_client, "player1", now=1000.0) == 1
+    assert admission.admit_request(redis_client, "player1", now=1000.0 + 1.0 / admission.player_rate) == None
+    # The bucket expires once it would be full again
+    assert 0 < redis_client.pttl(admission.player_bucket_key("player1")) <= (admission.player_burst / admission.player_rate + 1) * 1000
+
+
+def test_steady_game_server_updates_dont_shed_matchmaking(redis_client, heartbeat, mocker):
+
+    mocker.patch.object(admission, "shared_rate", 1.0)
+    mocker.patch.object(admission, "shared_burst", 5.0)
+    update = {"gameServers": [heartbeat("arn:task/" + str(task) + "-container0") for task in range(50)]}
+
+    # Far more updates than the matchmaking requests admitted per second are applied
+    for i in range(4):
+        assert all("error" not in result for result in updateredis.lambda_handler(update, None)["results"])
+
+    # The matchmaking requests within the limit are all admitted
+    with metrics.capture() as records:
+        responses = [requestgamesession.lambda_handler(player_request("player" + str(i)), None) for i in range(5)]
+    assert [response["statusCode"] for response in responses] == [200] * 5
+    assert all("ShedRequests" not in record for record in records)
@@ -0,0 +1,52 @@
+import backend
+import scaler
+
+
+def test_redis_client_is_reused(mocker):
+    mocker.patch.object(backend, "_redis_client", None)
+    create = mocker.patch("redis.Redis")
+
+    first = backend.get_redis_client()
+    assert backend.get_redis_client() is first
+    assert create.call_count == 1
+
+    backend.reset_redis_client()
+    backend.get_redis_client()
+    assert create.call_count == 2
+
+
+def test_task_definition_is_cached(mocker):
+    mocker.patch.object(backend, "_task_definition", None)
+    cloudformation = mocker.Mock()
+    cloudformation.describe_stacks.return_value = {
+        "Stacks": [{"Outputs": [{"OutputKey": "TaskDefinition", "OutputValue": "arn:task-definition:1", "Description": ""}]}]
+    }
+    mocker.patch.dict(backend._aws_clients, {"cloudformation": cloudformation})
+
+    assert backend.get_task_definition() == "arn:task-definition:1"
+    assert backend.get_task_definition() == "arn:task-definition:1"
+    assert cloudformation.describe_stacks.call_count == 1
+
+    mocker.patch("time.time", return_value=backend._task_definition_time + backend.task_definition_refresh_seconds + 1)
+    backend.get_task_definition()
+    assert cloudformation.describe_stacks.call_count == 2
+
+
+def test_scaler_recreates_aws_clients_after_an_error(mocker):
+    mocker.patch.object(backend, "_redis_client", mocker.Mock())
+    mocker.patch.dict(backend._aws_clients, {"ecs": mocker.Mock()})
+    mocker.patch("time.sleep")
+    rounds = []
+
+    def failing_round(redis_client, location):
+        rounds.append(location)
+        raise Exception("broken client")
+
+    # A single round, the minute is over once it has run
+    mocker.patch("time.time", side_effect=lambda: 60.0 * len(rounds))
+    mocker.patch.object(scaler, "scale_location", side_effect=failing_round)
+
+    scaler.run_scaler()
+
+    assert len(rounds) == 1
+    assert backend._aws_clients == {}
@@ -0,0 +1,167 @@
+import functools
+import time
+
+import pytest
+from redis.crc import key_slot
+
+import admission
+import registry
+import requestgamesession
+import scalein
+import updateredis
+
+
+@pytest.fixture()
+def sharded(redis_client, mocker):
+    """ Registry split into 4 shards. Fails the test if a script touches keys outside the hash slot of its declared
+    keys or declares keys in more than one slot (Redis Cluster rejects both)"""
+
+    from fakeredis.commands_mixins.scripting_mixin import ScriptingCommandsMixin
+
+    mocker.patch.object(registry, "shards", 4)
+    violations = []
+    script_slots = []
+    eval_script = ScriptingCommandsMixin.eval
+    lua_redis_call = ScriptingCommandsMixin._lua_redis_call
+
+    def to_bytes(key):
+        return key if isinstance(key, bytes) else str(key).encode()
+
+    @functools.wraps(eval_script)
+    def checked_eval(self, script, numkeys, *keys_and_args):
+        slots = set(key_slot(to_bytes(key)) for key in keys_and_args[:int(numkeys)])
+        if len(slots) > 1:
+            violations.append("keys in many slots: " + str(keys_and_args[:int(numkeys)]))
+        script_slots.append(slots)
+        try:
+            return eval_script(self, script, numkeys, *keys_and_args)
+        finally:
+            script_slots.pop()
+
+    def checked_lua_redis_call(self, lua_runtime, expected_globals, op, *args):
+        command = to_bytes(op).upper()
+        keys = args if command == b"DEL" else args[:2] if command == b"RENAME" else args[:1]
+        for key in keys:
+            if key_slot(to_bytes(key)) not in script_slots[-1]:
+                violations.append(command.decode() + " on undeclared slot: " + str(key))
+        return lua_redis_call(self, lua_runtime, expected_globals, op, *args)
+
+    mocker.patch.object(ScriptingCommandsMixin, "eval", checked_eval)
+    mocker.patch.object(ScriptingCommandsMixin, "_lua_redis_call", checked_lua_redis_call)
+    yield violations
+    assert violations == []
+
+
+def test_keys_of_a_task_share_a_hash_slot(sharded):
+
+    task_id = "arn:aws:ecs:task/cluster/0123456789abcdef"
+    slot = key_slot(registry.task_key(task_id).encode())
+    keys = [registry.server_key(state, task_id + "-container1") for state in registry.STATES]
+    keys += [registry.draining_key(task_id), registry.prioritize_key(task_id)]
+    keys += [registry.index_key(state, registry.shard_of(task_id)) for state in registry.STATES]
+
+    assert set(key_slot(key.encode()) for key in keys) == {slot}
+    # A ticket Hash is in the shard of its id, the queue of the location is outside the shards
+    assert key_slot(registry.ticket_key("ticket1").encode()) == key_slot(registry.ticket_notify_key("ticket1").encode())
+    assert registry.ticket_queue("eu-west-1").startswith("{tickets}")
+    # The Tasks are spread over the shards
+    assert len(set(registry.shard_of("arn:task/" + str(task)) for task in range(20))) == 4
+
+
+def test_admission_buckets_are_spread_over_the_shards(sharded, redis_client, mocker):
+
+    mocker.patch.object(admission, "shared_burst", 8.0)
+    players = ["player" + str(player) for player in range(20)]
+
+    # A player and its shared bucket share a hash slot, the players are spread over the shared buckets
+    for player in players:
+        shared_key = admission.shared_bucket_key(admission.shard_of(player))
+        assert key_slot(admission.player_bucket_key(player).encode()) == key_slot(shared_key.encode())
+    assert len(set(admission.shard_of(player) for player in players)) == 4
+
+    # Each shared bucket has its share of the burst
+    same_shard = [player for player in players if admission.shard_of(player) == admission.shard_of(players[0])]
+    assert [admission.admit_request(redis_client, player, now=1000.0) for player in same_shard[:3]] == [None, None, 1]
+    # The players of the other shards are not limited by it
+    assert admission.admit_request(redis_client, players[4], now=1000.0) == None
+
+
+def test_handlers_run_on_sharded_registry(sharded, redis_client, heartbeat, mocker):
+
+    for task in range(8):
+        for container in range(2):
+            updateredis.lambda_handler(heartbeat("arn:task/" + str(task) + "-container" + str(container)), None)
+
+    # 32 player slots on 16 game servers over the shards, every request gets a spot until they are all reserved
+    for i in range(8):
+        assert requestgamesession.lambda_handler({"queryStringParameters": {"groupSize": "2"}}, None)["statusCode"] == 200
+    mocker.patch.object(requestgamesession, "placement_strategy", "spread")
+    for i in range(16):
+        assert requestgamesession.lambda_handler({}, None)["statusCode"] == 200
+    assert requestgamesession.lambda_handler({}, None)["statusCode"] == 202
+    assert registry.count_tickets(redis_client) == 1
+
+    # The reservations expire, the next heartbeat serves the ticket
+    assert registry.sweep_reservations(redis_client, now=time.time() + 60) == 24
+    for task in range(8):
+        for container in range(2):
+            updateredis.lambda_handler(heartbeat("arn:task/" + str(task) + "-container" + str(container)), None)
+    assert registry.count_tickets(redis_client) == 0
+    assert registry.count_servers(redis_client)[registry.AVAILABLE] == 16
+
+
+def test_scale_in_on_sharded_registry(sharded, redis_client, heartbeat, mocker):
+
+    for task in range(4):
+        for container in range(2):
+            updateredis.lambda_handler(heartbeat("arn:task/" + str(task) + "-container" + str(container)), None)
+    ecs = mocker.Mock()
+    ecs.stop_task.side_effect = lambda cluster, task, reason: {"task": {"taskArn": task, "desiredStatus": "STOPPED"}}
+    now = time.time()
+    settings = {"available_game_servers_target_percentage": 0.2, "total_game_servers_target_min": 0, "containers_in_task": 2}
+
+    scalein.scale_in(redis_client, ecs, "cluster", 8, 8, settings, now)
+    assert scalein.scale_in(redis_client, ecs, "cluster", 8, 8, settings, now + scalein.drain_wait + 1) == 4
+    assert registry.count_servers(redis_client, now + scalein.drain_wait + 1) == dict((state, 0) for state in registry.STATES)
+
+
+def test_claims_try_shards_with_the_busiest_task_first(sharded, redis_client, heartbeat):
+
+    shard_tasks = {}
+    for task in range(40):
+        shard_tasks.setdefault(registry.shard_of("arn:task/" + str(task)), "arn:task/" + str(task))
+    for shard, task_id in shard_tasks.items():
+        updateredis.lambda_handler(heartbeat(task_id + "-container0"), None)
+    busiest = shard_tasks[2]
+    updateredis.lambda_handler(heartbeat(busiest + "-container0", current_players=1), None)
+
+    assert registry.claim_shards(redis_client, True)[0] == 2
+    assert sorted(registry.claim_shards(redis_client, False)) == [0, 1, 2, 3]
+    assert registry.claim_slots_by_occupancy(redis_client, 5)[0] == registry.server_key(registry.ACTIVE, busiest + "-container0")
+    # Shards without free slots are skipped
+    assert registry.claim_shards(redis_client, True) == [0, 1, 3]
+
+
+def test_tickets_of_all_shards_are_served_in_order_by_a_single_shard(sharded, redis_client, heartbeat, mocker):
+
+    mocker.patch.object(updateredis, "gameserverdata_ttl", 120.0)
+    # A single Task with game servers, the tickets are spread over all the shards
+    for container in range(3):
+        updateredis.lambda_handler(heartbeat("arn:task/0-container" + str(container), current_players=2, server_in_use=True), None)
+    ticket_ids = ["ticket" + str(i) for i in range(12)]
+    for ticket_id in ticket_ids:
+        registry.enqueue_ticket(redis_client, ticket_id, 1, 60)
+    assert len(set(registry.shard_of(ticket_id) for ticket_id in ticket_ids)) == 4
+
+    # The players of the first game server leave, it serves the first two tickets in the queue
+    updateredis.lambda_handler(heartbeat("arn:task/0-container0"), None)
+    placed = [ticket_id for ticket_id in ticket_ids if registry.get_ticket(redis_client, ticket_id)["status"] == "placed"]
+    assert placed == ticket_ids[:2]
+
+    # The players never connect, the scaler serves the next tickets with the slots released by the sweep
+    assert registry.serve_tickets(redis_client, 30) == 0
+    assert registry.sweep_reservations(redis_client, now=time.time() + 60) == 2
+    assert registry.serve_tickets(redis_client, 30) == 2
+    placed = [ticket_id for ticket_id in ticket_ids if registry.get_ticket(redis_client, ticket_id)["status"] == "placed"]
+    assert placed == ticket_ids[:4]
+    assert registry.count_tickets(redis_client) == 8
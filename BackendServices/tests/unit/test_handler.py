@@ -1,8 +1,14 @@
 import json
+import time
 
 import pytest
 
-from scaler import app
+import checktaskstatus
+import registry
+import requestgamesession
+import scaler
+import updateredis
+from simulator.fakeecs import FakeECS
 
 
 @pytest.fixture()
@@ -62,6 +68,194 @@ def apigw_event():
     }
 
 
-def test_lambda_handler(apigw_event, mocker):
+def test_lambda_handler(apigw_event, redis_client, heartbeat):
 
-    # NO TESTS ATM
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+
+    ret = requestgamesession.lambda_handler(apigw_event, None)
+    data = json.loads(ret["body"])
+
+    assert ret["statusCode"] == 200
+    assert data == {"publicIP": "10.0.0.1", "port": "1935"}
+    assert redis_client.hget(registry.server_key(registry.AVAILABLE, "arn:task/1-container0"), registry.RESERVED_SLOTS) == b"1"
+
+
+def test_lambda_handler_no_servers(apigw_event, redis_client, mocker):
+
+    ret = requestgamesession.lambda_handler(apigw_event, None)
+
+    assert ret["statusCode"] == 202
+    assert "ticketId" in json.loads(ret["body"])
+
+    mocker.patch.object(requestgamesession, "ticket_mode", False)
+    ret = requestgamesession.lambda_handler(apigw_event, None)
+
+    assert ret["statusCode"] == 500
+
+
+def test_lambda_handler_skips_servers_not_ready(apigw_event, redis_client, heartbeat):
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0", ready=False), None)
+
+    ret = requestgamesession.lambda_handler(apigw_event, None)
+
+    assert ret["statusCode"] == 202
+
+
+def test_queued_tickets_are_served_in_order_when_servers_get_ready(redis_client, heartbeat):
+
+    def ticket_status(ticket_id):
+        return requestgamesession.lambda_handler({"queryStringParameters": {"ticketId": ticket_id, "wait": "0.1"}}, None)
+
+    ticket_ids = [json.loads(requestgamesession.lambda_handler({}, None)["body"])["ticketId"] for i in range(3)]
+    # The client of the first ticket gave up
+    redis_client.delete(registry.ticket_key(ticket_ids[0]))
+    assert registry.count_tickets(redis_client) == 3
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+
+    for ticket_id in ticket_ids[1:]:
+        ret = ticket_status(ticket_id)
+        assert ret["statusCode"] == 200
+        assert json.loads(ret["body"]) == {"publicIP": "10.0.0.1", "port": "1935"}
+    assert ticket_status(ticket_ids[0])["statusCode"] == 404
+    assert registry.count_tickets(redis_client) == 0
+    # The placements are reserved on the game server
+    assert redis_client.hget(registry.server_key(registry.AVAILABLE, "arn:task/1-container0"), registry.RESERVED_SLOTS) == b"2"
+
+
+def test_ticket_stays_queued_until_a_server_has_room(redis_client, heartbeat):
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0", current_players=2, server_in_use=True), None)
+    ticket_id = json.loads(requestgamesession.lambda_handler({}, None)["body"])["ticketId"]
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0", current_players=2, server_in_use=True), None)
+    ret = requestgamesession.lambda_handler({"queryStringParameters": {"ticketId": ticket_id}}, None)
+
+    assert ret["statusCode"] == 202
+    assert json.loads(ret["body"]) == {"ticketId": ticket_id, "status": "queued"}
+
+
+def test_expired_tickets_dont_start_game_servers(redis_client, heartbeat, mocker):
+
+    mocker.patch("time.sleep")
+    mocker.patch.object(scaler, "scaling_policy", "percentage")
+    mocker.patch.object(scaler, "total_game_servers_target_min", 0)
+    ecs = FakeECS(scaler.containers_in_task)
+    # Game servers that are still starting up
+    for container in range(10):
+        updateredis.lambda_handler(heartbeat("arn:task/1-container" + str(container), ready=False), None)
+    # The players of 30 tickets gave up a while ago
+    for i in range(30):
+        registry.enqueue_ticket(redis_client, "expired" + str(i), 1, requestgamesession.ticket_timeout, now=time.time() - 120)
+
+    assert registry.count_tickets(redis_client) == 0
+    scaler.scaling_round(redis_client, ecs, "cluster", "task", ["subnet"], "security-group")
+    assert ecs.calls["run_task"] == 0
+
+    # 30 players waiting need 15 game servers, 5 more than the ones starting up
+    for i in range(30):
+        registry.enqueue_ticket(redis_client, "queued" + str(i), 1, requestgamesession.ticket_timeout)
+    scaler.scaling_round(redis_client, ecs, "cluster", "task", ["subnet"], "security-group")
+    assert len(ecs.running_tasks()) == 1
+
+
+def test_update_game_servers_batch(redis_client, heartbeat):
+
+    event = {"gameServers": [heartbeat("arn:task/1-container" + str(i)) for i in range(3)]}
+    event["gameServers"][1]["currentPlayers"] = 1
+    event["gameServers"].append({"taskArn": "arn:task/1-container3"})
+
+    ret = updateredis.lambda_handler(event, None)
+
+    assert ret["results"] == [
+        {"taskArn": "arn:task/1-container0", "state": "available"},
+        {"taskArn": "arn:task/1-container1", "state": "active"},
+        # The Task has an active container so the rest of its servers are prioritized
+        {"taskArn": "arn:task/1-container2", "state": "available-priority"},
+        {"taskArn": None, "error": "missing parameter 'serverInUse'"},
+    ]
+    assert redis_client.exists(registry.server_key(registry.ACTIVE, "arn:task/1-container1"))
+
+
+def test_check_task_status_in_large_keyspace(redis_client, heartbeat):
+
+    # Plenty of other game servers so that the Task's keys are nowhere near the start of the keyspace
+    with redis_client.pipeline(transaction=False) as pipe:
+        for i in range(20000):
+            pipe.set("available-gameserver-arn:task/other-" + str(i), 1)
+        pipe.execute()
+    for container in range(2):
+        updateredis.lambda_handler(heartbeat("arn:task/1-container" + str(container)), None)
+
+    assert checktaskstatus.lambda_handler({"taskArn": "arn:task/1"}, None) is False
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0", terminated=True), None)
+    assert checktaskstatus.lambda_handler({"taskArn": "arn:task/1"}, None) is False
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container1", terminated=True), None)
+    assert checktaskstatus.lambda_handler({"taskArn": "arn:task/1"}, None) is True
+
+
+def test_check_task_status_ignores_expired_servers(redis_client):
+
+    registry.add_to_task(redis_client, "arn:task/1-container0", "arn:task/1", 20, now=1000.0)
+    registry.add_to_task(redis_client, "arn:task/1-container1", "arn:task/1", 20, now=2000.0)
+
+    assert registry.count_task_servers(redis_client, "arn:task/1", now=1500.0) == 1
+    assert registry.count_task_servers(redis_client, "arn:task/1", now=2500.0) == 0
+
+
+def test_group_request_reserves_all_slots_on_one_server(redis_client, heartbeat):
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0", current_players=1), None)
+    updateredis.lambda_handler(heartbeat("arn:task/2-container0"), None)
+
+    ret = requestgamesession.lambda_handler({"queryStringParameters": {"groupSize": "2"}}, None)
+
+    assert ret["statusCode"] == 200
+    assert redis_client.hget(registry.server_key(registry.AVAILABLE, "arn:task/2-container0"), registry.RESERVED_SLOTS) == b"2"
+    assert redis_client.hget(registry.server_key(registry.ACTIVE, "arn:task/1-container0"), registry.RESERVED_SLOTS) is None
+
+
+def test_group_request_without_room_has_no_side_effects(redis_client, heartbeat, mocker):
+
+    mocker.patch.object(requestgamesession, "ticket_mode", False)
+    for task in range(3):
+        updateredis.lambda_handler(heartbeat("arn:task/" + str(task) + "-container0", current_players=1), None)
+
+    ret = requestgamesession.lambda_handler({"queryStringParameters": {"groupSize": "2"}}, None)
+
+    assert ret["statusCode"] == 500
+    for task in range(3):
+        assert redis_client.hget(registry.server_key(registry.ACTIVE, "arn:task/" + str(task) + "-container0"), registry.RESERVED_SLOTS) is None
+    assert requestgamesession.lambda_handler({"queryStringParameters": {"groupSize": "3"}}, None)["statusCode"] == 400
+
+
+def test_repeated_request_of_a_player_gets_the_same_spot(apigw_event, redis_client, heartbeat, mocker):
+
+    apigw_event["requestContext"]["identity"]["cognitoIdentityId"] = "us-east-1:player1"
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0", current_players=1), None)
+    server = registry.server_key(registry.ACTIVE, "arn:task/1-container0")
+
+    first = requestgamesession.lambda_handler(apigw_event, None)
+    repeated = requestgamesession.lambda_handler(apigw_event, None)
+
+    assert first["statusCode"] == repeated["statusCode"] == 200
+    assert json.loads(repeated["body"]) == json.loads(first["body"])
+    assert redis_client.hget(server, registry.RESERVED_SLOTS) == b"1"
+    assert 0 < redis_client.pttl(registry.player_key("us-east-1:player1")) <= requestgamesession.reservation_timeout * 1000
+
+    # A player waiting for a ticket gets the same ticket back
+    apigw_event["requestContext"]["identity"]["cognitoIdentityId"] = "us-east-1:player2"
+    requestgamesession.lambda_handler(apigw_event, None)
+    queued = requestgamesession.lambda_handler(apigw_event, None)
+    assert queued["statusCode"] == 202
+    assert json.loads(requestgamesession.lambda_handler(apigw_event, None)["body"]) == json.loads(queued["body"])
+    assert registry.count_tickets(redis_client) == 1
+
+    # Once the placement has expired the player gets a new spot
+    mocker.patch.object(requestgamesession, "ticket_mode", False)
+    redis_client.delete(registry.player_key("us-east-1:player1"))
+    apigw_event["requestContext"]["identity"]["cognitoIdentityId"] = "us-east-1:player1"
+    assert requestgamesession.lambda_handler(apigw_event, None)["statusCode"] == 500
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+import inventory
+import locations
+import metrics
+import registry
+import scaler
+import taskstatechange
+from simulator.fakeecs import FakeECS
+
+
+@pytest.fixture()
+def ecs(mocker):
+    """ Fake ECS cluster of the default location with 5 containers in a Task"""
+
+    mocker.patch.object(locations, "locations", [{"name": registry.default_location, "region": "local", "cluster": "cluster"}])
+    return FakeECS(5)
+
+
+def test_inventory_follows_task_events_out_of_order(ecs, redis_client):
+
+    task_arns = [task["taskArn"] for task in ecs.run_task(cluster="cluster", taskDefinition="task", count=3)["tasks"]]
+    ecs.set_status(task_arns[0], "RUNNING")
+    ecs.set_status(task_arns[1], "RUNNING")
+    ecs.stop_task(cluster="cluster", task=task_arns[1])
+    other_cluster = FakeECS(5)
+    other_cluster.run_task(cluster="other", taskDefinition="task")
+
+    # The latest events arrive first, the older events of the same Tasks (the start of the first two and the
+    # running event of the stopped one) are ignored
+    with metrics.capture() as records:
+        for event in reversed(ecs.take_events() + other_cluster.take_events()):
+            taskstatechange.lambda_handler(event, None)
+
+    assert sum(record.get("OutdatedTaskEvents", 0) for record in records) == 3
+    assert sum(record.get("IgnoredTaskEvents", 0) for record in records) == 1
+    counts = inventory.get_counts(redis_client, "task")
+    assert counts == {"tasks": 2, "containers": 10, "pending": 1, "running": 1, "containers_in_task": 5}
+
+
+def test_reconciliation_recovers_lost_events(ecs, redis_client):
+
+    tasks = ecs.run_task(cluster="cluster", taskDefinition="task", count=3)["tasks"]
+    inventory.record_tasks(redis_client, tasks[:2], now=1000.0)
+    ecs.stop_task(cluster="cluster", task=tasks[0]["taskArn"])
+    ecs.take_events()
+
+    # The stop event of the first Task and the start event of the third one were lost
+    assert inventory.reconcile(redis_client, ecs, "cluster", now=1010.0) == (1, 1)
+    assert inventory.get_counts(redis_client, "task")["tasks"] == 2
+    # A Task recorded after the listing started is not marked stopped
+    started = {"taskArn": "started-task", "taskDefinitionArn": "task", "containers": [{}] * 5, "version": 1}
+    inventory.record_task(redis_client, started, now=1030.0)
+    assert inventory.reconcile(redis_client, ecs, "cluster", now=1020.0) == (0, 0)
+    assert inventory.get_counts(redis_client, "task")["tasks"] == 3
+    # It is once a later listing doesn't have it, and the Task that stopped first is removed after the retention
+    assert inventory.reconcile(redis_client, ecs, "cluster", now=1011.0 + inventory.stopped_retention) == (0, 1)
+    assert inventory.get_counts(redis_client, "task")["tasks"] == 2
+    assert redis_client.hlen(inventory.tasks_key()) == 3
+
+
+def test_scaler_counts_tasks_from_the_inventory(ecs, redis_client, mocker):
+
+    mocker.patch("time.sleep")
+    mocker.patch.object(scaler, "scaling_policy", "percentage")
+
+    for i in range(3):
+        scaler.scaling_round(redis_client, ecs, "cluster", "task", ["subnet"], "security-group")
+
+    # The Tasks are listed only to reconcile the inventory on the first round
+    assert ecs.calls["list_tasks"] == 1
+    # The first round doesn't know the Task Definition yet and expects 10 containers in a Task (3 Tasks for the
+    # minimum of 30). The next round knows the Tasks have 5 containers and starts 3 more for the missing 15
+    assert len(ecs.running_tasks()) == 6
+    assert inventory.get_counts(redis_client, "task")["containers"] == scaler.total_game_servers_target_min
+
+
+def test_locations_without_task_events_are_reconciled_more_often(ecs, redis_client, mocker):
+
+    mocker.patch("time.sleep")
+    mocker.patch.object(scaler, "scaling_policy", "percentage")
+    mocker.patch.dict(os.environ, {"AWS_REGION": "us-east-1"})
+    remote = {"name": "eu-west-1", "region": "eu-west-1", "cluster": "cluster"}
+    assert not locations.receives_task_events(remote)
+    assert locations.receives_task_events(dict(remote, taskEvents=True))
+    assert locations.receives_task_events({"name": "us-east-1", "cluster": "cluster"})
+
+    def scaling_round():
+        scaler.scaling_round(redis_client, ecs, "cluster", "task", ["subnet"], "security-group", "eu-west-1", task_events=False)
+
+    with metrics.capture() as records:
+        metrics.begin("Scaler")
+        scaling_round()
+        assert 0 < redis_client.ttl(inventory.reconciled_key("eu-west-1")) <= inventory.remote_reconcile_interval
+        # A Task stops on its own in the remote Region, its event is not delivered
+        ecs.stop_task(cluster="cluster", task=ecs.running_tasks()[0]["taskArn"])
+        ecs.take_events()
+        scaling_round()
+        # The next reconciliation is due
+        redis_client.delete(inventory.reconciled_key("eu-west-1"))
+        scaling_round()
+        metrics.flush()
+
+    # The stopped Task is counted until the inventory is reconciled again, the Tasks are not listed on every round
+    assert records[0]["RunningTasks"] == [0, 3, 5]
+    assert ecs.calls["list_tasks"] == 2
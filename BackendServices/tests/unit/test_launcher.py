@@ -0,0 +1,31 @@
+import launcher
+import registry
+from simulator.fakeecs import FakeECS
+
+
+def test_launch_tasks_backs_off_on_throttling(redis_client, mocker):
+
+    sleep = mocker.patch("time.sleep")
+    ecs = FakeECS(10, throttle_every=3)
+
+    launched = launcher.launch_tasks(redis_client, ecs, 300, {"cluster": "cluster", "taskDefinition": "task"}, 2, 60)
+
+    assert launched == 300
+    assert len(ecs.running_tasks()) == 300
+    assert sleep.call_count > 0
+    # All the containers of the started Tasks are added as placeholders
+    assert registry.count_servers(redis_client)[registry.AVAILABLE] == 3000
+    task_arn = ecs.running_tasks()[0]["taskArn"]
+    assert registry.count_task_servers(redis_client, task_arn) == 10
+    assert redis_client.hget(registry.server_key(registry.AVAILABLE, task_arn + "-container0"), registry.READY) == b"0"
+
+
+def test_launch_tasks_reports_tasks_that_did_not_start(redis_client, mocker):
+
+    mocker.patch("time.sleep")
+    ecs = FakeECS(10, capacity=25)
+
+    launched = launcher.launch_tasks(redis_client, ecs, 40, {"cluster": "cluster", "taskDefinition": "task"}, 2, 60)
+
+    assert launched == 25
+    assert registry.count_servers(redis_client)[registry.AVAILABLE] == 250
@@ -0,0 +1,117 @@
+import json
+import os
+
+import pytest
+
+import backend
+import locations
+import metrics
+import registry
+import requestgamesession
+import scaler
+import updateredis
+from simulator.fakeecs import FakeECS
+
+
+@pytest.fixture()
+def two_locations(mocker):
+    """ Game servers in two locations (ECS clusters in different Regions)"""
+
+    configured = [
+        {"name": "us-west-2", "region": "us-west-2", "cluster": "cluster-us", "subnets": ["subnet-1"], "securityGroup": "sg-1",
+         "taskDefinition": "task-us"},
+        {"name": "eu-west-1", "region": "eu-west-1", "cluster": "cluster-eu", "subnets": ["subnet-2"], "securityGroup": "sg-2",
+         "taskDefinition": "task-eu", "minGameServers": 10},
+    ]
+    mocker.patch.object(locations, "locations", configured)
+    return configured
+
+
+def test_placement_order(mocker):
+
+    mocker.patch.object(locations, "locations", [{"name": "us-west-2"}, {"name": "eu-west-1"}, {"name": "ap-south-1"}])
+
+    assert locations.placement_order("us-west-2:120,eu-west-1:35,mars:1") == ["eu-west-1", "us-west-2"]
+    # The measured latencies come first, then the preferred locations. Malformed entries are ignored
+    assert locations.placement_order("ap-south-1:x,us-west-2:80", "ap-south-1,us-west-2") == ["us-west-2", "ap-south-1"]
+    # Without valid preferences all locations are tried
+    assert locations.placement_order(None, "mars") == ["us-west-2", "eu-west-1", "ap-south-1"]
+
+
+def test_locations_in_other_regions_need_a_task_definition(mocker):
+
+    mocker.patch.dict("os.environ", {"AWS_REGION": "us-west-2", "LOCATIONS": json.dumps([
+        {"name": "us-west-2", "cluster": "cluster-us", "subnets": ["subnet-1"], "securityGroup": "sg-1"},
+        {"name": "eu-west-1", "region": "eu-west-1", "cluster": "cluster-eu", "subnets": ["subnet-2"], "securityGroup": "sg-2"},
+    ])})
+
+    with pytest.raises(ValueError, match="eu-west-1"):
+        locations.load_locations()
+
+    # The home Region can use the Task Definition of the backend
+    configured = json.loads(os.environ["LOCATIONS"])
+    configured[1]["taskDefinition"] = "task-eu"
+    mocker.patch.dict("os.environ", {"LOCATIONS": json.dumps(configured)})
+    assert locations.load_locations() == configured
+
+
+def test_players_are_placed_in_the_lowest_latency_location_with_capacity(two_locations, redis_client, heartbeat):
+
+    for location in ["us-west-2", "eu-west-1"]:
+        update = heartbeat("arn:task/" + location + "-container0")
+        update["location"] = location
+        updateredis.lambda_handler(update, None)
+    assert registry.count_servers(redis_client, location="eu-west-1")[registry.AVAILABLE] == 1
+    assert registry.count_servers(redis_client)[registry.AVAILABLE] == 0
+
+    request = {"queryStringParameters": {"latencies": "us-west-2:120,eu-west-1:35"}}
+    for i in range(2):
+        assert requestgamesession.lambda_handler(request, None)["statusCode"] == 200
+    eu_server = registry.server_key(registry.AVAILABLE, "arn:task/eu-west-1-container0")
+    assert redis_client.hget(eu_server, registry.RESERVED_SLOTS) == b"2"
+
+    # The closest location is full, fall back to the next one
+    with metrics.capture() as records:
+        assert requestgamesession.lambda_handler(request, None)["statusCode"] == 200
+    us_server = registry.server_key(registry.AVAILABLE, "arn:task/us-west-2-container0")
+    assert redis_client.hget(us_server, registry.RESERVED_SLOTS) == b"1"
+    assert records[0]["FallbackPlacements"] == 1
+
+    # A client that only accepts the full location gets a ticket that only the game servers of that location serve
+    response = requestgamesession.lambda_handler({"queryStringParameters": {"locations": "eu-west-1"}}, None)
+    assert response["statusCode"] == 202
+    ticket_id = json.loads(response["body"])["ticketId"]
+    assert registry.count_tickets(redis_client, location="eu-west-1") == 1
+    update = heartbeat("arn:task/us-west-2-container0")
+    update["location"] = "us-west-2"
+    updateredis.lambda_handler(update, None)
+    assert registry.get_ticket(redis_client, ticket_id)["status"] == "queued"
+
+    redis_client.hset(eu_server, registry.RESERVED_SLOTS, 0)
+    update = heartbeat("arn:task/eu-west-1-container0")
+    update["location"] = "eu-west-1"
+    updateredis.lambda_handler(update, None)
+    assert registry.get_ticket(redis_client, ticket_id)["status"] == "placed"
+
+
+def test_scaler_manages_the_capacity_of_each_location(two_locations, redis_client, mocker):
+
+    mocker.patch("time.sleep")
+    clusters = {"us-west-2": FakeECS(scaler.containers_in_task), "eu-west-1": FakeECS(scaler.containers_in_task)}
+    mocker.patch.dict(backend._aws_clients, {"ecs:us-west-2": clusters["us-west-2"], "ecs:eu-west-1": clusters["eu-west-1"]})
+
+    with metrics.capture() as records:
+        metrics.begin("Scaler")
+        for location in two_locations:
+            with metrics.dimensions(**scaler.location_dimensions(location["name"])):
+                assert scaler.scale_location(redis_client, location)
+        metrics.flush()
+
+    # Each location starts its own minimum in its own cluster and the placeholders are in the indexes of the location
+    assert len(clusters["us-west-2"].running_tasks()) == scaler.total_game_servers_target_min // scaler.containers_in_task
+    assert len(clusters["eu-west-1"].running_tasks()) == 1
+    assert clusters["eu-west-1"].running_tasks()[0]["taskDefinitionArn"] == "task-eu"
+    assert registry.count_servers(redis_client, location="eu-west-1")[registry.AVAILABLE] == 10
+    assert registry.count_servers(redis_client, location="us-west-2")[registry.AVAILABLE] == scaler.total_game_servers_target_min
+    assert sorted(record["Location"] for record in records) == ["eu-west-1", "us-west-2"]
+    assert records[0]["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Location"]]
@@ -0,0 +1,105 @@
+import logging
+
+import redis
+from redis.backoff import NoBackoff
+
+import backend
+import checktaskstatus
+import metrics
+import registry
+import requestgamesession
+import scaler
+import updateredis
+from simulator.fakeecs import FakeECS
+
+
+def emitted_metrics(record):
+    """ The metric names declared in the EMF metadata of the record"""
+
+    return [metric["Name"] for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+
+
+def test_request_metrics_are_written_once_per_invocation(redis_client, heartbeat, mocker):
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+
+    with metrics.capture() as records:
+        assert requestgamesession.lambda_handler({}, None)["statusCode"] == 200
+        # Another container takes the last slot of the game server, the next request queues a ticket
+        assert registry.claim_slots_by_occupancy(redis_client, 5) != None
+        assert requestgamesession.lambda_handler({}, None)["statusCode"] == 202
+
+    assert len(records) == 2
+    placed, queued = records
+    assert placed["_aws"]["CloudWatchMetrics"][0]["Namespace"] == "RequestGameSession"
+    assert sorted(emitted_metrics(placed)) == sorted(name for name in placed if name != "_aws")
+    assert placed["Placements"] == 1 and placed["ClaimAttempts"] == 1
+    assert placed["RedisClaimTime"] > 0 and placed["RedisDemandTime"] > 0
+    assert queued["ClaimAttempts"] == requestgamesession.claim_attempts
+    assert queued["TicketsQueued"] == 1 and "Placements" not in queued
+
+
+
+def test_task_status_check_writes_a_record(redis_client, heartbeat):
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+
+    with metrics.capture() as records:
+        assert checktaskstatus.lambda_handler({"taskArn": "arn:task/1"}, None) is False
+        assert checktaskstatus.lambda_handler({"taskArn": "arn:task/2"}, None) is True
+
+    assert [record["_aws"]["CloudWatchMetrics"][0]["Namespace"] for record in records] == ["CheckTaskStatus"] * 2
+    assert records[0]["ActiveGameServersInTask"] == 1 and records[0]["RedisLookupTime"] > 0
+    assert records[1]["ActiveGameServersInTask"] == 0 and records[1]["TasksDone"] == 1
+
+def test_scaler_gauges_of_all_rounds_are_batched(redis_client, mocker):
+
+    mocker.patch("time.sleep")
+    ecs = FakeECS(scaler.containers_in_task)
+
+    with metrics.capture() as records:
+        metrics.begin("Scaler")
+        for i in range(2):
+            scaler.scaling_round(redis_client, ecs, "cluster", "task", ["subnet"], "security-group")
+        metrics.flush()
+
+    assert len(records) == 1
+    record = records[0]
+    # The first round started the minimum fleet, the second one sees its placeholders
+    assert record["TotalGameServers"] == [0, scaler.total_game_servers_target_min]
+    assert record["TasksLaunched"] == scaler.total_game_servers_target_min // scaler.containers_in_task
+    assert record["EcsListTasksTime"] > 0 and record["EcsRunTaskTime"] > 0 and record["RedisCountTime"] > 0
+    # Nothing is recorded outside of an invocation
+    assert metrics.flush() == []
+
+
+def test_redis_retries_are_counted():
+
+    retry = backend.CountingRetry(NoBackoff(), 3)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise redis.exceptions.ConnectionError()
+        return "OK"
+
+    with metrics.capture() as records:
+        metrics.begin("Test")
+        assert retry.call_with_retry(flaky, lambda error: None) == "OK"
+        metrics.flush()
+
+    assert records[0]["RedisRetries"] == 2
+
+
+def test_request_details_are_logged_at_debug_level(redis_client, heartbeat, caplog):
+
+    with caplog.at_level(logging.INFO, logger=metrics.logger.name):
+        updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+        requestgamesession.lambda_handler({}, None)
+    assert not any(record.levelno < logging.INFO for record in caplog.records)
+    assert not any("Claimed a spot" in record.getMessage() for record in caplog.records)
+
+    with caplog.at_level(logging.DEBUG, logger=metrics.logger.name):
+        requestgamesession.lambda_handler({}, None)
+    assert any("Claimed a spot" in record.getMessage() for record in caplog.records)
@@ -0,0 +1,257 @@
+import registry
+import updateredis
+
+
+def test_heartbeats_move_server_between_indexes(redis_client, heartbeat):
+
+    server_id = "arn:task/1-container0"
+
+    updateredis.lambda_handler(heartbeat(server_id), None)
+    assert redis_client.zscore(registry.index_key(registry.AVAILABLE, 0), server_id) is not None
+
+    updateredis.lambda_handler(heartbeat(server_id, current_players=1), None)
+    assert redis_client.zscore(registry.index_key(registry.AVAILABLE, 0), server_id) is None
+    assert redis_client.zscore(registry.index_key(registry.ACTIVE, 0), server_id) is not None
+
+    updateredis.lambda_handler(heartbeat(server_id, current_players=2, server_in_use=True), None)
+    assert redis_client.zscore(registry.index_key(registry.ACTIVE, 0), server_id) is None
+    assert redis_client.zscore(registry.index_key(registry.FULL, 0), server_id) is not None
+
+    # The Task has hosted sessions so the server comes back as priority
+    updateredis.lambda_handler(heartbeat(server_id), None)
+    assert redis_client.zscore(registry.index_key(registry.FULL, 0), server_id) is None
+    assert redis_client.zscore(registry.index_key(registry.AVAILABLE_PRIORITY, 0), server_id) is not None
+
+    updateredis.lambda_handler(heartbeat(server_id, terminated=True), None)
+    for state in registry.STATES:
+        assert redis_client.zscore(registry.index_key(state, 0), server_id) is None
+        assert not redis_client.exists(registry.server_key(state, server_id))
+
+
+def test_claim_slots_skips_expired_servers(redis_client):
+
+    registry.update_game_server(redis_client, "arn:task/1-container0", "arn:task/1", False, False, 0, 2, True, "10.0.0.1", 1935, 20, now=1000.0)
+    registry.update_game_server(redis_client, "arn:task/2-container0", "arn:task/2", False, False, 0, 2, True, "10.0.0.2", 1935, 20, now=2000.0)
+
+    for i in range(2):
+        claimed = registry.claim_slots(redis_client, [registry.AVAILABLE], 10, now=1500.0)
+        assert claimed == [registry.server_key(registry.AVAILABLE, "arn:task/2-container0"), "10.0.0.2", "1935"]
+    assert registry.claim_slots(redis_client, [registry.AVAILABLE], 10, now=1500.0) is None
+
+
+def test_count_servers_prunes_expired_entries(redis_client):
+
+    registry.update_index(redis_client, "arn:task/1-container0", registry.AVAILABLE, 20, now=1000.0)
+    registry.update_index(redis_client, "arn:task/1-container1", registry.ACTIVE, 20, now=2000.0)
+
+    counts = registry.count_servers(redis_client, now=1500.0)
+
+    assert counts == {registry.AVAILABLE: 0, registry.AVAILABLE_PRIORITY: 0, registry.ACTIVE: 1, registry.FULL: 0}
+    assert redis_client.zcard(registry.index_key(registry.AVAILABLE, 0)) == 0
+
+
+def test_count_servers_matches_full_recount(redis_client, heartbeat):
+
+    for task in range(20):
+        for container in range(10):
+            server_id = "arn:task/" + str(task) + "-container" + str(container)
+            players = (task + container) % 3
+            updateredis.lambda_handler(heartbeat(server_id, current_players=players, server_in_use=players == 2), None)
+    # Terminated servers and servers whose data expired in Redis
+    for container in range(5):
+        updateredis.lambda_handler(heartbeat("arn:task/0-container" + str(container), terminated=True), None)
+    for container in range(5):
+        server_id = "arn:task/1-container" + str(container)
+        registry.update_index(redis_client, server_id, registry.ACTIVE, -1)
+        redis_client.delete(*[registry.server_key(state, server_id) for state in registry.STATES])
+
+    counts = registry.count_servers(redis_client)
+
+    for state in registry.STATES:
+        recount = len(list(redis_client.scan_iter(match="{gs*}" + state + "-gameserver-*", count=1000)))
+        assert counts[state] == recount
+    assert sum(counts.values()) == 190
+
+
+def test_claim_slots_prefers_active_servers(redis_client, heartbeat):
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+    updateredis.lambda_handler(heartbeat("arn:task/2-container0", current_players=1), None)
+
+    states = [registry.ACTIVE, registry.AVAILABLE_PRIORITY, registry.AVAILABLE]
+    claimed = registry.claim_slots(redis_client, states, 25)
+
+    assert claimed == [registry.server_key(registry.ACTIVE, "arn:task/2-container0"), "10.0.0.1", "1935"]
+    # The player that is already on the game server is not pending
+    assert redis_client.hget(registry.server_key(registry.ACTIVE, "arn:task/2-container0"), registry.RESERVED_SLOTS) == b"1"
+
+
+def test_claim_slots_never_overfills_a_server(redis_client, heartbeat):
+
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+
+    states = [registry.AVAILABLE]
+    assert registry.claim_slots(redis_client, states, 25) is not None
+    assert registry.claim_slots(redis_client, states, 25) is not None
+    assert registry.claim_slots(redis_client, states, 25) is None
+    assert redis_client.hget(registry.server_key(registry.AVAILABLE, "arn:task/1-container0"), registry.RESERVED_SLOTS) == b"2"
+
+
+def test_heartbeat_moves_reservations_with_the_server(redis_client):
+
+    server_id = "arn:task/1-container0"
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 0, 2, True, "10.0.0.1", 1935, 20, now=1000.0)
+    assert registry.claim_slots_by_occupancy(redis_client, 5, slots=2, now=1000.0) is not None
+
+    result = registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 1, 2, True, "10.0.0.1", 1935, 20, now=1010.0)
+
+    assert registry.state_from_result(result) == registry.ACTIVE
+    assert not redis_client.exists(registry.server_key(registry.AVAILABLE, server_id))
+    # The connected player took one of the pending slots of the reservation
+    key = registry.server_key(registry.ACTIVE, server_id)
+    assert redis_client.hget(key, registry.RESERVED_SLOTS) == b"1"
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1010.0) is None
+
+
+def test_sweep_releases_expired_reservations(redis_client):
+
+    server_id = "arn:task/1-container0"
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 0, 2, True, "10.0.0.1", 1935, 60, now=1000.0)
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1000.0) is not None
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1000.0) is not None
+    assert redis_client.zscore(registry.occupancy_index(0), "arn:task/1") is None
+    # One of the two players connected
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 1, 2, True, "10.0.0.1", 1935, 60, now=1010.0)
+
+    assert registry.sweep_reservations(redis_client, now=1020.0) == 0
+    assert registry.sweep_reservations(redis_client, batch=1, now=1031.0) == 2
+
+    # The connected player takes its slot as a current player
+    assert redis_client.hget(registry.server_key(registry.ACTIVE, server_id), registry.RESERVED_SLOTS) == b"0"
+    assert redis_client.zcard(registry.reservation_index(0)) == 0
+    # The released slot is free for placements again
+    assert redis_client.zscore(registry.occupancy_index(0), "arn:task/1") == 1.5
+
+
+def test_connected_players_dont_release_other_pending_reservations(redis_client):
+
+    server_id = "arn:task/1-container0"
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 0, 2, True, "10.0.0.1", 1935, 60, now=1000.0)
+    # Player A claims and connects, player B claims later
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1000.0) is not None
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 1, 2, True, "10.0.0.1", 1935, 60, now=1005.0)
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1010.0) is not None
+
+    # The reservation of A expires but A is connected, B is still pending so the game server stays full
+    assert registry.sweep_reservations(redis_client, now=1031.0) == 1
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1032.0) is None
+    assert redis_client.zscore(registry.occupancy_index(0), "arn:task/1") is None
+
+    # Once the reservation of B expires its slot is free again
+    assert registry.sweep_reservations(redis_client, now=1041.0) == 1
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1042.0) is not None
+
+
+def test_reserved_slots_are_released_after_the_players_leave(redis_client):
+
+    server_id = "arn:task/1-container0"
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 0, 2, True, "10.0.0.1", 1935, 60, now=1000.0)
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1000.0) is not None
+    # The player connects, its reservation expires and the player leaves
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 1, 2, True, "10.0.0.1", 1935, 60, now=1010.0)
+    assert registry.sweep_reservations(redis_client, now=1031.0) == 1
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 0, 2, True, "10.0.0.1", 1935, 60, now=1040.0)
+
+    assert redis_client.hget(registry.server_key(registry.AVAILABLE_PRIORITY, server_id), registry.RESERVED_SLOTS) == b"0"
+    assert registry.drain_task(redis_client, "arn:task/1", 30, now=1045.0) == 1
+
+    # A player that is connected without a reservation takes a slot but doesn't take over the pending reservations
+    registry.update_game_server(redis_client, "arn:task/2-container0", "arn:task/2", False, False, 1, 2, True, "10.0.0.1", 1935, 60, now=1000.0)
+    key = registry.server_key(registry.ACTIVE, "arn:task/2-container0")
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1000.0) is not None
+    registry.update_game_server(redis_client, "arn:task/2-container0", "arn:task/2", False, False, 1, 2, True, "10.0.0.1", 1935, 60, now=1015.0)
+    assert redis_client.hget(key, registry.RESERVED_SLOTS) == b"1"
+    assert registry.claim_slots_by_occupancy(redis_client, 5, now=1020.0) is None
+    # The player leaves and the reservation expires
+    registry.update_game_server(redis_client, "arn:task/2-container0", "arn:task/2", False, False, 0, 2, True, "10.0.0.1", 1935, 60, now=1025.0)
+    assert registry.sweep_reservations(redis_client, now=1031.0) == 1
+    assert redis_client.hget(registry.server_key(registry.AVAILABLE_PRIORITY, "arn:task/2-container0"), registry.RESERVED_SLOTS) == b"0"
+
+
+
+def test_claim_by_occupancy_fills_busiest_task_first(redis_client, heartbeat):
+
+    for task in range(3):
+        for container in range(3):
+            updateredis.lambda_handler(heartbeat("arn:task/" + str(task) + "-container" + str(container)), None)
+    # Task 2 has the most players, task 1 has hosted sessions before (prioritized)
+    updateredis.lambda_handler(heartbeat("arn:task/2-container0", current_players=2, server_in_use=True), None)
+    updateredis.lambda_handler(heartbeat("arn:task/2-container1", current_players=1), None)
+    redis_client.set(registry.prioritize_key("arn:task/1"), "yes")
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0"), None)
+
+    claimed = [registry.claim_slots_by_occupancy(redis_client, 5)[0] for i in range(6)]
+
+    assert claimed == [
+        registry.server_key(registry.ACTIVE, "arn:task/2-container1"),
+        registry.server_key(registry.AVAILABLE, "arn:task/2-container2"),
+        registry.server_key(registry.AVAILABLE, "arn:task/2-container2"),
+        registry.server_key(registry.AVAILABLE_PRIORITY, "arn:task/1-container0"),
+        registry.server_key(registry.AVAILABLE_PRIORITY, "arn:task/1-container0"),
+        registry.server_key(registry.AVAILABLE, "arn:task/1-container1"),
+    ]
+    # Task 2 is fully reserved now and left the occupancy index
+    assert redis_client.zscore(registry.occupancy_index(0), "arn:task/2") is None
+    assert redis_client.zscore(registry.occupancy_index(0), "arn:task/1") == 3.5
+    assert redis_client.zscore(registry.occupancy_index(0), "arn:task/0") == 0
+
+
+def test_claim_by_occupancy_drops_expired_tasks(redis_client):
+
+    registry.update_game_server(redis_client, "arn:task/1-container0", "arn:task/1", False, False, 1, 2, True, "10.0.0.1", 1935, 20, now=1000.0)
+    registry.update_game_server(redis_client, "arn:task/2-container0", "arn:task/2", False, False, 0, 2, True, "10.0.0.2", 1935, 20, now=1015.0)
+
+    claimed = registry.claim_slots_by_occupancy(redis_client, 5, now=1025.0)
+
+    assert claimed == [registry.server_key(registry.AVAILABLE, "arn:task/2-container0"), "10.0.0.2", "1935"]
+    assert redis_client.zrange(registry.occupancy_index(0), 0, -1) == [b"arn:task/2"]
+
+
+def test_game_server_hashes_are_compact(redis_client):
+
+    server_id = "arn:task/1-container0"
+    key = registry.server_key(registry.AVAILABLE, server_id)
+    registry.update_game_server(redis_client, server_id, "arn:task/1", False, False, 0, 2, True, "10.0.0.1", 1935, 20)
+
+    assert redis_client.hgetall(key) == {b"v": b"1", b"c": b"0", b"m": b"2", b"r": b"1", b"a": b"10.0.0.1:1935"}
+    assert registry.claim_slots_by_occupancy(redis_client, 5) == [key, "10.0.0.1", "1935"]
+
+
+def test_steady_heartbeats_dont_read_the_whole_task(redis_client, mocker):
+
+    from fakeredis.commands_mixins.scripting_mixin import ScriptingCommandsMixin
+
+    commands = []
+    lua_redis_call = ScriptingCommandsMixin._lua_redis_call
+
+    def counted_lua_redis_call(self, lua_runtime, expected_globals, op, *args):
+        commands.append(op)
+        return lua_redis_call(self, lua_runtime, expected_globals, op, *args)
+
+    mocker.patch.object(ScriptingCommandsMixin, "_lua_redis_call", counted_lua_redis_call)
+
+    def heartbeat_commands(containers, current_players):
+        task_id = "arn:task/" + str(containers)
+        for container in range(containers):
+            registry.update_game_server(redis_client, task_id + "-container" + str(container), task_id, False, False, 1, 2,
+                                        True, "10.0.0.1", 1935, 20, now=1000.0)
+        del commands[:]
+        registry.update_game_server(redis_client, task_id + "-container0", task_id, False, False, current_players, 2,
+                                    True, "10.0.0.1", 1935, 20, now=1010.0)
+        return len(commands)
+
+    # A heartbeat that doesn't change the slots of the game server runs the same commands whatever the Task size
+    assert heartbeat_commands(2, 1) == heartbeat_commands(10, 1) <= 20
+    # When the slots change the other game servers of the Task are read to update the occupancy index
+    assert heartbeat_commands(20, 2) > 20
+    assert redis_client.zscore(registry.occupancy_index(0), "arn:task/20") == 21.5
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+import registry
+import scalein
+import updateredis
+
+settings = {
+    "available_game_servers_target_percentage": 0.2,
+    "total_game_servers_target_min": 0,
+    "containers_in_task": 10,
+}
+
+
+@pytest.fixture()
+def fleet(redis_client, heartbeat):
+    """ Two Tasks of 10 idle game servers, the second one with a player on one of its game servers"""
+
+    for task in range(2):
+        for container in range(10):
+            updateredis.lambda_handler(heartbeat("arn:task/" + str(task) + "-container" + str(container)), None)
+    updateredis.lambda_handler(heartbeat("arn:task/1-container0", current_players=1), None)
+    return redis_client
+
+
+def test_excess_game_servers_keeps_headroom_and_minimum():
+
+    assert scalein.excess_game_servers(19, 20, settings) == 18
+    assert scalein.excess_game_servers(4, 20, settings) == 0
+    assert scalein.excess_game_servers(19, 20, dict(settings, total_game_servers_target_min=15)) == 5
+
+
+def test_scale_in_drains_and_stops_idle_task(fleet, heartbeat, mocker):
+
+    ecs = mocker.Mock()
+    ecs.stop_task.side_effect = lambda cluster, task, reason: {"task": {"taskArn": task, "desiredStatus": "STOPPED"}}
+    now = time.time()
+
+    assert scalein.scale_in(fleet, ecs, "cluster", 19, 20, settings, now) == 0
+    # The idle Task is out of the indexes (no placements) and stays out after heartbeats
+    updateredis.lambda_handler(heartbeat("arn:task/0-container0"), None)
+    counts = registry.count_servers(fleet)
+    assert counts[registry.AVAILABLE] + counts[registry.AVAILABLE_PRIORITY] == 9
+    assert fleet.zscore(registry.DRAINING_TASKS, "arn:task/0") is not None
+    ecs.stop_task.assert_not_called()
+
+    assert scalein.scale_in(fleet, ecs, "cluster", 9, 10, settings, now + scalein.drain_wait + 1) == 1
+    ecs.stop_task.assert_called_once_with(cluster="cluster", task="arn:task/0", reason="Scaled in by the scaler")
+    assert not fleet.exists(registry.server_key(registry.AVAILABLE, "arn:task/0-container0"))
+    assert not fleet.exists(registry.task_key("arn:task/0"))
+
+
+def test_draining_task_with_reservation_is_released(fleet, mocker):
+
+    ecs = mocker.Mock()
+    now = time.time()
+    scalein.scale_in(fleet, ecs, "cluster", 19, 20, settings, now)
+    # A placement that landed while the Task was being marked draining
+    fleet.hset(registry.server_key(registry.AVAILABLE, "arn:task/0-container3"), registry.RESERVED_SLOTS, 1)
+
+    assert scalein.scale_in(fleet, ecs, "cluster", 9, 10, settings, now + scalein.drain_wait + 1) == 0
+    ecs.stop_task.assert_not_called()
+    assert not fleet.exists(registry.draining_key("arn:task/0"))
+
+
+def test_no_scale_in_after_scale_out(fleet, mocker):
+
+    ecs = mocker.Mock()
+    scalein.record_scale_out(fleet)
+
+    scalein.scale_in(fleet, ecs, "cluster", 19, 20, settings)
+
+    assert fleet.zcard(registry.DRAINING_TASKS) == 0
@@ -0,0 +1,66 @@
+import scalingpolicy
+
+settings = {
+    "total_game_servers_target_min": 30,
+    "available_game_servers_target_percentage": 0.2,
+    "server_startup_grace_period": 60,
+    "forecast_startup_periods": 2,
+}
+
+
+def record_ramp(redis_client, now):
+    # Requests grow by one per bucket over the history window
+    for i in range(scalingpolicy.history_buckets):
+        bucket = now - (scalingpolicy.history_buckets - i) * scalingpolicy.bucket_seconds
+        for request in range(i):
+            scalingpolicy.record_session_request(redis_client, True, now=bucket)
+
+
+def test_demand_history(redis_client):
+
+    scalingpolicy.record_session_request(redis_client, True, now=995.0)
+    scalingpolicy.record_session_request(redis_client, False, now=995.0)
+    # Current bucket is not complete yet and is not part of the history
+    scalingpolicy.record_session_request(redis_client, True, now=1001.0)
+
+    history = scalingpolicy.get_demand_history(redis_client, now=1005.0)
+
+    assert len(history) == scalingpolicy.history_buckets
+    assert history[-1] == (0.2, 0.1)
+    assert history[-2] == (0.0, 0.0)
+
+
+def test_forecast_rate_follows_trend():
+
+    level, forecast = scalingpolicy.forecast_rate([1.0, 2.0, 3.0, 4.0, 5.0, 6.0], 20)
+
+    assert 5.0 < level < 6.0
+    assert forecast > level
+
+    assert scalingpolicy.forecast_rate([], 20) == (0.0, 0.0)
+    assert scalingpolicy.forecast_rate([2.0, 2.0, 2.0], 120) == (2.0, 2.0)
+
+
+def test_percentage_policy():
+
+    assert scalingpolicy.percentage_policy(None, 50, 100, settings) == 0
+    assert scalingpolicy.percentage_policy(None, 10, 100, settings) == 10
+    assert scalingpolicy.percentage_policy(None, 0, 10, settings) == 20
+
+
+def test_predictive_policy_starts_capacity_ahead_of_ramp(redis_client, mocker):
+
+    now = scalingpolicy.bucket_seconds * 1000
+    record_ramp(redis_client, now)
+
+    mocker.patch("time.time", return_value=now)
+    predicted = scalingpolicy.predictive_policy(redis_client, 40, 200, settings)
+
+    # The percentage policy alone would not start anything with 20% available
+    assert scalingpolicy.percentage_policy(None, 40, 200, settings) == 0
+    assert predicted > 0
+
+
+def test_predictive_policy_falls_back_without_demand(redis_client):
+
+    assert scalingpolicy.predictive_policy(redis_client, 10, 100, settings) == 10
@@ -0,0 +1,27 @@
+from simulator import simulate
+
+
+def test_synthetic_trace_ramps_up_to_peak():
+
+    arrivals = simulate.synthetic_trace(1000.0, 0.1, 1.0, seed=1)
+    first_quarter = len([a for a in arrivals if a < 250.0])
+    middle = len([a for a in arrivals if 375.0 <= a < 625.0])
+
+    assert arrivals == sorted(arrivals)
+    assert middle > first_quarter * 2
+
+
+def test_simulation_places_players_and_reports_metrics():
+
+    arrivals = simulate.synthetic_trace(300.0, 0.1, 0.5, seed=1)
+    simulation = simulate.Simulation({"session_length": 60.0, "max_sessions": 1})
+
+    results = simulation.run(arrivals, 300.0)
+
+    assert results["players"] == len(arrivals)
+    assert results["placed"] + results["failed"] <= results["players"]
+    assert results["placed"] > 0
+    assert results["tasks_started"] > 0
+    assert 0.0 < results["idle_container_hours"] <= results["container_hours"]
+    # Game servers that hosted their session terminate and their Tasks are stopped
+    assert simulation.ecs.calls["stop_task"] > 0
@@ -22,6 +22,17 @@ public class MatchmakingClient
     public static Amazon.RegionEndpoint region = Amazon.RegionEndpoint.USEast1;
     // *********************************************************** //
 
+    // The latencies to the game server locations measured by the client ("us-east-1:40,eu-west-1:95") or the preferred
+    // locations in order ("eu-west-1,us-east-1"). The backend places us in the closest location that has room
+    public static string locationLatencies = null;
+    public static string preferredLocations = null;
+
+    // The matchmaking ticket we are waiting for when the backend didn't have a free spot for us right away
+    string ticketId = null;
+
+    // Seconds to wait before the next request when the backend asked us to slow down (too many requests)
+    public float retryAfter = 0.0f;
+
     // Helper function to send and wait for response to a signed request to the API Gateway endpoint
     async Task<string> SendSignedGetRequest(string requestUrl)
     {
@@ -43,16 +54,46 @@ public class MatchmakingClient
     {
         try
         {
+            // Check our queued ticket (the backend waits for max 4 seconds for a game server) or request a new game session
+            string url = apiEndpoint + "requestgamesession";
+            if (this.ticketId != null)
+                url += "?ticketId=" + this.ticketId + "&wait=4";
+            else if (!String.IsNullOrEmpty(locationLatencies))
+                url += "?latencies=" + locationLatencies;
+            else if (!String.IsNullOrEmpty(preferredLocations))
+                url += "?locations=" + preferredLocations;
+
             //Make the signed request and wait for max 10 seconds to complete
-            var response = Task.Run(() => this.SendSignedGetRequest(apiEndpoint + "requestgamesession"));
+            var response = Task.Run(() => this.SendSignedGetRequest(url));
             response.Wait(10000);
             string jsonResponse = response.Result;
             Debug.Log("Json response: " + jsonResponse);
 
+            // The backend is busy, keep our ticket and try again after the time it asked for
+            this.retryAfter = 0.0f;
+            if (jsonResponse.Contains("retryAfter"))
+            {
+                this.retryAfter = JsonUtility.FromJson<GameSessionInfo>(jsonResponse).retryAfter;
+                return null;
+            }
+
+            // The ticket expired or the request failed, start with a new request next time
             if (jsonResponse.Contains("failed"))
+            {
+                this.ticketId = null;
                 return null;
+            }
 
             GameSessionInfo info = JsonUtility.FromJson<GameSessionInfo>(jsonResponse);
+
+            // Queued to wait for a game server, check the ticket next time
+            if (!String.IsNullOrEmpty(info.ticketId))
+            {
+                this.ticketId = info.ticketId;
+                return null;
+            }
+
+            this.ticketId = null;
             return info;
         }
         catch (Exception e)
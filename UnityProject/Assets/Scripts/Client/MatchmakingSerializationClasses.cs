@@ -7,4 +7,7 @@ public class GameSessionInfo
 {
     public string publicIP;
     public int port;
+    public string ticketId; // Set instead of the IP and port when the request was queued
+    public string status;
+    public float retryAfter; // Set with an error when the backend had too many requests, seconds to wait before trying again
 }
\ No newline at end of file
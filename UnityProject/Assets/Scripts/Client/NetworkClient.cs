@@ -43,7 +43,7 @@ public class NetworkClient
 			if (gameSessionInfo == null)
 			{
 				GameObject.FindObjectOfType<UIManager>().SetTextBox("No game session found yet, trying again...");
-				yield return new WaitForSeconds(1.0f);
+				yield return new WaitForSeconds(Mathf.Max(1.0f, this.matchmakingClient.retryAfter));
 			}
 			else
 			{
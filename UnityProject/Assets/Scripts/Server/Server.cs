@@ -33,6 +33,7 @@ public class GameServerStatusData
     public int port { get; set; } //Port used
     public bool serverTerminated { get; set; } //Tells the backend that server has terminated and needs to be deleted from redis
     public int gameSessionsHosted { get; set; } //How many game sessions this server has already hosted? Used for terminating the Task when defined maximum is reached
+    public string location { get; set; } //Location of the game server (the LOCATION environment variable or the Region of the Task)
 }
 
 public class TaskStatusData
@@ -380,6 +381,7 @@ public class Server : MonoBehaviour
         gameServerStatusData.port = Server.port;
         gameServerStatusData.serverTerminated = serverTerminated;
         gameServerStatusData.gameSessionsHosted = Server.hostedGameSessions;
+        gameServerStatusData.location = Environment.GetEnvironmentVariable("LOCATION") ?? Environment.GetEnvironmentVariable("AWS_REGION");
 
         var lambdaConfig = new AmazonLambdaConfig() { RegionEndpoint = this.regionEndpoint };
         lambdaConfig.MaxErrorRetry = 0; //Don't do retries on failures